@@ -0,0 +1,132 @@
+"""
+Settings of the study shared by the notebooks and the pipeline (see `pipeline`): Brightway project and databases,
+impact assessment methods, inventories, datasets to regionalize, countries and N2O emission factors of the use of
+ammonia
+"""
+
+import pandas as pd
+from pathlib import Path
+
+
+# To be changed accordingly: name of your project and of the ecoinvent database in your project
+BW_PROJECT = 'iri_work'
+ECOINVENT_DB = 'ecoinvent 3.9.1 cutoff'
+LCI_DB = 'biomethane-to-ammonia'
+
+DATA_DIR = Path(__file__).resolve().parents[1] / "data"
+
+LCIA_METHODS = {
+    'Climate change, GWP 100a':            ('IPCC 2021', 'climate change', 'GWP 100a, incl. H and bio CO2'),
+    'Acidification':                       ('EF v3.1', 'acidification', 'accumulated exceedance (AE)'),
+    'Eutrophication, freshwater':          ('EF v3.1', 'eutrophication: freshwater', 'fraction of nutrients reaching freshwater end compartment (P)'),
+    'Eutrophication, marine':              ('EF v3.1', 'eutrophication: marine', 'fraction of nutrients reaching marine end compartment (N)'),
+    'Eutrophication, terrestrial':         ('EF v3.1', 'eutrophication: terrestrial', 'accumulated exceedance (AE)'),
+    'Photochemical oxidant formation':     ('EF v3.1', 'photochemical oxidant formation: human health', 'tropospheric ozone concentration increase'),
+    'Particulate matter formation':        ('EF v3.1', 'particulate matter formation', 'impact on human health'),
+    'Ozone depletion':                     ('EF v3.1', 'ozone depletion', 'ozone depletion potential (ODP)'),
+    'Ecotoxicity, freshwater':             ('EF v3.1', 'ecotoxicity: freshwater', 'comparative toxic unit for ecosystems (CTUe)'),
+    'Human toxicity, carcinogenic':        ('EF v3.1', 'human toxicity: carcinogenic', 'comparative toxic unit for human (CTUh)'),
+    'Human toxicity, non-carcinogenic':    ('EF v3.1', 'human toxicity: non-carcinogenic', 'comparative toxic unit for human (CTUh)'),
+    'Ionising radiation':                  ('EF v3.1', 'ionising radiation: human health', 'human exposure efficiency relative to u235'),
+    'Energy resources, non-renewable':     ('EF v3.1', 'energy resources: non-renewable', 'abiotic depletion potential (ADP): fossil fuels'),
+    'Material resources, minerals/metals': ('EF v3.1', 'material resources: metals/minerals', 'abiotic depletion potential (ADP): elements (ultimate reserves)'),
+    'Land use':                            ('EF v3.1', 'land use', 'soil quality index'),
+    'Water use':                           ('EF v3.1', 'water use', 'user deprivation potential (deprivation-weighted water consumption)')
+}
+
+IPCC_IMPACT = 'Climate change, GWP 100a'
+IPCC_METHOD = {IPCC_IMPACT: LCIA_METHODS[IPCC_IMPACT]}
+
+# Ammonia production datasets of the scenarios as {scenario: (name, reference product)}
+INVENTORIES = {
+    'Natural gas':                                            ('ammonia production, liquid, fossil ammonia from natural gas', 'ammonia, anhydrous, liquid'),
+    'Natural gas + CCS Syngas':                               ('ammonia production, liquid, fossil ammonia from natural gas, syngas w/ CCS', 'ammonia, anhydrous, liquid'),
+    'Natural gas + CCS Syngas + CCS Heating':                 ('ammonia production, liquid, fossil ammonia from natural gas, syngas w/ CCS, heating w/ CCS', 'ammonia, anhydrous, liquid'),
+    'Green H2':                                               ('ammonia production, liquid, green ammonia from wind-based hydrogen', 'ammonia, anhydrous, liquid'),
+    'Biomethane':                                             ('ammonia production, liquid, bio-ammonia from biomethane', 'ammonia, anhydrous, liquid'),
+    'Biomethane + CCS Syngas':                                ('ammonia production, liquid, bio-ammonia from biomethane, syngas w/ CCS', 'ammonia, anhydrous, liquid'),
+    'Biomethane + CCS Syngas + CCS Heating':                  ('ammonia production, liquid, bio-ammonia from biomethane, syngas w/ CCS, heating w/ CCS', 'ammonia, anhydrous, liquid'),
+    'Biomethane + CCS Upgrading':                             ('ammonia production, liquid, bio-ammonia from biomethane w/ CCS', 'ammonia, anhydrous, liquid'),
+    'Biomethane + CCS Upgrading + CCS Syngas':                ('ammonia production, liquid, bio-ammonia from biomethane w/ CCS, syngas w/ CCS', 'ammonia, anhydrous, liquid'),
+    'Biomethane + CCS Upgrading + CCS Syngas + CCS Heating':  ('ammonia production, liquid, bio-ammonia from biomethane w/ CCS, syngas w/ CCS, heating w/ CCS', 'ammonia, anhydrous, liquid'),
+}
+
+# Fossil scenario of every biomethane scenario, blended in the natural gas-biomethane blending strategy
+BIOMETHANE_FOSSIL_MATCH = {
+    'Biomethane': 'Natural gas',
+    'Biomethane + CCS Syngas': 'Natural gas + CCS Syngas',
+    'Biomethane + CCS Syngas + CCS Heating': 'Natural gas + CCS Syngas + CCS Heating',
+    'Biomethane + CCS Upgrading': 'Natural gas',
+    'Biomethane + CCS Upgrading + CCS Syngas': 'Natural gas + CCS Syngas',
+    'Biomethane + CCS Upgrading + CCS Syngas + CCS Heating': 'Natural gas + CCS Syngas + CCS Heating'
+}
+
+# Datasets (name, reference product, location) replicated to every country
+DS_TO_REGIONALIZE = [
+    ('anaerobic digestion of animal manure, with biogenic carbon uptake', 'biogas', 'RER'),
+    ('anaerobic digestion of agricultural residues, with biogenic carbon uptake', 'biogas', 'RER'),
+    ('anaerobic digestion of sequential crop, with biogenic carbon uptake', 'biogas', 'RER'),
+    ('market for biogas, sustainable feedstocks', 'biogas', 'RER'),
+    ('biogas upgrading to biomethane, water scrubbing', 'biomethane, 24 bar', 'RER'),
+    ('biogas upgrading to biomethane, water scrubbing w/ CCS', 'biomethane, 24 bar', 'RER'),
+    ('biogas upgrading to biomethane, chemical scrubbing', 'biomethane, 24 bar', 'RER'),
+    ('biogas upgrading to biomethane, chemical scrubbing w/ CCS', 'biomethane, 24 bar', 'RER'),
+    ('biogas upgrading to biomethane, membrane', 'biomethane, 24 bar', 'RER'),
+    ('biogas upgrading to biomethane, membrane w/ CCS', 'biomethane, 24 bar', 'RER'),
+    ('biogas upgrading to biomethane, pressure swing adsorption', 'biomethane, 24 bar', 'RER'),
+    ('biogas upgrading to biomethane, pressure swing adsorption w/ CCS', 'biomethane, 24 bar', 'RER'),
+    ('market for biomethane, 24 bar', 'biomethane, 24 bar', 'RER'),
+    ('market for biomethane, 24 bar w/ CCS', 'biomethane, 24 bar', 'RER'),
+    ('carbon dioxide capture, chemical absorption, with transport and storage, 200 km pipeline sotage 1000m',
+     'carbon dioxide capture, chemical absorption, with transport and storage, 200 km pipeline sotage 1000m', 'RER'),
+    ('heat production, at industrial furnace >100kW, natural gas, heating', 'heat, district or industrial', 'RER'),
+    ('heat production, at industrial furnace >100kW, natural gas, heating w/ CCS', 'heat, district or industrial', 'RER'),
+    ('heat production, at industrial furnace >100kW, biomethane', 'heat, district or industrial', 'RER'),
+    ('heat production, at industrial furnace >100kW, biomethane, heating w/ CCS', 'heat, district or industrial', 'RER'),
+    ('heat production, at industrial furnace >100kW, biomethane w/ CCS', 'heat, district or industrial', 'RER'),
+    ('heat production, at industrial furnace >100kW, biomethane w/ CCS, heating w/ CCS', 'heat, district or industrial', 'RER'),
+    ('ammonia production, liquid, fossil ammonia from natural gas', 'ammonia, anhydrous, liquid', 'RER'),
+    ('ammonia production, liquid, fossil ammonia from natural gas, syngas w/ CCS', 'ammonia, anhydrous, liquid', 'RER'),
+    ('ammonia production, liquid, fossil ammonia from natural gas, syngas w/ CCS, heating w/ CCS', 'ammonia, anhydrous, liquid', 'RER'),
+    ('ammonia production, liquid, bio-ammonia from biomethane', 'ammonia, anhydrous, liquid', 'RER'),
+    ('ammonia production, liquid, bio-ammonia from biomethane, syngas w/ CCS', 'ammonia, anhydrous, liquid', 'RER'),
+    ('ammonia production, liquid, bio-ammonia from biomethane, syngas w/ CCS, heating w/ CCS', 'ammonia, anhydrous, liquid', 'RER'),
+    ('ammonia production, liquid, bio-ammonia from biomethane w/ CCS', 'ammonia, anhydrous, liquid', 'RER'),
+    ('ammonia production, liquid, bio-ammonia from biomethane w/ CCS, syngas w/ CCS', 'ammonia, anhydrous, liquid', 'RER'),
+    ('ammonia production, liquid, bio-ammonia from biomethane w/ CCS, syngas w/ CCS, heating w/ CCS', 'ammonia, anhydrous, liquid', 'RER')
+]
+
+# Feedstock (in the biomethane potential) of the inputs of the country-specific markets for biogas
+FEEDSTOCK_MATCH = {
+    'treatment of biowaste by anaerobic digestion, cut-off with biogenic carbon uptake':              'Biowaste',
+    'treatment of industrial wastewater by anaerobic digestion, cut-off with biogenic carbon uptake': 'Industrial wastewater',
+    'treatment of sewage sludge by anaerobic digestion, cut-off with biogenic carbon uptake':         'Sewage sludge',
+    'anaerobic digestion of animal manure, with biogenic carbon uptake':                              'Animal manure',
+    'anaerobic digestion of agricultural residues, with biogenic carbon uptake':                      'Agricultural residues',
+    'anaerobic digestion of sequential crop, with biogenic carbon uptake':                            'Sequential crops'
+}
+
+# N2O emission factors of the use of ammonia (IPCC Chapter 11), as the share of the nitrogen emitted as N2O-N:
+# mineral fertilizers in dry (0.5%) and wet (1.6%) climates, and ammonia fuel in ships (0.4%)
+N2O_EMISSION_FACTORS = {'Fertilizer low': 0.005,
+                    'Fertilizer high': 0.016,
+                    'Fuel': 0.004}
+AMMONIA_NITROGEN_CONTENT = 0.82  # anhydrous ammonia is 82% nitrogen
+CF_N2O = 273.0                   # kg CO2-eq/kg N2O (GWP 100a)
+
+
+def countries(data_dir=DATA_DIR):
+    """
+    Countries (alpha-2 ISO codes) of the sustainable biomethane potential, in the order of the data file.
+    """
+    columns = pd.read_excel(Path(data_dir) / "sustainable_biomethane_potential_Europe.xlsx",
+                            sheet_name='Biomethane Potential', usecols='A:AE', nrows=0).columns
+    return [c for c in columns if c not in ('Parameter', 'Unit', 'Feedstock', 'Total')]
+
+
+def n2o_use_impacts(ammonia_nitrogen_content=AMMONIA_NITROGEN_CONTENT, cf_n2o=CF_N2O,
+                    n2o_emission_factors=N2O_EMISSION_FACTORS):
+    """
+    Carbon footprint of the N2O emissions of the use of 1 kg of ammonia as {use: kg CO2-eq}.
+    """
+    return {use: ammonia_nitrogen_content * factor * 44/28 * cf_n2o for use, factor in n2o_emission_factors.items()}
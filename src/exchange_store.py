@@ -0,0 +1,457 @@
+"""
+Compact, array-backed storage of a LCI database as an alternative to the wurst format (list of dictionaries)
+
+Exchanges are stored in a table of NumPy arrays (dataset id, flow id, amount, type code). The descriptive fields
+of the exchanges (name, product, unit, location, categories, database and input) are stored once per distinct
+flow, the uncertainty fields in a numeric array, and the remaining fields once per distinct combination,
+with interned strings. Unhashable values (e.g., pedigree dictionaries) are stored once per distinct value.
+
+The datasets of a store behave like wurst datasets: `ds['name']`, `ds['exchanges']`, `exc['amount']`,
+`exc.update({...})`, `ds['exchanges'].append({...})`, etc. read and write the arrays of the store, so that functions written for the wurst
+format (e.g., `link_exchanges_by_code`, `match_parameters`, `modify_exchange_amount_from_df` and
+`relink_exchange_location`) can run on a store. Copying (`copy.deepcopy`) or pickling a dataset of a store
+returns a regular wurst dataset.
+"""
+
+import copy
+import numpy as np
+import sys
+from collections.abc import MutableMapping, MutableSequence, Sequence
+
+
+# Fields of the exchanges stored in the flow table; the other fields (except amount, type and uncertainty) are extra fields
+FLOW_FIELDS = ('name', 'product', 'reference product', 'unit', 'location', 'categories', 'database', 'input')
+# Fields of the exchanges stored in the uncertainty array
+UNCERTAINTY_FIELDS = ('uncertainty type', 'loc', 'scale', 'shape', 'minimum', 'maximum')
+
+
+class _Column:
+    """
+    Column of the exchange table of a store: the rows in use of an array that grows when exchanges are added.
+    """
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, store, owner=None):
+        if store is None:
+            return self
+        return store._columns[self.name][:store._size]
+
+    def __set__(self, store, value):
+        store._columns[self.name] = value
+        store._size = len(value)
+
+
+class ExchangeStore:
+    """
+    LCI database stored in arrays.
+
+    Attributes:
+        - datasets (list): Dataset records (see `DatasetRecord`), in the order of the original database.
+        - exchange_dataset (numpy array): Dataset id of every exchange (-1 for removed exchanges). The exchanges
+                                          of the original database are sorted by dataset; added exchanges are
+                                          at the end.
+        - exchange_flow (numpy array): Flow id of every exchange (position in `flows`).
+        - exchange_extra (numpy array): Extra fields id of every exchange (position in `extras`).
+        - exchange_type (numpy array): Type code of every exchange (position in `types`).
+        - amounts (numpy array): Amount of every exchange.
+        - uncertainty (numpy array): Uncertainty fields of every exchange (exchanges x `UNCERTAINTY_FIELDS`);
+                                     NaN if the exchange does not have the field.
+        - flows (list): Distinct descriptive fields of the exchanges, as tuples of (field, value).
+        - extras (list): Distinct extra fields of the exchanges, as tuples of (field, value).
+        - types (list): Exchange types (e.g., 'production', 'technosphere', 'biosphere').
+    """
+    exchange_dataset = _Column()
+    exchange_flow = _Column()
+    exchange_extra = _Column()
+    exchange_type = _Column()
+    amounts = _Column()
+    uncertainty = _Column()
+
+    def __init__(self):
+        self.datasets = []
+        self.flows, self._flow_ids = [], {}
+        self.extras, self._extra_ids = [()], {(): 0}
+        self.types, self._type_ids = [], {}
+        self._columns = {}
+        self.exchange_dataset = np.zeros(0, dtype=np.int32)
+        self.exchange_flow = np.zeros(0, dtype=np.int32)
+        self.exchange_extra = np.zeros(0, dtype=np.int32)
+        self.exchange_type = np.zeros(0, dtype=np.int8)
+        self.amounts = np.zeros(0)
+        self.uncertainty = np.zeros((0, len(UNCERTAINTY_FIELDS)))
+        self._bounds = np.zeros(1, dtype=np.int64)
+        # Rows of the datasets whose exchanges were added, removed or replaced (the rows of the other datasets
+        # are the ranges of `_bounds`)
+        self._rows = {}
+
+    @classmethod
+    def from_wurst(cls, db):
+        """
+        Create a store from a list of datasets in wurst format.
+        """
+        store = cls()
+        dataset_ids, flow_ids, extra_ids, type_ids, amounts, uncertainty = [], [], [], [], [], []
+        for i, ds in enumerate(db):
+            store.datasets.append(DatasetRecord(store, i, {k: _intern_value(v) for k, v in ds.items()
+                                                           if k != 'exchanges'}))
+            for exc in ds.get('exchanges', []):
+                flow, extra = _split_exchange(exc)
+                dataset_ids.append(i)
+                flow_ids.append(_intern(store.flows, store._flow_ids, flow))
+                extra_ids.append(_intern(store.extras, store._extra_ids, extra))
+                type_ids.append(store.type_code(exc['type']))
+                amounts.append(exc['amount'])
+                uncertainty.append([exc.get(field, np.nan) for field in UNCERTAINTY_FIELDS])
+
+        store.exchange_dataset = np.array(dataset_ids, dtype=np.int32)
+        store.exchange_flow = np.array(flow_ids, dtype=np.int32)
+        store.exchange_extra = np.array(extra_ids, dtype=np.int32)
+        store.exchange_type = np.array(type_ids, dtype=np.int8)
+        store.amounts = np.array(amounts, dtype=float)
+        store.uncertainty = np.array(uncertainty, dtype=float).reshape(-1, len(UNCERTAINTY_FIELDS))
+        store._bounds = np.searchsorted(store.exchange_dataset, np.arange(len(store.datasets) + 1))
+        return store
+
+    def to_wurst(self, positions=None):
+        """
+        Convert the store (or the datasets at `positions`) to a list of datasets in wurst format.
+        """
+        positions = range(len(self.datasets)) if positions is None else positions
+        return [self.datasets[i].to_wurst() for i in positions]
+
+    def type_code(self, exchange_type):
+        """
+        Returns the code of an exchange type, adding the type if needed.
+        """
+        return _intern(self.types, self._type_ids, sys.intern(exchange_type))
+
+    def exchange_rows(self, i):
+        """
+        Returns the rows of the exchange table with the exchanges of dataset `i`, in order.
+        """
+        rows = self._rows.get(i)
+        if rows is None:
+            return range(int(self._bounds[i]), int(self._bounds[i + 1]))
+        return rows
+
+    def insert_exchange(self, i, index, exc):
+        """
+        Insert an exchange (in wurst format) in the exchanges of dataset `i`, before position `index`.
+        The exchange is added at the end of the exchange table, so that the rows of the other exchanges do not change.
+        """
+        exc = dict(exc)
+        if self._size == len(self._columns['amounts']):
+            capacity = max(2 * self._size, 16)
+            for name, column in self._columns.items():
+                grown = np.zeros((capacity,) + column.shape[1:], dtype=column.dtype)
+                grown[:self._size] = column[:self._size]
+                self._columns[name] = grown
+        row = self._size
+        self._size += 1
+
+        flow, extra = _split_exchange(exc)
+        self.exchange_dataset[row] = i
+        self.exchange_flow[row] = _intern(self.flows, self._flow_ids, flow)
+        self.exchange_extra[row] = _intern(self.extras, self._extra_ids, extra)
+        self.exchange_type[row] = self.type_code(exc['type'])
+        self.amounts[row] = exc['amount']
+        self.uncertainty[row] = [exc.get(field, np.nan) for field in UNCERTAINTY_FIELDS]
+
+        rows = list(self.exchange_rows(i))
+        rows.insert(index, row)
+        self._rows[i] = rows
+        return row
+
+    def remove_exchange(self, i, index):
+        """
+        Remove the exchange at position `index` in the exchanges of dataset `i`. Its row is kept in the exchange
+        table with the dataset id -1.
+        """
+        rows = list(self.exchange_rows(i))
+        self.exchange_dataset[rows.pop(index)] = -1
+        self._rows[i] = rows
+
+    def set_exchanges(self, i, exchanges):
+        """
+        Replace the exchanges of dataset `i` by exchanges in wurst format.
+        """
+        exchanges = [dict(exc) for exc in exchanges]
+        for row in self.exchange_rows(i):
+            self.exchange_dataset[row] = -1
+        self._rows[i] = []
+        for exc in exchanges:
+            self.insert_exchange(i, len(self._rows[i]), exc)
+
+    def exchange(self, row):
+        """
+        Returns the exchange at `row` of the exchange table as a dictionary in wurst format.
+        """
+        exc = dict(self.flows[self.exchange_flow[row]])
+        exc['amount'] = float(self.amounts[row])
+        exc['type'] = self.types[self.exchange_type[row]]
+        for field, value in zip(UNCERTAINTY_FIELDS, self.uncertainty[row].tolist()):
+            if value == value:
+                exc[field] = int(value) if field == 'uncertainty type' else value
+        exc.update((field, _copy_value(value)) for field, value in self.extras[self.exchange_extra[row]])
+        return exc
+
+    def set_exchange_fields(self, row, fields):
+        """
+        Set fields of the exchange at `row` of the exchange table.
+        """
+        fields = dict(fields)
+        if 'amount' in fields:
+            self.amounts[row] = fields.pop('amount')
+        if 'type' in fields:
+            self.exchange_type[row] = self.type_code(fields.pop('type'))
+        for j, field in enumerate(UNCERTAINTY_FIELDS):
+            if field in fields:
+                self.uncertainty[row, j] = fields.pop(field)
+        if fields:
+            exc = self.exchange(row)
+            exc.update(fields)
+            flow, extra = _split_exchange(exc)
+            self.exchange_flow[row] = _intern(self.flows, self._flow_ids, flow)
+            self.exchange_extra[row] = _intern(self.extras, self._extra_ids, extra)
+
+    def __len__(self):
+        return len(self.datasets)
+
+    def __getitem__(self, i):
+        return self.datasets[i]
+
+    def __iter__(self):
+        return iter(self.datasets)
+
+    def __add__(self, other):
+        return list(self.datasets) + list(other)
+
+    def __radd__(self, other):
+        return list(other) + list(self.datasets)
+
+
+class DatasetRecord(MutableMapping):
+    """
+    Dataset of an `ExchangeStore`, with the same keys as a wurst dataset.
+    `record['exchanges']` returns a list view (see `ExchangeList`) on the exchange table of the store, and
+    `record['exchanges'] = [...]` replaces the exchanges of the dataset in the store.
+    """
+    __slots__ = ('store', 'position', 'fields')
+
+    def __init__(self, store, position, fields):
+        self.store = store
+        self.position = position
+        self.fields = fields
+
+    def to_wurst(self):
+        ds = dict(self.fields)
+        ds['exchanges'] = [self.store.exchange(row) for row in self.store.exchange_rows(self.position)]
+        return ds
+
+    def __getitem__(self, key):
+        if key == 'exchanges':
+            return ExchangeList(self.store, self.position)
+        return self.fields[key]
+
+    def __setitem__(self, key, value):
+        if key == 'exchanges':
+            self.store.set_exchanges(self.position, value)
+            return
+        self.fields[key] = _intern_value(value)
+
+    def __delitem__(self, key):
+        del self.fields[key]
+
+    def __iter__(self):
+        yield from self.fields
+        yield 'exchanges'
+
+    def __len__(self):
+        return len(self.fields) + 1
+
+    def __reduce__(self):
+        return dict, (self.to_wurst(),)
+
+    def __repr__(self):
+        return f"DatasetRecord({self.fields.get('name')!r}, {self.fields.get('location')!r})"
+
+
+class ExchangeList(MutableSequence):
+    """
+    Exchanges of a dataset of an `ExchangeStore`, as a list of `ExchangeView`. Adding, removing or replacing
+    exchanges (`append`, `remove`, `del`, `exchanges[i] = {...}`, ...) changes the exchanges of the dataset in the store.
+    """
+    __slots__ = ('store', 'position')
+
+    def __init__(self, store, position):
+        self.store = store
+        self.position = position
+
+    def __getitem__(self, index):
+        rows = self.store.exchange_rows(self.position)
+        if isinstance(index, slice):
+            return [ExchangeView(self.store, row) for row in rows[index]]
+        return ExchangeView(self.store, rows[index])
+
+    def __setitem__(self, index, value):
+        if isinstance(index, slice):
+            exchanges = [dict(exc) for exc in self]
+            exchanges[index] = [dict(exc) for exc in value]
+            self.store.set_exchanges(self.position, exchanges)
+            return
+        index = range(len(self))[index]
+        exc = dict(value)
+        self.store.remove_exchange(self.position, index)
+        self.store.insert_exchange(self.position, index, exc)
+
+    def __delitem__(self, index):
+        indices = range(len(self))[index]
+        for i in sorted(indices, reverse=True) if isinstance(index, slice) else [indices]:
+            self.store.remove_exchange(self.position, i)
+
+    def insert(self, index, value):
+        self.store.insert_exchange(self.position, index, value)
+
+    def __iter__(self):
+        return (ExchangeView(self.store, row) for row in self.store.exchange_rows(self.position))
+
+    def __len__(self):
+        return len(self.store.exchange_rows(self.position))
+
+    def __eq__(self, other):
+        if not isinstance(other, Sequence):
+            return NotImplemented
+        return list(self) == list(other)
+
+    __hash__ = None
+
+    def __reduce__(self):
+        return list, ([self.store.exchange(row) for row in self.store.exchange_rows(self.position)],)
+
+    def __repr__(self):
+        return f"ExchangeList({[self.store.exchange(row) for row in self.store.exchange_rows(self.position)]!r})"
+
+
+class ExchangeView(MutableMapping):
+    """
+    Exchange of an `ExchangeStore`, with the same keys as a wurst exchange. Changes are written to the store.
+    """
+    __slots__ = ('store', 'row')
+
+    def __init__(self, store, row):
+        self.store = store
+        self.row = row
+
+    def __getitem__(self, key):
+        store = self.store
+        if key == 'amount':
+            return float(store.amounts[self.row])
+        if key == 'type':
+            return store.types[store.exchange_type[self.row]]
+        if key in UNCERTAINTY_FIELDS:
+            value = store.uncertainty[self.row, UNCERTAINTY_FIELDS.index(key)]
+            if value == value:
+                return int(value) if key == 'uncertainty type' else float(value)
+            raise KeyError(key)
+        for fields in (store.flows[store.exchange_flow[self.row]], store.extras[store.exchange_extra[self.row]]):
+            for field, value in fields:
+                if field == key:
+                    return _copy_value(value)
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        self.store.set_exchange_fields(self.row, {key: value})
+
+    def update(self, other=(), **kwargs):
+        self.store.set_exchange_fields(self.row, dict(other, **kwargs))
+
+    def __delitem__(self, key):
+        if key in UNCERTAINTY_FIELDS:
+            self.store.uncertainty[self.row, UNCERTAINTY_FIELDS.index(key)] = np.nan
+            return
+        exc = self.store.exchange(self.row)
+        del exc[key]
+        flow, extra = _split_exchange(exc)
+        self.store.exchange_flow[self.row] = _intern(self.store.flows, self.store._flow_ids, flow)
+        self.store.exchange_extra[self.row] = _intern(self.store.extras, self.store._extra_ids, extra)
+
+    def __iter__(self):
+        return iter(self.store.exchange(self.row))
+
+    def __len__(self):
+        return len(self.store.exchange(self.row))
+
+    def __reduce__(self):
+        return dict, (self.store.exchange(self.row),)
+
+    def __repr__(self):
+        return f"ExchangeView({self.store.exchange(self.row)!r})"
+
+
+def _split_exchange(exc):
+    """
+    Split an exchange into its flow fields and extra fields (tuples of (field, value) with interned values).
+    Amount, type and uncertainty fields are not included.
+    """
+    flow = tuple((k, _intern_value(v)) for k, v in exc.items() if k in FLOW_FIELDS)
+    extra = tuple((k, _intern_value(v)) for k, v in exc.items()
+                  if k not in FLOW_FIELDS and k not in UNCERTAINTY_FIELDS and k not in ('amount', 'type'))
+    return flow, extra
+
+
+def _intern(table, ids, value):
+    """
+    Returns the position of `value` in `table`, adding it if needed. Unhashable values (e.g., extra fields with
+    pedigree dictionaries) are identified by a key that keeps the type of every nested container.
+    """
+    try:
+        key = value
+        position = ids.get(key)
+    except TypeError:
+        key = (_UNHASHABLE, _unhashable_key(value))
+        position = ids.get(key)
+    if position is None:
+        position = ids[key] = len(table)
+        table.append(value)
+    return position
+
+
+# Marker of the keys of unhashable values in the ids of `_intern`
+_UNHASHABLE = '__unhashable__'
+
+
+def _unhashable_key(value):
+    """
+    Hashable key of a value with nested dictionaries, lists or sets. Each container is tagged with its type, so that a
+    tuple and a list, or dictionaries with keys 1 and '1', do not get the same key.
+    """
+    if isinstance(value, dict):
+        items = ((_unhashable_key(k), _unhashable_key(v)) for k, v in value.items())
+        return type(value).__name__, tuple(sorted(items, key=repr))
+    if isinstance(value, (set, frozenset)):
+        return type(value).__name__, tuple(sorted((_unhashable_key(v) for v in value), key=repr))
+    if isinstance(value, (list, tuple)):
+        return type(value).__name__, tuple(_unhashable_key(v) for v in value)
+    try:
+        hash(value)
+    except TypeError:
+        return type(value).__name__, repr(value)
+    return type(value).__name__, value
+
+
+def _copy_value(value):
+    """
+    Copy of a stored value that can be modified (dictionaries and lists are shared by all the exchanges with the value).
+    """
+    if isinstance(value, (dict, list)):
+        return copy.deepcopy(value)
+    return value
+
+
+def _intern_value(value):
+    if isinstance(value, str):
+        return sys.intern(value)
+    if isinstance(value, tuple):
+        return tuple(_intern_value(v) for v in value)
+    return value
@@ -0,0 +1,200 @@
+"""
+Global sensitivity analysis (Sobol indices and Morris elementary effects) of LCA scores with respect to
+the values of some elements of the technosphere and biosphere matrices
+
+The designs are arrays with one row per model run and one column per parameter. The runs only change the values
+of the parameters, so they are evaluated in batches as scenarios of a single factorization of the technosphere
+matrix (see `lca_matrices.scenario_scores`), in-process or in a pool of worker processes.
+"""
+
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from scipy.stats import qmc
+
+from . import lca_matrices
+
+
+def saltelli_design(bounds, n, seed=None):
+    """
+    Saltelli design for the estimation of first-order and total Sobol indices.
+
+    Two (scrambled Sobol sequence) sample matrices A and B of `n` rows are generated; the design stacks A, B and,
+    for each parameter i, the matrix AB_i (A with the column i of B). Preferably, `n` is a power of 2.
+
+    Parameters:
+    - bounds (numpy array): Lower and upper bound of each parameter (parameters x 2).
+    - n (int): Number of base samples.
+    - seed (int): Seed of the random numbers. Defaults to None.
+
+    Returns:
+    - design (numpy array): Parameter values (n * (parameters + 2) x parameters).
+    """
+    bounds = np.asarray(bounds, dtype=float)
+    k = len(bounds)
+    samples = qmc.Sobol(d=2 * k, scramble=True, seed=seed).random(n)
+    A, B = samples[:, :k], samples[:, k:]
+
+    AB = np.repeat(A[None, :, :], k, axis=0)
+    AB[np.arange(k), :, np.arange(k)] = B.T
+    design = np.vstack([A, B, AB.reshape(k * n, k)])
+
+    return bounds[:, 0] + design * (bounds[:, 1] - bounds[:, 0])
+
+
+def sobol_indices(scores, n):
+    """
+    First-order (Saltelli et al., 2010) and total (Jansen, 1999) Sobol indices from the scores of a Saltelli design.
+
+    Parameters:
+    - scores (numpy array): Scores of the runs of the design (runs x outputs, e.g., impact categories).
+    - n (int): Number of base samples of the design.
+
+    Returns:
+    - indices (dict): 'first_order' and 'total' indices (parameters x outputs).
+    """
+    scores = np.asarray(scores, dtype=float).reshape(scores.shape[0], -1)
+    k = scores.shape[0] // n - 2
+    f_A, f_B = scores[:n], scores[n:2 * n]
+    f_AB = scores[2 * n:].reshape(k, n, -1)
+    variance = np.var(np.vstack([f_A, f_B]), axis=0)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        first_order = np.mean(f_B[None] * (f_AB - f_A[None]), axis=1) / variance
+        total = 0.5 * np.mean((f_A[None] - f_AB) ** 2, axis=1) / variance
+
+    return {'first_order': first_order, 'total': total}
+
+
+def morris_design(bounds, trajectories, levels=4, seed=None):
+    """
+    Morris design: `trajectories` one-at-a-time trajectories on a grid of `levels` levels, where each parameter
+    is changed once by delta = levels / (2 * (levels - 1)) (in the unit range), in a random order.
+
+    Parameters:
+    - bounds (numpy array): Lower and upper bound of each parameter (parameters x 2).
+    - trajectories (int): Number of trajectories.
+    - levels (int): Number of levels of the grid (even). Defaults to 4.
+    - seed (int): Seed of the random numbers. Defaults to None.
+
+    Returns:
+    - design (numpy array): Parameter values (trajectories * (parameters + 1) x parameters).
+    """
+    bounds = np.asarray(bounds, dtype=float)
+    k = len(bounds)
+    rng = np.random.default_rng(seed)
+    delta = levels / (2 * (levels - 1))
+
+    # Start points on the levels from which the step delta stays in [0, 1], and random directions
+    start_levels = np.arange(levels // 2) / (levels - 1)
+    design = np.zeros((trajectories, k + 1, k))
+    for t in range(trajectories):
+        start = rng.choice(start_levels, k)
+        direction = rng.choice([-1, 1], k)
+        start = np.where(direction < 0, start + delta, start)
+        design[t, 0] = start
+        for step, i in enumerate(rng.permutation(k)):
+            design[t, step + 1] = design[t, step]
+            design[t, step + 1, i] += direction[i] * delta
+
+    design = design.reshape(trajectories * (k + 1), k)
+    return bounds[:, 0] + design * (bounds[:, 1] - bounds[:, 0])
+
+
+def morris_indices(design, scores, bounds):
+    """
+    Morris indices from the scores of a Morris design (see `morris_design`). The elementary effects are
+    computed with the parameter steps in the unit range.
+
+    Parameters:
+    - design (numpy array): Parameter values of the design (runs x parameters).
+    - scores (numpy array): Scores of the runs of the design (runs x outputs).
+    - bounds (numpy array): Lower and upper bound of each parameter (parameters x 2).
+
+    Returns:
+    - indices (dict): 'mu', 'mu_star' (mean of the absolute elementary effects) and 'sigma' (parameters x outputs).
+    """
+    bounds = np.asarray(bounds, dtype=float)
+    k = len(bounds)
+    scores = np.asarray(scores, dtype=float).reshape(scores.shape[0], -1)
+    unit_design = (np.asarray(design, dtype=float) - bounds[:, 0]) / (bounds[:, 1] - bounds[:, 0])
+
+    steps = np.diff(unit_design.reshape(-1, k + 1, k), axis=1)  # trajectories x k x parameters
+    score_steps = np.diff(scores.reshape(-1, k + 1, scores.shape[1]), axis=1)  # trajectories x k x outputs
+    parameter = np.argmax(np.abs(steps), axis=2)
+    step = np.take_along_axis(steps, parameter[:, :, None], axis=2)
+
+    effects = np.zeros((steps.shape[0], k, scores.shape[1]))
+    np.put_along_axis(effects, parameter[:, :, None], score_steps / step, axis=1)
+
+    return {'mu': effects.mean(axis=0),
+            'mu_star': np.abs(effects).mean(axis=0),
+            'sigma': effects.std(axis=0, ddof=1) if len(effects) > 1 else np.zeros(effects.shape[1:])}
+
+
+def evaluate_design(technosphere_matrix, biosphere_matrix, characterization, demand, parameters, design,
+                    batch_size=1000, processes=None, max_rank=200):
+    """
+    Scores of every run of a design, where each parameter is the value of an element of the technosphere or
+    biosphere matrix.
+
+    Parameters:
+    - technosphere_matrix (scipy sparse matrix): Technosphere matrix (products x activities).
+    - biosphere_matrix (scipy sparse matrix): Biosphere matrix (elementary flows x activities).
+    - characterization (numpy array): Characterization factors (impact categories x elementary flows).
+    - demand (numpy array): Final demand (products).
+    - parameters (list): Matrix elements of the parameters as ('technosphere' or 'biosphere', row, col). The
+                         values of the design are the values of the elements in the matrix (technosphere inputs
+                         are negative).
+    - design (numpy array): Parameter values (runs x parameters).
+    - batch_size (int): Number of runs evaluated together. Defaults to 1000.
+    - processes (int): Number of worker processes. Defaults to None (serial run in this process).
+    - max_rank (int): See `lca_matrices.scenario_scores`. Defaults to 200.
+
+    Returns:
+    - scores (numpy array): Scores (runs x impact categories).
+    """
+    design = np.asarray(design, dtype=float)
+    batches = [design[start:start + batch_size] for start in range(0, len(design), batch_size)]
+    initargs = (technosphere_matrix, biosphere_matrix, characterization, demand, parameters, max_rank)
+
+    if processes is None:
+        _init_design_worker(*initargs)
+        batch_scores = [_evaluate_batch_worker(batch) for batch in batches]
+    else:
+        with ProcessPoolExecutor(max_workers=processes,
+                                 initializer=_init_design_worker,
+                                 initargs=initargs) as executor:
+            batch_scores = list(executor.map(_evaluate_batch_worker, batches))
+
+    return np.vstack(batch_scores)
+
+
+# Data shared with the worker processes of `evaluate_design`
+_worker_data = {}
+
+
+def _init_design_worker(technosphere_matrix, biosphere_matrix, characterization, demand, parameters, max_rank):
+    _worker_data.update({'technosphere_matrix': technosphere_matrix,
+                         'biosphere_matrix': biosphere_matrix,
+                         'characterization': characterization,
+                         'demand': demand,
+                         'parameters': parameters,
+                         'max_rank': max_rank,
+                         'lu': lca_matrices.factorize(technosphere_matrix)})
+
+
+def _evaluate_batch_worker(batch):
+    data = _worker_data
+    changes = {}
+    for matrix in ('technosphere', 'biosphere'):
+        positions = [j for j, parameter in enumerate(data['parameters']) if parameter[0] == matrix]
+        if positions:
+            changes[matrix] = ([data['parameters'][j][1] for j in positions],
+                               [data['parameters'][j][2] for j in positions],
+                               batch[:, positions].T)
+
+    return lca_matrices.scenario_scores(data['technosphere_matrix'], data['biosphere_matrix'],
+                                        data['characterization'], data['demand'],
+                                        technosphere_changes=changes.get('technosphere'),
+                                        biosphere_changes=changes.get('biosphere'),
+                                        lu=data['lu'], max_rank=data['max_rank'])
@@ -5,9 +5,20 @@ from an Excel file
 
 import numpy as np
 import pandas as pd
+import brightway2 as bw
 import wurst
+import wurst.errors
+from wurst.brightway.write_database import WurstImporter
 from constructive_geometries import *
+from functools import lru_cache
 import copy
+import hashlib
+import json
+import os
+import pickle
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+import uuid
 
 
 def correct_product_in_exchanges(db):
@@ -31,39 +42,74 @@ def link_exchanges_by_code(db, external_db, biosphere_db):
     '''
     This function links in place technosphere exchanges within the database and/or to an external database
     and biosphere exchanges with the biosphere database (only unlinked exchanges)
+
+    Suppliers and elementary flows are looked up in hash indexes built once per call, keyed on
+    (name, reference product, location) and (name, unit, categories) respectively.
+    All exchanges that can be resolved are linked; the ones that cannot be resolved
+    (no match or multiple matching suppliers) are reported together in a single error.
     
-    Returns a dictionary with the linked database
+    Arguments:
+        - db: list of dictionaries; each dictionary is a dataset/activity
+        - external_db: list of datasets (e.g., ecoinvent in wurst format) used as additional suppliers
+        - biosphere_db: list of dictionaries with the elementary flows of the biosphere database
     '''   
     technosphere = lambda x: x["type"] == "technosphere"
     biosphere = lambda x: x["type"] == "biosphere"
-    
+
+    technosphere_index = build_technosphere_index(db + external_db)
+    biosphere_index = build_biosphere_index(biosphere_db)
+
+    unresolved = []
     for ds in db:
         
         for exc in filter(technosphere, ds["exchanges"]):
             if 'input' not in exc:
-                try:
-                    exc_lci = wurst.get_one(db + external_db,
-                                            wurst.equals("name", exc['name']),
-                                            wurst.equals("reference product", exc['product']),
-                                            wurst.equals("location", exc['location'])
-                                        )
-                    exc.update({'input': (exc_lci['database'],
-                                        exc_lci['code'])})
-                except Exception:
-                    print(exc['name'], exc['product'], exc['location'])
-                    raise
+                suppliers = technosphere_index.get((exc['name'], exc['product'], exc['location']), [])
+                if len(suppliers) == 1:
+                    exc.update({'input': suppliers[0]})
+                else:
+                    unresolved.append(('technosphere', exc['name'], exc['product'], exc['location'], len(suppliers)))
             
         for exc in filter(biosphere, ds["exchanges"]):
             if 'input' not in exc:
-                try:
-                    ef_code = [ef['code'] for ef in biosphere_db if ef['name'] == exc['name'] and 
-                                                                    ef['unit'] == exc['unit'] and 
-                                                                    ef['categories'] == exc['categories']][0]
+                ef_code = biosphere_index.get((exc['name'], exc['unit'], tuple(exc['categories'])))
+                if ef_code is not None:
                     exc.update({'input': ('biosphere3',
-                                          ef_code)})   
-                except Exception:
-                    print(exc['name'], exc['unit'], exc['categories'])
-                    raise
+                                          ef_code)})
+                else:
+                    unresolved.append(('biosphere', exc['name'], exc['unit'], tuple(exc['categories']), 0))
+
+    if unresolved:
+        # (name, product, location) of technosphere exchanges and (name, unit, categories) of biosphere exchanges
+        details = "\n".join(f"  {exc_type} {tuple(fields)}: {matches} matches" for exc_type, *fields, matches in unresolved)
+        raise ValueError(f"{len(unresolved)} exchanges could not be linked (no match or multiple matches):\n{details}")
+
+
+def build_technosphere_index(datasets):
+    '''
+    Index datasets by (name, reference product, location).
+
+    Returns a dictionary with the (database, code) of every dataset matching each key.
+    More than one entry for a key means that the supplier is ambiguous.
+    '''
+    index = {}
+    for ds in datasets:
+        key = (ds['name'], ds['reference product'], ds['location'])
+        index.setdefault(key, []).append((ds['database'], ds['code']))
+    return index
+
+
+def build_biosphere_index(biosphere_db):
+    '''
+    Index elementary flows by (name, unit, categories).
+
+    Returns a dictionary with the code of the elementary flow for each key. If several flows
+    share a key, the first one is kept.
+    '''
+    index = {}
+    for ef in biosphere_db:
+        index.setdefault((ef['name'], ef['unit'], tuple(ef['categories'])), ef['code'])
+    return index
 
 
 def create_dataset_from_df(inventories_df):
@@ -71,6 +117,9 @@ def create_dataset_from_df(inventories_df):
     This function converts datasets contained in a dataframe into a list of dictionaries as required by BW2.
     Technosphere and biosphere exchanges are unlinked (by code).
 
+    The wide sheet is melted once into a long table of non-zero (exchange, dataset) cells, and the
+    dictionaries are built from NumPy arrays instead of scalar lookups in the dataframe.
+
     Arguments:
         - inventories_df: Dataframe with the inventories; rows are exchanges (production/technosphere/biosphere) and
                         columns are name, reference product, database, categories, location, type, and unit followed by
@@ -78,58 +127,71 @@ def create_dataset_from_df(inventories_df):
     """
     COL_START = 7 # inventory data start at column 7 in the dataframe
     NUMBER_ACTV = len(inventories_df.columns) - COL_START - 1 # number of datasets (rest 1 to substract the 'comment' column)
-    
-    inventories = []
-    for i in range(NUMBER_ACTV):
-        col_no = i + COL_START
-        id_actv = inventories_df.columns[col_no]
-        inv_actv = inventories_df.iloc[:, np.r_[0:COL_START, col_no]].copy()
 
+    # Exchange attributes (one entry per row)
+    names = inventories_df['name'].tolist()
+    products = inventories_df['reference product'].tolist()
+    databases = inventories_df['database'].tolist()
+    locations = inventories_df['location'].tolist()
+    types = inventories_df['type'].tolist()
+    units = inventories_df['unit'].tolist()
+    # Format of categories string needs to be changed (only for biosphere exchanges):
+    categories = [tuple(cat.split('::')) if exc_type == 'biosphere' and isinstance(cat, str) else cat
+                  for cat, exc_type in zip(inventories_df['categories'].tolist(), types)]
+
+    # Long table of non-zero cells ordered by dataset, then by row
+    id_actvs = inventories_df.columns[COL_START:COL_START + NUMBER_ACTV]
+    values = inventories_df.iloc[:, COL_START:COL_START + NUMBER_ACTV].to_numpy().T
+    actv_idx, row_idx = np.nonzero(values != 0)
+    amounts = values[actv_idx, row_idx]
+    bounds = np.searchsorted(actv_idx, np.arange(NUMBER_ACTV + 1)).tolist()
+    row_idx = row_idx.tolist()
+
+    inventories = []
+    for i, id_actv in enumerate(id_actvs):
+        actv_dict = None
         exchanges = []
-        for exc in list(inv_actv.index):
-            if inv_actv.iloc[exc][id_actv] == 0:
-                pass
-            else:
-                if inv_actv.iloc[exc]['type'] == 'production':
-                    name_actv = f"{inv_actv.iloc[exc]['name']}, {id_actv}"
-                    actv_dict = {'name': name_actv,
-                                 'location': inv_actv.iloc[exc]['location'],
-                                 'reference product': inv_actv.iloc[exc]['reference product'],
-                                 'production amount': inv_actv.iloc[exc][id_actv],
-                                 'unit': inv_actv.iloc[exc]['unit'],
-                                 'database': inv_actv.iloc[exc]['database'],
-                                 'code': wurst.filesystem.get_uuid()
-                                 }
-                    exchanges.append({'name': name_actv,
-                                      'reference product': inv_actv.iloc[exc]['reference product'],
-                                      'amount': inv_actv.iloc[exc][id_actv],
-                                      'unit': inv_actv.iloc[exc]['unit'],
-                                      'database': inv_actv.iloc[exc]['database'],
-                                      'location': inv_actv.iloc[exc]['location'],
-                                      'type': inv_actv.iloc[exc]['type']
-                                      })                    
-                    
-                elif inv_actv.iloc[exc]['type'] == 'technosphere':
-                    exchanges.append({'name': inv_actv.iloc[exc]['name'],
-                                      'reference product': inv_actv.iloc[exc]['reference product'],
-                                      'amount': inv_actv.iloc[exc][id_actv],
-                                      'unit': inv_actv.iloc[exc]['unit'],
-                                      'database': inv_actv.iloc[exc]['database'],
-                                      'location': inv_actv.iloc[exc]['location'],
-                                      'type': inv_actv.iloc[exc]['type']
-                                      })
-                    
-                elif inv_actv.iloc[exc]['type'] == 'biosphere':
-                    # Format of categories string needs to be changed:
-                    categories = inv_actv.iloc[exc]['categories']
-                    categories = tuple(categories.split('::'))
-                    exchanges.append({'name': inv_actv.iloc[exc]['name'],
-                                      'amount': inv_actv.iloc[exc][id_actv],
-                                      'unit': inv_actv.iloc[exc]['unit'],
-                                      'categories': categories,
-                                      'database': inv_actv.iloc[exc]['database'],
-                                      'type': inv_actv.iloc[exc]['type']
-                                      })                    
+        for exc, amount in zip(row_idx[bounds[i]:bounds[i + 1]], amounts[bounds[i]:bounds[i + 1]]):
+            if types[exc] == 'production':
+                name_actv = f"{names[exc]}, {id_actv}"
+                actv_dict = {'name': name_actv,
+                             'location': locations[exc],
+                             'reference product': products[exc],
+                             'production amount': amount,
+                             'unit': units[exc],
+                             'database': databases[exc],
+                             'code': wurst.filesystem.get_uuid()
+                             }
+                exchanges.append({'name': name_actv,
+                                  'reference product': products[exc],
+                                  'amount': amount,
+                                  'unit': units[exc],
+                                  'database': databases[exc],
+                                  'location': locations[exc],
+                                  'type': types[exc]
+                                  })
+
+            elif types[exc] == 'technosphere':
+                exchanges.append({'name': names[exc],
+                                  'reference product': products[exc],
+                                  'amount': amount,
+                                  'unit': units[exc],
+                                  'database': databases[exc],
+                                  'location': locations[exc],
+                                  'type': types[exc]
+                                  })
+
+            elif types[exc] == 'biosphere':
+                exchanges.append({'name': names[exc],
+                                  'amount': amount,
+                                  'unit': units[exc],
+                                  'categories': categories[exc],
+                                  'database': databases[exc],
+                                  'type': types[exc]
+                                  })
+
+        if actv_dict is None:
+            raise ValueError(f"Dataset '{id_actv}' has no production exchange.")
 
         actv_dict.update({'exchanges': exchanges})
         inventories.append(actv_dict)
@@ -137,49 +199,220 @@ def create_dataset_from_df(inventories_df):
     return inventories
 
 
-def regionalize_inventories(activities, COUNTRIES, dbs, DB_REG):
+def regionalize_inventories(activities, COUNTRIES, dbs, DB_REG, processes=None, seed=None):
     """
     This function creates regionalized inventories for multiple activities
     by replicating a list of existing activities for a set of countries/regions and relinking
     technosphere exchanges to suppliers within the new location.
 
+    The work is split by location. With `processes`, the locations are regionalized in a pool of
+    worker processes; the supplier index is sent once to each worker and the results are merged
+    in the same order as in the serial run.
+
     Arguments:
         - activities (List of tuples): List of tuples, where each tuple contains 3 elements that defines the activity
                                        which is regionalized; (`name`, `reference product`, `location`) 
         - COUNTRIES (List): List of countries/regions that the activity be replicated to.
         - dbs (List): List of databases that contains the data to be used in the function.
         - DB_REG (str): The name of the database where the regionalized data will be stored.
+        - processes (int): Number of worker processes. Defaults to None (serial run in this process).
+        - seed (str or int): If provided, the codes of the regionalized datasets are derived from the seed, the
+                             activity and the location, so that repeated (serial or parallel) runs give the same codes.
+                             Defaults to None (random codes).
     
     Return:
         - This function returns a list of datasets with regionalized inventory data.
     """
 
-    # Replicate activities to the new locations
-    lci_raw = []
+    # Find the activities to replicate
+    activities_lci = []
     for ds in activities:
         try:
             ds_lci = wurst.get_one(dbs, wurst.equals("name", ds[0]), 
                                         wurst.equals('reference product', ds[1]),
                                         wurst.equals('location', ds[2])
                                 )
-        except:
-            print(ds)
-            raise
-        
+        except (wurst.errors.NoResults, wurst.errors.MultipleResults) as err:
+            raise ValueError(f"The dataset to regionalize {ds} (name, reference product, location) "
+                             f"{'was not found' if isinstance(err, wurst.errors.NoResults) else 'is not unique'}.") from err
+        activities_lci.append(ds_lci)
+
+    # Codes of the replicated activities, assigned upfront so that all locations can be linked to each other
+    codes = {}
+    for i, ds_lci in enumerate(activities_lci):
         for loc in COUNTRIES:
-            ds_lci_loc = replicate_activity_to_loc(ds_lci, loc, DB_REG)
-            lci_raw.append(ds_lci_loc)
-
-    # Change exchange inputs for the new location
-    lci_regional = []
-    for ds in lci_raw:
-        ds_linked = relink_exchange_location(ds, dbs + lci_raw)
-        lci_regional.append(ds_linked)
+            if seed is None:
+                codes[(i, loc)] = wurst.filesystem.get_uuid()
+            else:
+                codes[(i, loc)] = deterministic_code(seed, DB_REG, ds_lci['name'], ds_lci['reference product'],
+                                                     ds_lci['location'], loc)
+
+    # Suppliers: existing datasets followed by the replicated activities
+    regional_suppliers = [{'name': ds_lci['name'],
+                           'reference product': ds_lci['reference product'],
+                           'unit': ds_lci['unit'],
+                           'location': loc,
+                           'database': DB_REG,
+                           'code': codes[(i, loc)]}
+                          for i, ds_lci in enumerate(activities_lci) for loc in COUNTRIES]
+    supplier_index = build_supplier_index(dbs + regional_suppliers)
+
+    # Replicate activities to the new locations and change exchange inputs for the new location
+    if processes is None:
+        lci_by_loc = [regionalize_location(activities_lci, loc, DB_REG, codes, supplier_index) for loc in COUNTRIES]
+    else:
+        with ProcessPoolExecutor(max_workers=processes,
+                                 initializer=_init_regionalization_worker,
+                                 initargs=(activities_lci, DB_REG, codes, supplier_index)) as executor:
+            lci_by_loc = list(executor.map(_regionalize_location_worker, COUNTRIES))
+
+    # Same order as the activities, then the locations
+    lci_regional = [lci_by_loc[j][i] for i in range(len(activities_lci)) for j in range(len(COUNTRIES))]
 
     return lci_regional
 
 
-def replicate_activity_to_loc(ds, LOC, DB_REG):
+def regionalize_location(activities_lci, LOC, DB_REG, codes, supplier_index):
+    """
+    Replicate activities to one location and relink their technosphere exchanges.
+
+    Arguments:
+        activities_lci (List): Datasets to replicate.
+        LOC (str): The new location.
+        DB_REG (str): The name of the regionalized database.
+        codes (dict): Codes of the replicated datasets as {(position in `activities_lci`, location): code}.
+        supplier_index (dict): Index created with `build_supplier_index`.
+
+    Returns:
+        The list of regionalized datasets, in the order of `activities_lci`.
+    """
+    lci_loc = []
+    for i, ds_lci in enumerate(activities_lci):
+        ds_lci_loc = replicate_activity_to_loc(ds_lci, LOC, DB_REG, code=codes[(i, LOC)])
+        lci_loc.append(relink_exchange_location(ds_lci_loc, None, supplier_index))
+    return lci_loc
+
+
+# Read-only data shared with the worker processes of `regionalize_inventories`
+_worker_data = {}
+
+
+def _init_regionalization_worker(activities_lci, DB_REG, codes, supplier_index):
+    _worker_data.update({'activities_lci': activities_lci,
+                         'DB_REG': DB_REG,
+                         'codes': codes,
+                         'supplier_index': supplier_index})
+
+
+def _regionalize_location_worker(LOC):
+    return regionalize_location(_worker_data['activities_lci'], LOC, _worker_data['DB_REG'],
+                                _worker_data['codes'], _worker_data['supplier_index'])
+
+
+def deterministic_code(*fields):
+    """
+    Returns a code (UUID hex string) derived from the given fields.
+    The same fields always give the same code.
+    """
+    return uuid.uuid5(uuid.NAMESPACE_OID, '|'.join(str(f) for f in fields)).hex
+
+
+def assign_deterministic_codes(db):
+    """
+    Replace the codes of the datasets by codes derived from their name, reference product and location
+    (see `deterministic_code`), so that the datasets keep the same code every time they are imported.
+    Exchanges (including production exchanges) linked to the old codes are updated.
+
+    Arguments:
+        - db: list of dictionaries; each dictionary is a dataset/activity
+
+    Returns a dictionary as {old key: new key}.
+    """
+    new_keys = {}
+    for ds in db:
+        code = deterministic_code(ds['name'], ds['reference product'], ds['location'])
+        if (ds['database'], code) in new_keys.values():
+            raise ValueError(f"Several datasets for {ds['name']}, {ds['reference product']}, {ds['location']}.")
+        new_keys[(ds['database'], ds['code'])] = (ds['database'], code)
+
+    for ds in db:
+        ds['code'] = new_keys[(ds['database'], ds['code'])][1]
+        for exc in ds['exchanges']:
+            if exc.get('input') in new_keys:
+                exc['input'] = new_keys[exc['input']]
+
+    return new_keys
+
+
+def dataset_hash(ds):
+    """
+    Returns a hash of the content of a dataset (all fields and exchanges).
+    """
+    content = json.dumps(ds, sort_keys=True, default=str)
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+
+def write_database_incremental(data, db_name):
+    """
+    Write a list of datasets to a Brightway database, only writing the datasets that are new or have changed since
+    the last write and deleting the datasets that are no longer in `data`.
+
+    The datasets are prepared as in `wurst.write_brightway2_database` (parameters in Brightway format, database name,
+    internal linking and checks) on copies of the datasets and their exchanges, so `data` is not modified. A hash of each dataset (see `dataset_hash`) is stored in the metadata of the database; a dataset is written if
+    its code is new or its hash is different. The first write (or a write to a database without hashes) writes all
+    datasets. The processed arrays of the database are rebuilt once at the end, only if something changed.
+    Use deterministic codes (see `assign_deterministic_codes` and the `seed` of `regionalize_inventories`) so that
+    unchanged datasets keep their code between imports.
+
+    Arguments:
+        - data: list of dictionaries; each dictionary is a dataset/activity
+        - db_name (str): Name of the Brightway database
+
+    Returns a dictionary with the number of 'written', 'deleted' and 'unchanged' datasets.
+    """
+    data = [{**ds, 'exchanges': [dict(exc) for exc in ds.get('exchanges', [])]} for ds in data]
+    for ds in data:
+        if "parameters" in ds:
+            ds["parameters"] = {name: {"amount": amount} for name, amount in ds["parameters"].items()}
+    wurst.linking.change_db_name(data, db_name)
+    wurst.linking.link_internal(data)
+    wurst.linking.check_internal_linking(data)
+    wurst.linking.check_duplicate_codes(data)
+
+    hashes = {ds['code']: dataset_hash(ds) for ds in data}
+
+    if db_name not in bw.databases or 'content_hashes' not in bw.databases[db_name]:
+        if db_name in bw.databases:
+            del bw.databases[db_name]
+        # The datasets are already prepared (`wurst.write_brightway2_database` would convert the parameters again)
+        WurstImporter(db_name, data).write_database()
+        bw.databases[db_name]['content_hashes'] = hashes
+        bw.databases.flush()
+        return {'written': len(data), 'deleted': 0, 'unchanged': 0}
+
+    stored_hashes = bw.databases[db_name]['content_hashes']
+    changed = [ds for ds in data if stored_hashes.get(ds['code']) != hashes[ds['code']]]
+    removed = [code for code in stored_hashes if code not in hashes]
+
+    db = bw.Database(db_name)
+    for code in removed + [ds['code'] for ds in changed if ds['code'] in stored_hashes]:
+        db.get(code).delete()
+
+    for ds in changed:
+        act = db.new_activity(ds['code'], **{k: v for k, v in ds.items() if k not in ('exchanges', 'code', 'database')})
+        act.save()
+        for exc in ds['exchanges']:
+            act.new_exchange(**exc).save()
+
+    if changed or removed:
+        bw.databases[db_name]['content_hashes'] = hashes
+        bw.databases.flush()
+        db.process()
+
+    return {'written': len(changed), 'deleted': len(removed), 'unchanged': len(data) - len(changed)}
+
+
+def replicate_activity_to_loc(ds, LOC, DB_REG, code=None):
     """
     Replicate an activity to new locations and translate it to a regionalized database.
     
@@ -187,6 +420,7 @@ def replicate_activity_to_loc(ds, LOC, DB_REG):
         ds: The existing dataset.
         loc (str): The new location to replicate the activity to.
         DB_REG (str): The name of the regionalized database.
+        code (str): Code of the new dataset. Defaults to None (a new random code).
         
     Returns:
         The activity replicated to the new location.
@@ -198,6 +432,8 @@ def replicate_activity_to_loc(ds, LOC, DB_REG):
 
     # Translate the copy to the regionalized database
     ds_lci_loc['database'] = DB_REG
+    if code is not None:
+        ds_lci_loc['code'] = code
 
     # Change input code for production type
     for exc in filter(production, ds_lci_loc["exchanges"]):
@@ -206,97 +442,357 @@ def replicate_activity_to_loc(ds, LOC, DB_REG):
     return ds_lci_loc
 
 
-def relink_exchange_location(ds, db):
+def relink_exchange_location(ds, db, supplier_index=None):
     """
     Find new technosphere suppliers based on the location of the dataset.
     The new supplier is linked by code.
 
     Based on 'wurst.transformations.geo.relink_technosphere_exchanges'
 
+    The supplier is searched first in the location of the dataset, then in the locations
+    returned by `location_fallback_chain` and finally in 'RoW'.
+
     Arguments:
         ds: The dataset.
-        dbs (List): List of datasets that contains the data to be used in the function.
-        
+        db (List): List of datasets searched for the suppliers. Not used if `supplier_index` is provided
+                   (can be None).
+        supplier_index (dict): Index of `db` created with `build_supplier_index`. Defaults to None (created
+                               from `db`); pass it when relinking many datasets against the same `db`.
+
     Returns:
-        The activity replicated to the new location.  
+        The dataset, with its technosphere exchanges relinked in place.
     """
 
     LOCATION = ds['location']
     technosphere = lambda x: x["type"] == "technosphere"
-    geomatcher = Geomatcher() # Initialize the geomatcher object     
-
-    for exc in filter(technosphere, ds["exchanges"]):
-        exc_filter = {'name': exc['name'],
-                      'product': exc['product'],
-                      'unit': exc['unit']}
 
-        # Get the list of possible datasets for the exchange
+    if supplier_index is None:
+        supplier_index = build_supplier_index(db)
 
+    for exc in filter(technosphere, ds["exchanges"]):
+        # Get the possible datasets for the exchange, by location
+        suppliers = [supplier_index.get((exc['name'], exc['product'], exc['unit']), {})]
         if 'market group' in exc['name']:
             # Get both "market group" and "market" activities:
-            possible_datasets_group = list(wurst.transformations.geo.get_possibles(exc_filter, db)) 
-
-            exc_filter_market = copy.deepcopy(exc_filter)
-            exc_filter_market.update({'name': exc['name'].replace('market group', 'market')})
-            possible_datasets_market = list(wurst.transformations.geo.get_possibles(exc_filter_market, db))
-
-            possible_datasets = possible_datasets_group + possible_datasets_market
-            
-        else:
-            possible_datasets = list(wurst.transformations.geo.get_possibles(exc_filter, db))
-        
-        # Check if there is an exact match for the location
-        match_dataset = [ds for ds in possible_datasets if ds['location'] == LOCATION]
-        if len(match_dataset) == 0:
-            # If there is no specific dataset for the location, search for the supraregional locations
-            loc_intersection = geomatcher.intersects(LOCATION, biggest_first=False)
-            
-            for loc in [i[1] if type(i)==tuple else i for i in loc_intersection]:
-                match_dataset = [ds for ds in possible_datasets if ds['location'] == loc]
-                if len(match_dataset) > 0:
+            suppliers.append(supplier_index.get((exc['name'].replace('market group', 'market'), exc['product'], exc['unit']), {}))
+
+        # Check if there is an exact match for the location, otherwise search for the supraregional locations and RoW
+        match_dataset = None
+        for loc in [LOCATION] + location_fallback_chain(LOCATION) + ['RoW']:
+            for suppliers_by_loc in suppliers:
+                if loc in suppliers_by_loc:
+                    match_dataset = suppliers_by_loc[loc][0]
                     break
-                else:
-                    match_dataset = [ds for ds in possible_datasets if ds['location'] == 'RoW']
+            if match_dataset is not None:
+                break
+
+        if match_dataset is None:
+            raise ValueError(f"No supplier found for {exc['name']}, {exc['product']}, {exc['unit']} in {LOCATION}")
 
         exc.update({
-                    'name': match_dataset[0]['name'],
-                    'product': match_dataset[0]['reference product'],
-                    'unit': match_dataset[0]['unit'],
-                    'location': match_dataset[0]['location'],
-                    'input': (match_dataset[0]['database'], match_dataset[0]['code'])
+                    'name': match_dataset['name'],
+                    'product': match_dataset['reference product'],
+                    'unit': match_dataset['unit'],
+                    'location': match_dataset['location'],
+                    'input': (match_dataset['database'], match_dataset['code'])
                     })
 
     return ds
 
 
-def modify_exchange_amount_from_df(db, lci_param_prosp):
+def build_supplier_index(datasets):
+    """
+    Index datasets by (name, reference product, unit) and location.
+
+    Returns a nested dictionary as {(name, reference product, unit): {location: [suppliers]}},
+    where the suppliers keep the order in which they appear in `datasets`. Each supplier only holds
+    the fields needed for linking (name, reference product, unit, location, database and code).
+    """
+    index = {}
+    for ds in datasets:
+        key = (ds['name'], ds['reference product'], ds['unit'])
+        supplier = {field: ds[field] for field in ('name', 'reference product', 'unit', 'location', 'database', 'code')}
+        index.setdefault(key, {}).setdefault(ds['location'], []).append(supplier)
+    return index
+
+
+@lru_cache(maxsize=None)
+def _geomatcher():
+    return Geomatcher()
+
+
+@lru_cache(maxsize=None)
+def _location_fallback_chain(LOCATION):
+    loc_intersection = _geomatcher().intersects(LOCATION, biggest_first=False)
+    return tuple(i[1] if type(i)==tuple else i for i in loc_intersection)
+
+
+def location_fallback_chain(LOCATION):
+    """
+    Returns the list of supraregional locations intersecting `LOCATION`, from the smallest to the biggest.
+    The chain is computed once per location and cached.
+    """
+    return list(_location_fallback_chain(LOCATION))
+
+
+def modify_exchange_amount_from_df(db, lci_param_prosp, column='2030_avg'):
     '''
     This function modifies in place exchanges amounts based on data provided in a dataframe
-    
+
+    Arguments:
+        - db: list of dictionaries; each dictionary is a dataset/activity
+        - lci_param_prosp: Dataframe with one row per parameter; columns are to_process, to_reference_product,
+                           to_location, from_process, from_reference_product, from_location, from_categories and
+                           the year/statistic columns with the new amounts (e.g., '2030_avg')
+        - column (str): Column with the new amounts. Defaults to '2030_avg'.
+
+    Returns a dataframe with the parameter rows that did not match any exchange.
     '''
-    # Change the format of 'categories':
-    lci_param_prosp['from_categories'] = [tuple(i.split('::')) if i != 0 else 0 for i in lci_param_prosp['from_categories']]
-    
+    parameter_index, amounts = build_parameter_index(lci_param_prosp, [column])
+
     # Modify exchanges amount:
-    for ds in db:
-        for exc in ds['exchanges']:
-            if exc['type'] == 'production':
-                pass
+    matched_rows = set()
+    for i, j, row in match_parameters(db, parameter_index):
+        db[i]['exchanges'][j].update({'amount': amounts[row, 0]})
+        matched_rows.add(row)
+
+    return unmatched_parameters(lci_param_prosp, matched_rows)
+
+
+def scenario_variants_from_df(db, lci_param_prosp, columns):
+    '''
+    This function creates one variant of the database per year/statistic column of the parameters dataframe,
+    matching the exchanges with the parameters in a single pass.
+
+    Only the datasets with modified exchanges are copied; the other datasets are the same objects in `db`
+    and in all variants.
+
+    Arguments:
+        - db: list of dictionaries; each dictionary is a dataset/activity
+        - lci_param_prosp: Dataframe with the parameters (see `modify_exchange_amount_from_df`)
+        - columns (list): Columns with the new amounts (e.g., ['2030_avg', '2030_min', '2030_max'])
+
+    Returns a dictionary as {column: list of datasets} and a dataframe with the parameter rows
+    that did not match any exchange.
+    '''
+    parameter_index, amounts = build_parameter_index(lci_param_prosp, columns)
+
+    # Collect the matches: {dataset position: [(exchange position, parameter row)]}
+    matches = {}
+    for i, j, row in match_parameters(db, parameter_index):
+        matches.setdefault(i, []).append((j, row))
+
+    variants = {}
+    for j, column in enumerate(columns):
+        db_variant = list(db)
+        for i, exc_rows in matches.items():
+            db_variant[i] = copy.deepcopy(db[i])
+            for exc_pos, row in exc_rows:
+                db_variant[i]['exchanges'][exc_pos]['amount'] = amounts[row, j]
+        variants[column] = db_variant
+
+    matched_rows = {row for exc_rows in matches.values() for _, row in exc_rows}
+
+    return variants, unmatched_parameters(lci_param_prosp, matched_rows)
+
+
+def build_parameter_index(lci_param_prosp, columns):
+    '''
+    Index the rows of a parameters dataframe by the exchange they modify.
+
+    Technosphere exchanges are indexed by (to_process, to_reference_product, to_location,
+    from_process, from_reference_product, from_location) and biosphere exchanges by (to_process,
+    to_reference_product, to_location, from_process, from_categories). If several rows share a key,
+    the first one is used.
+
+    Returns the index as {('technosphere' or 'biosphere', key): row position} and an array with
+    the values of `columns` (rows x columns).
+    '''
+    # Change the format of 'categories':
+    from_categories = [tuple(i.split('::')) if i != 0 else 0 for i in lci_param_prosp['from_categories']]
+
+    to_keys = list(zip(lci_param_prosp['to_process'],
+                       lci_param_prosp['to_reference_product'],
+                       lci_param_prosp['to_location'],
+                       lci_param_prosp['from_process']))
+
+    index = {}
+    for row, (to_key, from_product, from_location, categories) in enumerate(zip(to_keys,
+                                                                               lci_param_prosp['from_reference_product'],
+                                                                               lci_param_prosp['from_location'],
+                                                                               from_categories)):
+        index.setdefault(('technosphere', to_key + (from_product, from_location)), row)
+        index.setdefault(('biosphere', to_key + (categories,)), row)
+
+    return index, lci_param_prosp[list(columns)].to_numpy()
+
+
+def match_parameters(db, parameter_index):
+    '''
+    Generator of (dataset position, exchange position, parameter row position) for every technosphere and
+    biosphere exchange in `db` that has a parameter in `parameter_index` (see `build_parameter_index`).
+    '''
+    for i, ds in enumerate(db):
+        ds_key = (ds['name'], ds['reference product'], ds['location'])
+        for j, exc in enumerate(ds['exchanges']):
+            if exc['type'] == 'technosphere':
+                key = ('technosphere', ds_key + (exc['name'], exc['product'], exc['location']))
+            elif exc['type'] == 'biosphere':
+                key = ('biosphere', ds_key + (exc['name'], exc['categories']))
             else:
-                if exc['type'] == 'technosphere':
-                    new_amount = lci_param_prosp[(lci_param_prosp['to_process'] == ds['name']) & 
-                                                (lci_param_prosp['to_reference_product'] == ds['reference product']) & 
-                                                (lci_param_prosp['to_location'] == ds['location']) &
-                                                (lci_param_prosp['from_process'] == exc['name']) & 
-                                                (lci_param_prosp['from_reference_product'] == exc['product']) & 
-                                                (lci_param_prosp['from_location'] == exc['location'])]['2030_avg'].values
-                    
-                elif exc['type'] == 'biosphere':
-                    new_amount = lci_param_prosp[(lci_param_prosp['to_process'] == ds['name']) & 
-                                                (lci_param_prosp['to_reference_product'] == ds['reference product']) & 
-                                                (lci_param_prosp['to_location'] == ds['location']) &
-                                                (lci_param_prosp['from_process'] == exc['name']) & 
-                                                (lci_param_prosp['from_categories'] == exc['categories'])]['2030_avg'].values
-
-                if len(new_amount) > 0:
-                    exc.update({'amount': new_amount[0]})
\ No newline at end of file
+                continue
+
+            row = parameter_index.get(key)
+            if row is not None:
+                yield i, j, row
+
+
+def unmatched_parameters(lci_param_prosp, matched_rows):
+    '''
+    Returns the rows of the parameters dataframe whose position is not in `matched_rows`.
+    '''
+    unmatched = [row for row in range(len(lci_param_prosp)) if row not in matched_rows]
+    return lci_param_prosp.iloc[unmatched]
+
+
+def extract_database_snapshot(db_name, snapshot_dir=None, lazy=False):
+    """
+    Extract a Brightway database into wurst format (list of datasets) through a binary snapshot.
+
+    The first call runs `wurst.extract_brightway2_databases` and writes the datasets to a snapshot;
+    the following calls read the snapshot as long as the database has not been modified since
+    (the snapshot stores the database name, its "modified" timestamp and the wurst version).
+
+    Arguments:
+        - db_name (str): Name of the database (e.g., 'ecoinvent 3.9.1 cutoff').
+        - snapshot_dir (Path): Directory of the snapshots. Defaults to the "wurst_snapshots" folder of the project directory.
+        - lazy (bool): If True, the exchanges of each dataset are only read from the snapshot when the dataset's
+                       'exchanges' are accessed (see `LazyDataset`). Defaults to False.
+
+    Returns:
+        - List of datasets.
+    """
+    return _load_snapshot(db_name, lambda: wurst.extract_brightway2_databases(db_name), snapshot_dir, lazy)
+
+
+def extract_biosphere_snapshot(db_name='biosphere3', snapshot_dir=None):
+    """
+    Import the biosphere database as a list of dictionaries (`as_dict()` of every flow) through a binary snapshot.
+    See `extract_database_snapshot`.
+    """
+    return _load_snapshot(db_name, lambda: [ef.as_dict() for ef in bw.Database(db_name)], snapshot_dir, False)
+
+
+class LazyDataset(dict):
+    """
+    Dataset of a snapshot whose exchanges are read from disk the first time they are needed: when
+    `ds['exchanges']` is accessed or when the dataset is iterated over (`items()`, `dict(ds)`, `json.dumps`, ...),
+    copied or pickled. Copies and pickles are regular dictionaries.
+    The other fields (name, reference product, location, code, ...) are always in memory.
+    """
+    def __init__(self, fields, filepath, offset, length):
+        super().__init__(fields)
+        self.filepath = filepath
+        self.offset = offset
+        self.length = length
+
+    def load(self):
+        """
+        Read the exchanges from the snapshot if they have not been read yet. Returns the dataset.
+        """
+        if not super().__contains__('exchanges'):
+            with open(self.filepath, 'rb') as f:
+                f.seek(self.offset)
+                super().__setitem__('exchanges', pickle.loads(f.read(self.length)))
+        return self
+
+    def __missing__(self, key):
+        if key != 'exchanges':
+            raise KeyError(key)
+        return self.load()['exchanges']
+
+    def __contains__(self, key):
+        return key == 'exchanges' or super().__contains__(key)
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def __iter__(self):
+        return super(LazyDataset, self.load()).__iter__()
+
+    def __len__(self):
+        return super().__len__() + (0 if super().__contains__('exchanges') else 1)
+
+    def keys(self):
+        return super(LazyDataset, self.load()).keys()
+
+    def values(self):
+        return super(LazyDataset, self.load()).values()
+
+    def items(self):
+        return super(LazyDataset, self.load()).items()
+
+    def copy(self):
+        return dict(self.load())
+
+    def __reduce__(self):
+        return dict, (dict(self.load()),)
+
+
+def _load_snapshot(db_name, extract, snapshot_dir, lazy):
+    metadata = {'database': db_name,
+                'modified': bw.databases[db_name].get('modified'),
+                'wurst': wurst.__version__}
+
+    snapshot_dir = Path(snapshot_dir) if snapshot_dir is not None else Path(bw.projects.dir) / 'wurst_snapshots'
+    snapshot_name = hashlib.md5(db_name.encode('utf-8')).hexdigest()
+    header_filepath = snapshot_dir / f"{snapshot_name}.header.pickle"
+
+    header = None
+    if header_filepath.exists():
+        with open(header_filepath, 'rb') as f:
+            header = pickle.load(f)
+        if header['metadata'] != metadata or not (snapshot_dir / header.get('exchanges_file', '')).is_file():
+            header = None
+
+    if header is None:
+        # Write a new snapshot: dataset fields in the header and the exchanges of each dataset in a binary file.
+        # The binary file has a new name and the header is replaced atomically once the binary file is complete,
+        # so that an interrupted write leaves the previous snapshot (or none), never a header pointing to a partial file.
+        db = extract()
+        datasets = []
+        snapshot_dir.mkdir(parents=True, exist_ok=True)
+        exchanges_file = f"{snapshot_name}.{uuid.uuid4().hex}.exchanges.bin"
+        with open(snapshot_dir / exchanges_file, 'wb') as f:
+            for ds in db:
+                exchanges = pickle.dumps(ds.get('exchanges', []), protocol=pickle.HIGHEST_PROTOCOL)
+                datasets.append(({k: v for k, v in ds.items() if k != 'exchanges'}, f.tell(), len(exchanges)))
+                f.write(exchanges)
+        header = {'metadata': metadata, 'exchanges_file': exchanges_file, 'datasets': datasets}
+        temporary_filepath = snapshot_dir / f"{snapshot_name}.{uuid.uuid4().hex}.header.tmp"
+        with open(temporary_filepath, 'wb') as f:
+            pickle.dump(header, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temporary_filepath, header_filepath)
+
+        # Exchanges of the previous snapshots
+        for filepath in snapshot_dir.glob(f"{snapshot_name}.*.exchanges.bin"):
+            if filepath.name != exchanges_file:
+                try:
+                    filepath.unlink()
+                except OSError:
+                    pass
+        return db
+
+    exchanges_filepath = snapshot_dir / header['exchanges_file']
+
+    if lazy:
+        return [LazyDataset(fields, exchanges_filepath, offset, length) for fields, offset, length in header['datasets']]
+
+    with open(exchanges_filepath, 'rb') as f:
+        exchanges = memoryview(f.read())
+    db = []
+    for fields, offset, length in header['datasets']:
+        ds = dict(fields)
+        ds['exchanges'] = pickle.loads(exchanges[offset:offset + length])
+        db.append(ds)
+    return db
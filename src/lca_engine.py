@@ -0,0 +1,311 @@
+"""
+LCA calculations on a matrix bundle exported from a Brightway project, without Brightway
+
+A bundle is a directory with the technosphere and biosphere matrices (arrays of the sparse matrices in .npy files),
+the characterization matrix (.npy), the index maps and activity names (index.json) and, optionally, the
+uncertainty parameters of the matrix values (see `PARAMETER_DTYPE`). The arrays are loaded as
+memory maps, so processes loading the same bundle share a single copy of the matrices through the page cache.
+Bundles are written with `results_analysis.export_matrix_bundle`.
+"""
+
+import heapq
+import json
+import numpy as np
+from pathlib import Path
+from scipy import sparse
+
+from . import lca_matrices
+
+
+SYSTEM_COMPONENTS = ['Direct emissions',
+                     'Feedstock supply chain',
+                     'Heating',
+                     'Electricity from grid',
+                     'Other',
+                     'Total']
+
+FEEDSTOCK_SUPPLY_CHAIN = ['market group for natural gas, high pressure',
+                          'market for biomethane, 24 bar',
+                          'market for biomethane, 24 bar w/ CCS',
+                          'hydrogen production, gaseous, 25 bar, from electrolysis with wind electricity',
+                          'nitrogen gaseous, from cryogenic distillation, without compression']
+
+# Uncertainty parameters of the values of the technosphere and biosphere matrices (one entry per exchange),
+# with the fields of Brightway/stats_arrays. `sign` is -1 for values entered with the opposite sign in the matrix
+# (technosphere inputs).
+PARAMETER_DTYPE = np.dtype([('row', np.int32), ('col', np.int32), ('amount', np.float64),
+                            ('uncertainty_type', np.uint8), ('loc', np.float64), ('scale', np.float64),
+                            ('shape', np.float64), ('minimum', np.float64), ('maximum', np.float64),
+                            ('negative', bool), ('sign', np.float64)])
+
+# Default rules of `MatrixBundle.supply_chain_contribution`, as (category, [name substrings])
+SUPPLY_CHAIN_RULES = [('Feedstock supply chain', FEEDSTOCK_SUPPLY_CHAIN),
+                      ('Heating', ['heat production', 'steam production']),
+                      ('Electricity from grid', ['market group for electricity'])]
+
+
+def system_component(input_name):
+    """
+    System component (see `SYSTEM_COMPONENTS`) of a technosphere input, based on the name of the supplier.
+    """
+    # Feedstock supply chain
+    if input_name in FEEDSTOCK_SUPPLY_CHAIN:
+        return 'Feedstock supply chain'
+    # Heating
+    if 'heat production' in input_name or 'steam production' in input_name:
+        return 'Heating'
+    # Electricity
+    if 'market group for electricity' in input_name:
+        return 'Electricity from grid'
+    # Infrastructure + other utilities
+    return 'Other'
+
+
+def write_matrix_bundle(dirpath, technosphere_matrix, biosphere_matrix, characterization,
+                        product_dict, activity_dict, biosphere_dict, impacts, activity_names,
+                        technosphere_params=None, biosphere_params=None):
+    """
+    Write a matrix bundle.
+
+    Parameters:
+    - dirpath (str or Path): Directory of the bundle (created if needed).
+    - technosphere_matrix (scipy sparse matrix): Technosphere matrix (products x activities).
+    - biosphere_matrix (scipy sparse matrix): Biosphere matrix (elementary flows x activities).
+    - characterization (numpy array): Characterization factors (impact categories x elementary flows).
+    - product_dict, activity_dict, biosphere_dict (dict): Keys of the products, activities and elementary flows
+                                                         mapped to their row/column (e.g., `lca.product_dict`).
+    - impacts (list): Names of the impact categories, in the order of the rows of `characterization`.
+    - activity_names (dict): Name of the activities as {key: name}.
+    - technosphere_params, biosphere_params (numpy structured array): Uncertainty parameters of the matrix values
+                                                                     (see `PARAMETER_DTYPE`). Defaults to None.
+    """
+    dirpath = Path(dirpath)
+    dirpath.mkdir(parents=True, exist_ok=True)
+
+    for name, matrix in (('technosphere', sparse.csc_matrix(technosphere_matrix)),
+                         ('biosphere', sparse.csc_matrix(biosphere_matrix))):
+        matrix.sum_duplicates()
+        np.save(dirpath / f"{name}_data.npy", matrix.data.astype(np.float64))
+        np.save(dirpath / f"{name}_indices.npy", matrix.indices.astype(np.int32))
+        np.save(dirpath / f"{name}_indptr.npy", matrix.indptr.astype(np.int32))
+    np.save(dirpath / "characterization.npy", np.asarray(characterization, dtype=np.float64))
+    for name, params in (('technosphere', technosphere_params), ('biosphere', biosphere_params)):
+        if params is not None:
+            np.save(dirpath / f"{name}_params.npy", np.asarray(params, dtype=PARAMETER_DTYPE))
+
+    ordered = lambda index: [list(key) for key, _ in sorted(index.items(), key=lambda x: x[1])]
+    index = {'technosphere_shape': list(technosphere_matrix.shape),
+             'biosphere_shape': list(biosphere_matrix.shape),
+             'products': ordered(product_dict),
+             'activities': ordered(activity_dict),
+             'biosphere': ordered(biosphere_dict),
+             'impacts': list(impacts),
+             'activity_names': [[list(key), name] for key, name in activity_names.items()]}
+    with open(dirpath / "index.json", 'w') as f:
+        json.dump(index, f)
+
+
+class MatrixBundle:
+    """
+    Matrices and index maps of a bundle (see `load_matrix_bundle`).
+    The technosphere matrix is factorized on the first calculation and the factorization is reused.
+    `technosphere_params` and `biosphere_params` are None if the bundle has no uncertainty parameters.
+    """
+
+    def __init__(self, technosphere_matrix, biosphere_matrix, characterization,
+                 product_dict, activity_dict, biosphere_dict, impacts, activity_names,
+                 technosphere_params=None, biosphere_params=None):
+        self.technosphere_matrix = technosphere_matrix
+        self.biosphere_matrix = biosphere_matrix
+        self.characterization = characterization
+        self.product_dict = product_dict
+        self.activity_dict = activity_dict
+        self.biosphere_dict = biosphere_dict
+        self.impacts = impacts
+        self.activity_names = activity_names
+        self.products = sorted(product_dict, key=product_dict.get)
+        self.technosphere_params = technosphere_params
+        self.biosphere_params = biosphere_params
+        self._lu = None
+        self._unit_scores = None
+
+    @property
+    def lu(self):
+        if self._lu is None:
+            self._lu = lca_matrices.factorize(self.technosphere_matrix)
+        return self._lu
+
+    def unit_scores(self):
+        """
+        Scores per unit of every product (products x impact categories), see `lca_matrices.unit_scores`.
+        """
+        if self._unit_scores is None:
+            self._unit_scores = lca_matrices.unit_scores(self.lu, self.biosphere_matrix, self.characterization)
+        return self._unit_scores
+
+    def multi_lcia(self, key, amount=1):
+        """
+        Scores of `amount` of the product `key` for every impact category, as {impact: score}
+        (same results as `results_analysis.multi_lcia`).
+        """
+        demand = np.zeros(len(self.product_dict))
+        demand[self.product_dict[key]] = amount
+        scores = self.characterization @ (self.biosphere_matrix @ self.lu.solve(demand))
+        return {impact: scores[i] for i, impact in enumerate(self.impacts)}
+
+    def multi_lcia_batch(self, demands):
+        """
+        Scores of several demands, given as {label: (key, amount)}, solved together.
+
+        Returns a dictionary as {label: {impact: score}}.
+        """
+        labels = list(demands)
+        demand_matrix = sparse.csc_matrix(([demands[label][1] for label in labels],
+                                           ([self.product_dict[demands[label][0]] for label in labels],
+                                            list(range(len(labels))))),
+                                          shape=(len(self.product_dict), len(labels)))
+        scores = lca_matrices.demand_scores(self.lu, self.biosphere_matrix, self.characterization, demand_matrix)
+        return {label: {impact: scores[j, i] for i, impact in enumerate(self.impacts)}
+                for j, label in enumerate(labels)}
+
+    def system_contribution(self, key, activity_amount=1):
+        """
+        Contribution of each system component (see `SYSTEM_COMPONENTS`) to the scores of an activity, as
+        {impact: {component: score}} (same results as `results_analysis.lcia_system_contribution`).
+        The technosphere inputs are read from the column of the activity in the technosphere matrix.
+        """
+        scores = self.unit_scores()
+        contributions = np.zeros((len(SYSTEM_COMPONENTS), len(self.impacts)))
+        contributions[SYSTEM_COMPONENTS.index('Total')] = activity_amount * scores[self.product_dict[key]]
+
+        col = self.activity_dict[key]
+        technosphere_column = self.technosphere_matrix[:, col].tocoo()
+        production_row = self.product_dict[key]
+        for row, value in zip(technosphere_column.row, technosphere_column.data):
+            if row == production_row or value == 0:
+                continue
+            component = system_component(self.activity_names[self.products[row]])
+            # Inputs are negative in the technosphere matrix
+            contributions[SYSTEM_COMPONENTS.index(component)] += -activity_amount * value * scores[row]
+
+        direct_emissions = self.biosphere_matrix[:, col].toarray().ravel()
+        contributions[SYSTEM_COMPONENTS.index('Direct emissions')] += activity_amount * (self.characterization @ direct_emissions)
+
+        return {impact: {component: contributions[c, i] for c, component in enumerate(SYSTEM_COMPONENTS)}
+                for i, impact in enumerate(self.impacts)}
+
+    def supply_chain_contribution(self, key, activity_amount=1, rules=None, max_depth=5, cutoff=0.01,
+                                  max_nodes=10000, impact=0):
+        """
+        Contribution of the supply chain of an activity to its scores, by traversing the supply chain.
+
+        Starting from the activity, the technosphere inputs of each node are expanded, the largest first, while their
+        score (for the impact category at position `impact`) is at least `cutoff` times the total score, they are at
+        most `max_depth` tiers from the activity and less than `max_nodes` nodes have been expanded. The score of a
+        node is its amount times the unit score of the product (see `unit_scores`), so that no calculation is needed
+        per node, and cycles of the technosphere are cut by the depth and the number of nodes.
+
+        The direct emissions of each expanded node and the whole score of each node that is not expanded are
+        assigned to a category with `rules`, a list of (category, [name substrings]) that defaults to
+        `SUPPLY_CHAIN_RULES`: a contribution goes to the
+        first rule matching the name of its node or, if none does, of the closest node upstream in the path to the
+        activity. Contributions without a matching rule go to 'Other' and the direct emissions of the activity to
+        'Direct emissions'. The categories add up to the total score for every impact category.
+
+        Returns:
+        - contributions (dict): {impact: {category: score}}, including 'Total'.
+        - nodes (list): The expanded nodes as dictionaries with the depth, the path of activity names from the activity,
+                        the amount, the score (cumulative) and the direct emissions score, for every impact category.
+        """
+        rules = SUPPLY_CHAIN_RULES if rules is None else rules
+        scores = self.unit_scores()
+        A = self.technosphere_matrix if self.technosphere_matrix.format == 'csc' else self.technosphere_matrix.tocsc()
+        B = self.biosphere_matrix if self.biosphere_matrix.format == 'csc' else self.biosphere_matrix.tocsc()
+        characterization = np.asarray(self.characterization)
+
+        def category(path):
+            for name in reversed(path):
+                for rule_category, substrings in rules:
+                    if any(substring in name for substring in substrings):
+                        return rule_category
+            return 'Other'
+
+        total = activity_amount * scores[self.product_dict[key]]
+        threshold = cutoff * abs(total[impact])
+        contributions = {'Total': total}
+
+        def add(category_name, values):
+            contributions[category_name] = contributions.get(category_name, 0) + values
+
+        # Heap of nodes to expand as (-|score|, order, product row, amount, depth, path)
+        root_row = self.product_dict[key]
+        heap = [(-abs(total[impact]), 0, root_row, activity_amount, 0, (self.activity_names.get(key, str(key)),))]
+        counter, nodes = 1, []
+        while heap:
+            _, _, row, amount, depth, path = heapq.heappop(heap)
+            node_key = self.products[row]
+            col = self.activity_dict[node_key]
+            node_score = amount * scores[row]
+
+            if depth > 0 and (len(nodes) >= max_nodes or depth > max_depth or abs(node_score[impact]) < threshold):
+                add(category(path), node_score)
+                continue
+
+            # Scaling of the activity to produce `amount` of its product
+            column = slice(A.indptr[col], A.indptr[col + 1])
+            rows, values = A.indices[column], A.data[column]
+            scale = amount / values[rows == row].sum()
+
+            bio_column = slice(B.indptr[col], B.indptr[col + 1])
+            direct_score = scale * (characterization[:, B.indices[bio_column]] @ B.data[bio_column])
+            add('Direct emissions' if depth == 0 else category(path), direct_score)
+            nodes.append({'depth': depth, 'path': path, 'amount': amount,
+                          'score': node_score, 'direct score': direct_score})
+
+            for input_row, value in zip(rows, values):
+                if input_row == row or value == 0:
+                    continue
+                # Inputs are negative in the technosphere matrix
+                input_amount = -value * scale
+                input_key = self.products[input_row]
+                input_score = input_amount * scores[input_row, impact]
+                heapq.heappush(heap, (-abs(input_score), counter, input_row, input_amount, depth + 1,
+                                      path + (self.activity_names.get(input_key, str(input_key)),)))
+                counter += 1
+
+        contributions = {impact_name: {category_name: values[i] for category_name, values in contributions.items()}
+                         for i, impact_name in enumerate(self.impacts)}
+        return contributions, nodes
+
+
+def load_matrix_bundle(dirpath):
+    """
+    Load a matrix bundle written with `write_matrix_bundle`. The arrays are memory-mapped (read-only).
+
+    Returns:
+    - bundle (MatrixBundle)
+    """
+    dirpath = Path(dirpath)
+    with open(dirpath / "index.json") as f:
+        index = json.load(f)
+
+    load = lambda name: np.load(dirpath / f"{name}.npy", mmap_mode='r')
+    matrices = {}
+    for name in ('technosphere', 'biosphere'):
+        matrices[name] = sparse.csc_matrix((load(f"{name}_data"), load(f"{name}_indices"), load(f"{name}_indptr")),
+                                           shape=tuple(index[f"{name}_shape"]), copy=False)
+
+    params = {name: load(f"{name}_params") if (dirpath / f"{name}_params.npy").exists() else None
+              for name in ('technosphere', 'biosphere')}
+
+    as_dict = lambda keys: {tuple(key): i for i, key in enumerate(keys)}
+    return MatrixBundle(matrices['technosphere'],
+                        matrices['biosphere'],
+                        load("characterization"),
+                        as_dict(index['products']),
+                        as_dict(index['activities']),
+                        as_dict(index['biosphere']),
+                        index['impacts'],
+                        {tuple(key): name for key, name in index['activity_names']},
+                        params['technosphere'],
+                        params['biosphere'])
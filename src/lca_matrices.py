@@ -0,0 +1,193 @@
+"""
+Functions to perform LCA calculations directly on the technosphere, biosphere and characterization matrices,
+so that the technosphere matrix is factorized once and reused for many demands and impact categories
+"""
+
+import numpy as np
+from scipy import sparse
+from scipy.sparse.linalg import splu
+
+
+def factorize(technosphere_matrix):
+    """
+    LU factorization of the technosphere matrix.
+
+    Parameters:
+    - technosphere_matrix (scipy sparse matrix): Technosphere matrix (products x activities).
+
+    Returns:
+    - lu (scipy.sparse.linalg.SuperLU): Factorization; `lu.solve(b)` solves A x = b and
+                                        `lu.solve(b, trans='T')` solves A^T x = b. `b` can have several columns.
+    """
+    return splu(sparse.csc_matrix(technosphere_matrix))
+
+
+def unit_scores(lu, biosphere_matrix, characterization):
+    """
+    Impact scores of one unit of every product, for every impact category, from a single transposed solve.
+
+    The score of a demand f is c B A^-1 f = f . s, with A^T s = B^T c. All products and impact
+    categories are therefore obtained with one solve with one column per impact category.
+
+    Parameters:
+    - lu (SuperLU): Factorization of the technosphere matrix (see `factorize`).
+    - biosphere_matrix (scipy sparse matrix): Biosphere matrix (elementary flows x activities).
+    - characterization (numpy array): Characterization factors (impact categories x elementary flows).
+
+    Returns:
+    - scores (numpy array): Scores per unit of product (products x impact categories).
+    """
+    rhs = np.asarray(biosphere_matrix.T @ np.asarray(characterization).T, dtype=float)
+    return lu.solve(np.ascontiguousarray(rhs), trans='T')
+
+
+def demand_scores(lu, biosphere_matrix, characterization, demand_matrix):
+    """
+    Impact scores of several demands, for every impact category, solving all demands together.
+
+    The system is solved either for all demands at once (one column per demand) or, when there are more
+    demands than impact categories, through the unit scores of every product (see `unit_scores`).
+
+    Parameters:
+    - lu (SuperLU): Factorization of the technosphere matrix (see `factorize`).
+    - biosphere_matrix (scipy sparse matrix): Biosphere matrix (elementary flows x activities).
+    - characterization (numpy array): Characterization factors (impact categories x elementary flows).
+    - demand_matrix (scipy sparse matrix or numpy array): Final demands (products x demands).
+
+    Returns:
+    - scores (numpy array): Scores (demands x impact categories).
+    """
+    characterization = np.asarray(characterization)
+    if demand_matrix.shape[1] < characterization.shape[0]:
+        demand = demand_matrix.toarray() if sparse.issparse(demand_matrix) else np.asarray(demand_matrix, dtype=float)
+        supply = lu.solve(np.ascontiguousarray(demand, dtype=float))
+        return (characterization @ (biosphere_matrix @ supply)).T
+    return np.asarray(demand_matrix.T @ unit_scores(lu, biosphere_matrix, characterization))
+
+
+def scenario_scores(technosphere_matrix, biosphere_matrix, characterization, demand,
+                    technosphere_changes=None, biosphere_changes=None, lu=None, max_rank=200):
+    """
+    Impact scores of a demand for many scenarios, each replacing a few values of the technosphere
+    and/or biosphere matrices, with a single factorization of the base technosphere matrix.
+
+    The change of the technosphere matrix in a scenario is dA = E_I D E_J^T, where I and J are the rows and
+    columns changed in any scenario. With G = A^-1 E_I (one solve per changed row, shared by all scenarios),
+    the Woodbury identity gives the supply of each scenario as
+        x' = x - Z (1 + Z[J, :])^-1 x[J],   with Z = G D and x = A^-1 f.
+    When more than `max_rank` rows or columns change over all scenarios (e.g., one-at-a-time perturbations),
+    the correction uses the rows and columns changed in each scenario only. When a scenario changes more than
+    `max_rank` rows or columns (or the correction is singular), the scenario matrix is factorized and solved directly.
+
+    Parameters:
+    - technosphere_matrix (scipy sparse matrix): Base technosphere matrix (products x activities).
+    - biosphere_matrix (scipy sparse matrix): Base biosphere matrix (elementary flows x activities).
+    - characterization (numpy array): Characterization factors (impact categories x elementary flows).
+    - demand (numpy array): Final demand (products).
+    - technosphere_changes (tuple): (rows, cols, values) with the new values of the technosphere matrix;
+                                    `values` has one row per changed element and one column per scenario.
+    - biosphere_changes (tuple): (rows, cols, values) with the new values of the biosphere matrix, with the same
+                                 number of scenarios as `technosphere_changes`.
+    - lu (SuperLU): Factorization of the base technosphere matrix. Computed if not provided.
+    - max_rank (int): Maximum number of changed rows/columns for the low-rank correction. Defaults to 200.
+
+    Returns:
+    - scores (numpy array): Scores (scenarios x impact categories).
+    """
+    technosphere_matrix = sparse.csc_matrix(technosphere_matrix)
+    biosphere_matrix = sparse.csr_matrix(biosphere_matrix)
+    characterization = np.asarray(characterization)
+    if lu is None:
+        lu = factorize(technosphere_matrix)
+
+    tech_rows, tech_cols, tech_delta = _matrix_delta(technosphere_matrix, technosphere_changes)
+    bio_rows, bio_cols, bio_delta = _matrix_delta(biosphere_matrix, biosphere_changes)
+    if tech_delta.shape[1] and bio_delta.shape[1] and tech_delta.shape[1] != bio_delta.shape[1]:
+        raise ValueError(f"The technosphere and biosphere changes have different numbers of scenarios "
+                         f"({tech_delta.shape[1]} and {bio_delta.shape[1]}).")
+    number_scenarios = max(tech_delta.shape[1], bio_delta.shape[1])
+    if number_scenarios == 0:
+        raise ValueError("No scenario values have been provided.")
+
+    supply = lu.solve(np.asarray(demand, dtype=float))
+
+    # Rows (I) and columns (J) of the technosphere matrix changed in any scenario
+    rows_I, pos_I = np.unique(tech_rows, return_inverse=True)
+    cols_J, pos_J = np.unique(tech_cols, return_inverse=True)
+    shared = 0 < max(len(rows_I), len(cols_J)) <= max_rank
+    if shared:
+        G = lu.solve(_unit_columns(rows_I, technosphere_matrix.shape[0]))
+
+    scores = np.zeros((number_scenarios, characterization.shape[0]))
+    for s in range(number_scenarios):
+        delta_s = tech_delta[:, s] if tech_delta.shape[1] else np.zeros(0)
+        changed = np.flatnonzero(delta_s)
+
+        if len(changed) == 0:
+            supply_s = supply
+        else:
+            supply_s = None
+            if shared:
+                supply_s = _woodbury_supply(supply, G, pos_I, pos_J, cols_J, delta_s)
+            else:
+                # Low-rank correction with the rows and columns changed in this scenario only
+                rows_s, pos_Is = np.unique(tech_rows[changed], return_inverse=True)
+                cols_s, pos_Js = np.unique(tech_cols[changed], return_inverse=True)
+                if max(len(rows_s), len(cols_s)) <= max_rank:
+                    G_s = lu.solve(_unit_columns(rows_s, technosphere_matrix.shape[0]))
+                    supply_s = _woodbury_supply(supply, G_s, pos_Is, pos_Js, cols_s, delta_s[changed])
+            if supply_s is None:
+                delta_matrix = sparse.csc_matrix((delta_s, (tech_rows, tech_cols)), shape=technosphere_matrix.shape)
+                supply_s = factorize(technosphere_matrix + delta_matrix).solve(np.asarray(demand, dtype=float))
+
+        inventory = biosphere_matrix @ supply_s
+        if bio_delta.shape[1]:
+            np.add.at(inventory, bio_rows, bio_delta[:, s] * supply_s[bio_cols])
+        scores[s] = characterization @ inventory
+
+    return scores
+
+
+def _unit_columns(rows, size):
+    """
+    Dense matrix with one unit column per row index in `rows`.
+    """
+    unit = np.zeros((size, len(rows)))
+    unit[rows, np.arange(len(rows))] = 1
+    return unit
+
+
+def _woodbury_supply(supply, G, pos_I, pos_J, cols_J, delta):
+    """
+    Supply vector after a low-rank change of the technosphere matrix (see `scenario_scores`).
+    Returns None if the correction is singular.
+    """
+    D = np.zeros((G.shape[1], len(cols_J)))
+    np.add.at(D, (pos_I, pos_J), delta)
+    Z = G @ D
+    try:
+        return supply - Z @ np.linalg.solve(np.eye(len(cols_J)) + Z[cols_J, :], supply[cols_J])
+    except np.linalg.LinAlgError:
+        return None
+
+
+def _matrix_delta(matrix, changes):
+    """
+    Rows, columns and differences (changed elements x scenarios) between the new values in `changes`
+    and the values of `matrix`.
+    """
+    if changes is None:
+        return np.zeros(0, dtype=int), np.zeros(0, dtype=int), np.zeros((0, 0))
+    rows, cols, values = changes
+    values = np.asarray(values, dtype=float).reshape(len(rows), -1)
+
+    # If an element is changed more than once, the last value is used
+    last = {}
+    for i, element in enumerate(zip(rows, cols)):
+        last[element] = i
+    keep = sorted(last.values())
+    rows = np.asarray(rows, dtype=int)[keep]
+    cols = np.asarray(cols, dtype=int)[keep]
+    values = values[keep]
+    base = np.asarray(matrix[rows, cols]).ravel() if len(rows) else np.zeros(0)
+    return rows, cols, values - base[:, None]
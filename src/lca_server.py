@@ -0,0 +1,309 @@
+"""
+Local LCA calculation server that keeps the matrices of a matrix bundle (see `lca_engine`) and the factorization
+of its technosphere matrix in memory, and answers requests over HTTP on localhost
+
+The bundle is loaded, factorized and its unit scores are computed when the server starts, so that requests only
+need solves with the existing factorization (or none). Requests and responses are JSON; the keys of products,
+activities and elementary flows are lists (e.g., ["biomethane-to-ammonia", "<code>"]). The operations are
+implemented in `handle_request`, which is also used by the client in `results_analysis` to compute the same
+results in-process when no server is running. The server does not need Brightway nor a network connection.
+
+Usage (from the root directory of the repository):
+    python -m src.lca_server path/to/bundle --port 8765
+
+Operations (POST /<operation>; the payload can include "bundle_dir" to check that the server calculates this bundle):
+    - multi_lcia: {"demands": [[label, key, amount], ...]}
+    - system_contribution: {"key": key, "amount": 1}
+    - supply_chain_contribution: {"key": key, "amount": 1, "rules": null, "max_depth": 5, "cutoff": 0.01,
+                                  "max_nodes": 10000, "impact": 0}
+    - scenario_deltas: {"demands": [[label, key, amount], ...],
+                        "technosphere": [[input key, activity key, [amount in each scenario]], ...],
+                        "biosphere": [[flow key, activity key, [amount in each scenario]], ...]}
+    - info (GET /info): description of the bundle
+"""
+
+import argparse
+import json
+import threading
+import time
+import http.client
+import numpy as np
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+from . import lca_engine
+from . import lca_matrices
+
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8765
+
+
+def handle_request(bundle, operation, payload):
+    """
+    Result of an operation on a bundle, as JSON-compatible data (see the operations in the module docstring).
+
+    Parameters:
+    - bundle (MatrixBundle): Bundle of the calculations.
+    - operation (str): Name of the operation.
+    - payload (dict): Parameters of the operation.
+
+    Returns:
+    - result (dict): Result of the operation.
+    """
+    if operation not in OPERATIONS:
+        raise ValueError(f"Unknown operation {operation}; the operations are {sorted(OPERATIONS)}.")
+    return OPERATIONS[operation](bundle, payload)
+
+
+def warm_bundle(bundle):
+    """
+    Factorize the technosphere matrix of a bundle and compute its unit scores, which are kept in the bundle.
+    """
+    bundle.unit_scores()
+    return bundle
+
+
+def _multi_lcia(bundle, payload):
+    labels, demands = _demands(bundle, payload['demands'])
+    scores = bundle.multi_lcia_batch({j: demand for j, demand in enumerate(demands)})
+    return {'labels': labels,
+            'impacts': list(bundle.impacts),
+            'scores': [[float(scores[j][impact]) for impact in bundle.impacts] for j in range(len(labels))]}
+
+
+def _system_contribution(bundle, payload):
+    contributions = bundle.system_contribution(_product_key(bundle, payload['key']), payload.get('amount', 1))
+    return {'contributions': json_compatible(contributions)}
+
+
+def _supply_chain_contribution(bundle, payload):
+    contributions, nodes = bundle.supply_chain_contribution(_product_key(bundle, payload['key']),
+                                                            payload.get('amount', 1),
+                                                            rules=payload.get('rules'),
+                                                            max_depth=payload.get('max_depth', 5),
+                                                            cutoff=payload.get('cutoff', 0.01),
+                                                            max_nodes=payload.get('max_nodes', 10000),
+                                                            impact=payload.get('impact', 0))
+    return {'impacts': list(bundle.impacts), 'contributions': json_compatible(contributions), 'nodes': json_compatible(nodes)}
+
+
+def _scenario_deltas(bundle, payload):
+    """
+    Scores of the demands in scenarios that change some exchange amounts, and their difference to the base scores.
+    Technosphere inputs are given as positive amounts (as in Brightway); the production exchange of an activity
+    is given with the key of the activity as input.
+    """
+    labels, demands = _demands(bundle, payload['demands'])
+    changes = {}
+    for matrix, row_dict in (('technosphere', bundle.product_dict), ('biosphere', bundle.biosphere_dict)):
+        entries = payload.get(matrix) or []
+        if not entries:
+            continue
+        rows, cols, values = [], [], []
+        for input_key, activity_key, amounts in entries:
+            input_key, activity_key = tuple(input_key), tuple(activity_key)
+            if input_key not in row_dict or activity_key not in bundle.activity_dict:
+                raise ValueError(f"Unknown exchange from {input_key} to {activity_key}.")
+            rows.append(row_dict[input_key])
+            cols.append(bundle.activity_dict[activity_key])
+            # Inputs are negative in the technosphere matrix
+            sign = -1 if matrix == 'technosphere' and input_key != activity_key else 1
+            values.append(sign * np.asarray(amounts, dtype=float))
+        changes[matrix] = (rows, cols, np.vstack(values))
+
+    # The numbers of scenarios of the technosphere and biosphere changes are checked by `scenario_scores`
+    number_scenarios = max((values.shape[1] for _, _, values in changes.values()), default=0)
+    base = np.zeros((len(labels), len(bundle.impacts)))
+    scenarios = np.zeros((len(labels), number_scenarios, len(bundle.impacts)))
+    for j, (key, amount) in enumerate(demands):
+        demand = np.zeros(len(bundle.product_dict))
+        demand[bundle.product_dict[key]] = amount
+        base[j] = bundle.characterization @ (bundle.biosphere_matrix @ bundle.lu.solve(demand))
+        if number_scenarios:
+            scenarios[j] = lca_matrices.scenario_scores(bundle.technosphere_matrix, bundle.biosphere_matrix,
+                                                        bundle.characterization, demand,
+                                                        technosphere_changes=changes.get('technosphere'),
+                                                        biosphere_changes=changes.get('biosphere'),
+                                                        lu=bundle.lu)
+
+    return {'labels': labels,
+            'impacts': list(bundle.impacts),
+            'base': base.tolist(),
+            'scores': scenarios.tolist(),
+            'deltas': (scenarios - base[:, None, :]).tolist()}
+
+
+def _info(bundle, payload):
+    return {'impacts': list(bundle.impacts),
+            'products': len(bundle.product_dict),
+            'biosphere_flows': len(bundle.biosphere_dict),
+            'bundle_dir': getattr(bundle, 'bundle_dir', None)}
+
+
+OPERATIONS = {'multi_lcia': _multi_lcia,
+              'system_contribution': _system_contribution,
+              'supply_chain_contribution': _supply_chain_contribution,
+              'scenario_deltas': _scenario_deltas,
+              'info': _info}
+
+
+def _product_key(bundle, key):
+    key = tuple(key)
+    if key not in bundle.product_dict:
+        raise ValueError(f"Unknown product {key}.")
+    return key
+
+
+def _demands(bundle, demands):
+    labels = [label for label, _, _ in demands]
+    return labels, [(_product_key(bundle, key), float(amount)) for _, key, amount in demands]
+
+
+def json_compatible(data):
+    """
+    Convert dictionaries, tuples and NumPy values to JSON-compatible data (keys are converted to strings).
+    """
+    if isinstance(data, dict):
+        return {str(key): json_compatible(value) for key, value in data.items()}
+    if isinstance(data, (list, tuple)):
+        return [json_compatible(value) for value in data]
+    if isinstance(data, np.ndarray):
+        return data.tolist()
+    if isinstance(data, np.generic):
+        return data.item()
+    return data
+
+
+class LCARequestHandler(BaseHTTPRequestHandler):
+    """
+    Handler of the requests of `serve`: GET /info and POST /<operation> with a JSON payload.
+    """
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately: without Nagle's algorithm, small responses are not delayed
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        self._respond(self.path.strip('/'), {})
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        try:
+            payload = json.loads(self.rfile.read(length) or b'{}')
+        except json.JSONDecodeError as err:
+            return self._send(400, {'error': f"Invalid JSON: {err}"})
+        self._respond(self.path.strip('/'), payload)
+
+    def _respond(self, operation, payload):
+        start = time.perf_counter()
+        bundle_dir = payload.pop('bundle_dir', None)
+        if bundle_dir is not None and str(Path(bundle_dir).resolve()) != self.server.bundle.bundle_dir:
+            return self._send(409, {'error': f"The server calculates the bundle {self.server.bundle.bundle_dir}, "
+                                             f"not {bundle_dir}."})
+        try:
+            # The factorization is shared by the threads of the server
+            with self.server.lock:
+                result = handle_request(self.server.bundle, operation, payload)
+        except (ValueError, KeyError, TypeError) as err:
+            return self._send(400, {'error': f"{type(err).__name__}: {err}"})
+        except Exception as err:
+            return self._send(500, {'error': f"{type(err).__name__}: {err}"})
+        result['elapsed_ms'] = 1000 * (time.perf_counter() - start)
+        self._send(200, result)
+
+    def _send(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+def make_server(bundle_dir, host=DEFAULT_HOST, port=DEFAULT_PORT, verbose=False):
+    """
+    Load and warm a bundle (see `warm_bundle`) and create a server for it (not started; see `serve`).
+    Use port 0 to select a free port (`server.server_address`).
+    """
+    bundle = warm_bundle(lca_engine.load_matrix_bundle(bundle_dir))
+    bundle.bundle_dir = str(Path(bundle_dir).resolve())
+
+    server = ThreadingHTTPServer((host, port), LCARequestHandler)
+    server.daemon_threads = True
+    server.bundle = bundle
+    server.lock = threading.Lock()
+    server.verbose = verbose
+    return server
+
+
+def serve(bundle_dir, host=DEFAULT_HOST, port=DEFAULT_PORT, verbose=False):
+    """
+    Serve the calculations of a bundle until interrupted.
+    """
+    server = make_server(bundle_dir, host, port, verbose)
+    print(f"Serving {server.bundle.bundle_dir} on http://{server.server_address[0]}:{server.server_address[1]}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+# Open connections to the servers (see `request`), reused between requests
+_connections = {}
+
+
+def request(operation, payload=None, host=DEFAULT_HOST, port=DEFAULT_PORT, timeout=60):
+    """
+    Send a request to a server and return its result.
+
+    A request on a connection closed or reset by the server is retried once with a new connection; other errors
+    (e.g., a timeout while the server calculates) are not retried.
+
+    Raises ConnectionError (OSError) if no server is reachable, TimeoutError if the server did not respond within
+    `timeout` seconds and ValueError if the server rejected the request or failed.
+    """
+    body = json.dumps(json_compatible(payload or {})).encode()
+    for attempt in range(2):
+        connection = _connections.get((host, port))
+        if connection is None:
+            connection = _connections[(host, port)] = http.client.HTTPConnection(host, port, timeout=timeout)
+        try:
+            connection.request('POST', f"/{operation}", body=body, headers={'Content-Type': 'application/json'})
+            response = connection.getresponse()
+            result = json.loads(response.read())
+            break
+        except (ConnectionRefusedError, ConnectionResetError, BrokenPipeError) as err:
+            # The connection may have been closed by the server (http.client.RemoteDisconnected is a
+            # ConnectionResetError): retry once with a new connection
+            connection.close()
+            del _connections[(host, port)]
+            if attempt == 1:
+                raise ConnectionError(f"No LCA server on {host}:{port}.") from err
+        except (OSError, http.client.HTTPException):
+            connection.close()
+            del _connections[(host, port)]
+            raise
+
+    if response.status != 200:
+        raise ValueError(result.get('error', f"Request failed with status {response.status}."))
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m src.lca_server", description=__doc__.splitlines()[1])
+    parser.add_argument('bundle_dir', help="directory of the matrix bundle (see results_analysis.export_matrix_bundle)")
+    parser.add_argument('--host', default=DEFAULT_HOST)
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--verbose', action='store_true', help="log the requests")
+    args = parser.parse_args(argv)
+    serve(args.bundle_dir, args.host, args.port, args.verbose)
+
+
+if __name__ == '__main__':
+    main()
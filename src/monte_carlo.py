@@ -0,0 +1,244 @@
+"""
+Monte Carlo propagation of the uncertainty of the technosphere and biosphere matrices on a matrix bundle
+(see `lca_engine`), without Brightway
+
+The uncertain values are sampled for a block of iterations at once. Blocks are solved in-process or in a pool of
+worker processes that load the bundle once. The technosphere matrix of every iteration is factorized in full: only
+the column ordering of the deterministic technosphere matrix is reused (the fill-reducing ordering step is skipped),
+since the values of all the uncertain exchanges change in every iteration and SuperLU has no numeric-only
+refactorization. The scores are written to disk block by block, so an interrupted run can be resumed, and the
+statistics are computed afterwards by reading the file one demand at a time.
+"""
+
+import json
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from numpy.lib.format import open_memmap
+from pathlib import Path
+from scipy import sparse
+from scipy.sparse.linalg import splu
+
+from . import lca_engine
+from . import lca_matrices
+
+
+def monte_carlo(bundle_dir, demands, iterations, output_dir, block_size=100, processes=None, seed=None):
+    """
+    Monte Carlo scores of several demands, with the same samples for all demands in each iteration.
+
+    The run is stored in `output_dir`: the scores (iterations x demands x impact categories) in "scores.npy",
+    the completed blocks in "blocks.npy" and the settings in "run.json". If `output_dir` has an unfinished run
+    with the same settings, only the missing blocks are calculated.
+
+    Parameters:
+    - bundle_dir (str or Path): Directory of a matrix bundle with uncertainty parameters
+                                (see `results_analysis.export_matrix_bundle`).
+    - demands (dict): Demands as {label: (key, amount)}, with the keys of the products in the bundle.
+    - iterations (int): Number of iterations.
+    - output_dir (str or Path): Directory of the run.
+    - block_size (int): Number of iterations sampled and solved together. Defaults to 100.
+    - processes (int): Number of worker processes. Defaults to None (serial run in this process).
+    - seed (int): Seed of the random numbers; each block uses its own stream derived from the seed and
+                  the block number. Defaults to None (a random seed, stored in "run.json").
+
+    Returns:
+    - statistics (dict): See `monte_carlo_statistics`.
+    """
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    labels = list(demands)
+    number_blocks = -(-iterations // block_size)
+
+    run = {'bundle_dir': str(Path(bundle_dir).resolve()),
+           'demands': [[str(label), list(demands[label][0]), demands[label][1]] for label in labels],
+           'iterations': iterations,
+           'block_size': block_size}
+
+    run_filepath = output_dir / "run.json"
+    if run_filepath.exists():
+        with open(run_filepath) as f:
+            previous_run = json.load(f)
+        if {k: v for k, v in previous_run.items() if k != 'seed'} != run or \
+                (seed is not None and previous_run['seed'] != seed):
+            raise ValueError(f"{output_dir} has a Monte Carlo run with different settings.")
+        run['seed'] = previous_run['seed']
+        scores = open_memmap(output_dir / "scores.npy", mode='r+')
+        completed = np.load(output_dir / "blocks.npy")
+    else:
+        run['seed'] = int(np.random.SeedSequence(seed).entropy % 2**63) if seed is None else seed
+        bundle = lca_engine.load_matrix_bundle(bundle_dir)
+        scores = open_memmap(output_dir / "scores.npy", mode='w+', dtype=np.float64,
+                             shape=(iterations, len(labels), len(bundle.impacts)))
+        scores[:] = np.nan
+        completed = np.zeros(number_blocks, dtype=bool)
+        np.save(output_dir / "blocks.npy", completed)
+        with open(run_filepath, 'w') as f:
+            json.dump(run, f)
+
+    keys = [tuple(demands[label][0]) for label in labels]
+    amounts = [demands[label][1] for label in labels]
+    pending = [(block, block * block_size, min(iterations, (block + 1) * block_size))
+               for block in range(number_blocks) if not completed[block]]
+
+    def save_block(block, start, block_scores):
+        scores[start:start + len(block_scores)] = block_scores
+        scores.flush()
+        completed[block] = True
+        np.save(output_dir / "blocks.npy", completed)
+
+    initargs = (bundle_dir, keys, amounts, run['seed'])
+    if processes is None:
+        _init_monte_carlo_worker(*initargs)
+        for block, start, stop in pending:
+            save_block(block, start, _monte_carlo_block_worker(block, stop - start))
+    else:
+        with ProcessPoolExecutor(max_workers=processes,
+                                 initializer=_init_monte_carlo_worker,
+                                 initargs=initargs) as executor:
+            futures = {executor.submit(_monte_carlo_block_worker, block, stop - start): (block, start)
+                       for block, start, stop in pending}
+            for future in as_completed(futures):
+                save_block(*futures[future], future.result())
+
+    del scores
+    return monte_carlo_statistics(output_dir)
+
+
+def monte_carlo_statistics(output_dir, quantiles=(0.025, 0.5, 0.975)):
+    """
+    Statistics of the completed iterations of a Monte Carlo run (see `monte_carlo`), reading the scores
+    one demand at a time. The whole file is read on every call, as the quantiles need all the scores
+    (no running moments are stored with the run).
+
+    Returns:
+    - statistics (dict): 'labels' (demands), 'iterations' (number of completed iterations), 'mean' and
+                         'variance' (demands x impact categories), 'quantiles' (the quantile levels) and
+                         'quantile_values' (quantiles x demands x impact categories).
+    """
+    output_dir = Path(output_dir)
+    with open(output_dir / "run.json") as f:
+        run = json.load(f)
+    scores = np.load(output_dir / "scores.npy", mmap_mode='r')
+    completed = np.load(output_dir / "blocks.npy")
+    rows = np.flatnonzero(np.repeat(completed, run['block_size'])[:run['iterations']])
+
+    number_demands, number_impacts = scores.shape[1:]
+    mean = np.full((number_demands, number_impacts), np.nan)
+    variance = np.full((number_demands, number_impacts), np.nan)
+    quantile_values = np.full((len(quantiles), number_demands, number_impacts), np.nan)
+    for d in range(number_demands):
+        if len(rows):
+            demand_scores = scores[rows, d, :]
+            mean[d] = demand_scores.mean(axis=0)
+            variance[d] = demand_scores.var(axis=0, ddof=1) if len(rows) > 1 else 0
+            quantile_values[:, d, :] = np.quantile(demand_scores, quantiles, axis=0)
+
+    return {'labels': [label for label, _, _ in run['demands']],
+            'iterations': len(rows),
+            'mean': mean,
+            'variance': variance,
+            'quantiles': list(quantiles),
+            'quantile_values': quantile_values}
+
+
+def sample_parameters(params, size, rng):
+    """
+    Sample the values of uncertainty parameters (see `lca_engine.PARAMETER_DTYPE`) for `size` iterations.
+
+    Lognormal (2), normal (3), uniform (4) and triangular (5) distributions are sampled; the other uncertainty
+    types are kept at their amount.
+
+    Returns:
+    - values (numpy array): Sampled values (parameters x iterations).
+    """
+    values = np.repeat(np.asarray(params['amount'], dtype=float)[:, None], size, axis=1)
+    uncertainty_type = np.asarray(params['uncertainty_type'])
+
+    lognormal = np.flatnonzero(uncertainty_type == 2)
+    if len(lognormal):
+        sampled = np.exp(rng.normal(params['loc'][lognormal][:, None], params['scale'][lognormal][:, None],
+                                    (len(lognormal), size)))
+        values[lognormal] = np.where(params['negative'][lognormal][:, None], -sampled, sampled)
+
+    normal = np.flatnonzero(uncertainty_type == 3)
+    if len(normal):
+        values[normal] = rng.normal(params['loc'][normal][:, None], params['scale'][normal][:, None],
+                                    (len(normal), size))
+
+    uniform = np.flatnonzero(uncertainty_type == 4)
+    if len(uniform):
+        values[uniform] = rng.uniform(params['minimum'][uniform][:, None], params['maximum'][uniform][:, None],
+                                      (len(uniform), size))
+
+    triangular = np.flatnonzero(uncertainty_type == 5)
+    if len(triangular):
+        values[triangular] = rng.triangular(params['minimum'][triangular][:, None], params['loc'][triangular][:, None],
+                                            params['maximum'][triangular][:, None], (len(triangular), size))
+
+    return values
+
+
+def _matrix_pattern(params, shape):
+    """
+    Sparsity pattern of the matrix built from `params` (CSC, duplicates summed) and the sparse matrix
+    (non-zero elements x parameters) that sums the signed parameter values into the data of the matrix.
+    """
+    rows = np.asarray(params['row'], dtype=np.int64)
+    cols = np.asarray(params['col'], dtype=np.int64)
+    elements, position = np.unique(cols * shape[0] + rows, return_inverse=True)
+    indices = (elements % shape[0]).astype(np.int32)
+    indptr = np.searchsorted(elements // shape[0], np.arange(shape[1] + 1)).astype(np.int32)
+    aggregation = sparse.csr_matrix((np.asarray(params['sign'], dtype=float), (position, np.arange(len(params)))),
+                                    shape=(len(elements), len(params)))
+    return indices, indptr, aggregation
+
+
+# Data shared with the worker processes of `monte_carlo`
+_worker_data = {}
+
+
+def _init_monte_carlo_worker(bundle_dir, keys, amounts, seed):
+    bundle = lca_engine.load_matrix_bundle(bundle_dir)
+    if bundle.technosphere_params is None or bundle.biosphere_params is None:
+        raise ValueError(f"The bundle {bundle_dir} has no uncertainty parameters.")
+    technosphere_shape = bundle.technosphere_matrix.shape
+
+    demand = np.zeros((technosphere_shape[0], len(keys)))
+    for j, (key, amount) in enumerate(zip(keys, amounts)):
+        demand[bundle.product_dict[key], j] += amount
+
+    # Column ordering of the deterministic technosphere matrix, reused for every iteration (each iteration is
+    # still factorized in full with this ordering)
+    column_order = np.argsort(lca_matrices.factorize(bundle.technosphere_matrix).perm_c)
+
+    _worker_data.update({'bundle': bundle,
+                         'seed': seed,
+                         'demand': demand,
+                         'column_order': column_order,
+                         'technosphere_pattern': _matrix_pattern(bundle.technosphere_params, technosphere_shape),
+                         'biosphere_pattern': _matrix_pattern(bundle.biosphere_params, bundle.biosphere_matrix.shape)})
+
+
+def _monte_carlo_block_worker(block, size):
+    data = _worker_data
+    bundle = data['bundle']
+    rng = np.random.default_rng([data['seed'], block])
+
+    technosphere_values = data['technosphere_pattern'][2] @ sample_parameters(bundle.technosphere_params, size, rng)
+    biosphere_values = data['biosphere_pattern'][2] @ sample_parameters(bundle.biosphere_params, size, rng)
+
+    column_order = data['column_order']
+    block_scores = np.zeros((size, data['demand'].shape[1], len(bundle.impacts)))
+    for k in range(size):
+        technosphere_matrix = sparse.csc_matrix((technosphere_values[:, k], data['technosphere_pattern'][0],
+                                                 data['technosphere_pattern'][1]),
+                                                shape=bundle.technosphere_matrix.shape)
+        biosphere_matrix = sparse.csc_matrix((biosphere_values[:, k], data['biosphere_pattern'][0],
+                                              data['biosphere_pattern'][1]),
+                                             shape=bundle.biosphere_matrix.shape)
+        lu = splu(technosphere_matrix[:, column_order], permc_spec='NATURAL')
+        supply = np.empty_like(data['demand'])
+        supply[column_order] = lu.solve(data['demand'])
+        block_scores[k] = (bundle.characterization @ (biosphere_matrix @ supply)).T
+
+    return block_scores
@@ -0,0 +1,89 @@
+"""
+Closed-form net-zero conditions for blending strategies and CO2 removal, for arrays of carbon footprints
+(e.g., scenarios x locations)
+
+The carbon footprint of a blend and of a system with removal are linear in the blending ratio and in the removed
+amount, so the break-even points are obtained exactly with array operations instead of interpolating on a grid.
+"""
+
+import numpy as np
+
+
+# Status of the net-zero solutions
+FEASIBLE = 0        # net zero is reached within the allowed range
+NET_NEGATIVE = 1    # the footprint without biomethane/removal is already zero or negative
+INFEASIBLE = 2      # net zero cannot be reached within the allowed range
+
+STATUS_LABELS = {FEASIBLE: 'feasible', NET_NEGATIVE: 'net-negative', INFEASIBLE: 'infeasible'}
+
+
+def blending_footprint(cf_biomethane, cf_fossil, ratios):
+    """
+    Carbon footprint of the natural gas-biomethane blend for blending ratios (share of biomethane, 0-100%).
+
+    Parameters:
+    - cf_biomethane, cf_fossil (numpy arrays): Carbon footprint with biomethane and with natural gas (same shape).
+    - ratios (numpy array): Blending ratios (%).
+
+    Returns:
+    - footprint (numpy array): Carbon footprint with shape cf_fossil.shape + ratios.shape.
+    """
+    cf_biomethane = np.asarray(cf_biomethane, dtype=float)[..., None]
+    cf_fossil = np.asarray(cf_fossil, dtype=float)[..., None]
+    shares = np.asarray(ratios, dtype=float).ravel() / 100
+    footprint = (1 - shares) * cf_fossil + shares * cf_biomethane
+    return footprint.reshape(footprint.shape[:-1] + np.shape(ratios))
+
+
+def net_zero_blending_ratio(cf_biomethane, cf_fossil):
+    """
+    Share of biomethane (%) in the natural gas-biomethane blend for which the carbon footprint is zero:
+        ratio = 100 * cf_fossil / (cf_fossil - cf_biomethane)
+
+    Parameters:
+    - cf_biomethane, cf_fossil (numpy arrays): Carbon footprint with biomethane and with natural gas (broadcastable).
+
+    Returns:
+    - ratio (numpy array): Net-zero blending ratio (%); 0 if the footprint with natural gas is already zero or negative
+                           and NaN if net zero is not reached with 100% biomethane.
+    - status (numpy array): FEASIBLE, NET_NEGATIVE or INFEASIBLE.
+    """
+    cf_biomethane, cf_fossil = np.broadcast_arrays(np.asarray(cf_biomethane, dtype=float),
+                                                   np.asarray(cf_fossil, dtype=float))
+    status = np.where(cf_fossil <= 0, NET_NEGATIVE, np.where(cf_biomethane <= 0, FEASIBLE, INFEASIBLE))
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratio = 100 * cf_fossil / (cf_fossil - cf_biomethane)
+    ratio = np.where(status == FEASIBLE, ratio, np.where(status == NET_NEGATIVE, 0.0, np.nan))
+
+    return ratio, status
+
+
+def net_zero_removal(cf_system, cf_removal, max_amount=None):
+    """
+    Amount of CO2 removal (e.g., kg CO2 captured by DACCS) per functional unit for which the carbon footprint of the
+    system is zero:
+        amount = -cf_system / cf_removal
+
+    Parameters:
+    - cf_system (numpy array): Carbon footprint of the system without removal.
+    - cf_removal (numpy array): Carbon footprint of one unit of removal (negative for a net removal), broadcastable.
+    - max_amount (float): Maximum amount of removal. Defaults to None (no maximum).
+
+    Returns:
+    - amount (numpy array): Net-zero removal amount; 0 if the system is already zero or negative and NaN if
+                            net zero cannot be reached (the removal is not net-negative or above `max_amount`).
+    - status (numpy array): FEASIBLE, NET_NEGATIVE or INFEASIBLE.
+    """
+    cf_system, cf_removal = np.broadcast_arrays(np.asarray(cf_system, dtype=float),
+                                                np.asarray(cf_removal, dtype=float))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        amount = np.where(cf_removal < 0, -cf_system / cf_removal, np.nan)
+
+    feasible = cf_removal < 0
+    if max_amount is not None:
+        feasible &= amount <= max_amount
+    status = np.where(cf_system <= 0, NET_NEGATIVE, np.where(feasible, FEASIBLE, INFEASIBLE))
+    amount = np.where(status == FEASIBLE, amount, np.where(status == NET_NEGATIVE, 0.0, np.nan))
+
+    return amount, status
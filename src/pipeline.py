@@ -0,0 +1,667 @@
+"""
+Command-line pipeline that imports the LCIs and calculates the results of notebooks 02 to 04
+
+The pipeline is a graph of stages. Each stage declares its inputs (data files, Brightway databases, settings and
+upstream stages) and its outputs (tables written as csv files and appended to the results store, see
+`results_store`, under the id of the pipeline run). The result of a stage is stored in a cache with
+the hash of its inputs and code: the hashes of the data files, the modification time of the databases, the
+settings, the hashes of the outputs of the upstream stages and the source code of the stage and of the modules
+it uses. A stage only runs again when one of these hashes changes; stages whose upstream stages are done run in
+parallel in a pool of worker processes.
+
+Usage (from the root directory of the repository):
+    python -m src.pipeline                      # run all the stages
+    python -m src.pipeline net_zero_blending    # run a stage and the stages it depends on
+    python -m src.pipeline --force lci          # run a stage regardless of the cache (the stages that depend on it
+                                                # run again only if its outputs change)
+    python -m src.pipeline --list               # list the stages
+"""
+
+import argparse
+import hashlib
+import inspect
+import json
+import os
+import pickle
+import time
+import numpy as np
+import pandas as pd
+import brightway2 as bw
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from pathlib import Path
+
+from . import inventory_imports
+from . import results_analysis
+from . import net_zero
+from . import lca_matrices
+from . import lca_engine
+from . import results_store
+from . import config as project_config
+
+
+DEFAULT_CONFIG = {
+    'project': project_config.BW_PROJECT,
+    'ecoinvent_db': project_config.ECOINVENT_DB,
+    'lci_db': project_config.LCI_DB,
+    'data_dir': str(project_config.DATA_DIR),
+    'lcia_methods': project_config.LCIA_METHODS,
+    'ipcc_impact': project_config.IPCC_IMPACT,
+    'inventories': project_config.INVENTORIES,
+    'biomethane_fossil_match': project_config.BIOMETHANE_FOSSIL_MATCH,
+    'ds_to_regionalize': project_config.DS_TO_REGIONALIZE,
+    'feedstock_match': project_config.FEEDSTOCK_MATCH,
+    'ammonia_nitrogen_content': project_config.AMMONIA_NITROGEN_CONTENT,
+    'cf_n2o': project_config.CF_N2O,
+    'n2o_emission_factors': project_config.N2O_EMISSION_FACTORS,
+    'daccs_name': 'carbon dioxide capture, from atmosphere, solid sorbents with heat pumps, with transport and storage, '
+                  '200 km pipeline storage 1000m',
+    'netzero_scenarios': {
+        'Natural gas + CCS Syngas + CCS Heating': 'Ammonia production from natural gas with CCS',
+        'Green H2': 'Ammonia production from green H2',
+    },
+    'blending_scenario': ('Natural gas + CCS Syngas + CCS Heating', 'Biomethane + CCS Upgrading + CCS Syngas + CCS Heating'),
+    'oat_products': [
+        "biogas",
+        "animal manure",
+        "oat forage, sequential crop",
+        "biomethane, 24 bar",
+        "heat, district or industrial",
+        "carbon dioxide capture, chemical absorption, with transport and storage, 200 km pipeline sotage 1000m",
+        "carbon dioxide transport and storage, 200 km pipeline, storage 1000m",
+    ],
+}
+
+
+class Stage:
+    """
+    Stage of the pipeline.
+
+    Attributes:
+        - name (str): Name of the stage.
+        - func (function): Function of the stage, called as func(config, upstream) with the results of the upstream
+                           stages as {stage: result}. It returns the outputs as {output: DataFrame}.
+        - outputs (list): Names of the outputs (csv files written in the output directory).
+        - upstream (list): Names of the stages whose results are used by the stage.
+        - files (list): Data files read by the stage (relative to the data directory).
+        - databases (list): Settings with the names of the Brightway databases read by the stage.
+        - settings (list): Settings (keys of the configuration) used by the stage.
+        - modules (list): Modules of `src` used by the stage; their source code is part of the code hash.
+        - store (dict): Outputs appended to the results store as {output: (dimensions, fixed dimensions)}
+                        (see `results_store.tidy_results`); the fixed values are formatted with the settings.
+    """
+
+    def __init__(self, name, func, outputs, upstream=(), files=(), databases=(), settings=(), modules=(), store=None):
+        self.name = name
+        self.func = func
+        self.outputs = list(outputs)
+        self.upstream = list(upstream)
+        self.files = list(files)
+        self.databases = list(databases)
+        self.settings = list(settings)
+        self.modules = list(modules)
+        self.store = dict(store or {})
+
+
+def lci_stage(config, upstream):
+    """
+    Import the LCIs, regionalize them and write the LCI database (notebook 02).
+    """
+    data_dir = Path(config['data_dir'])
+    ei_db = inventory_imports.extract_database_snapshot(config['ecoinvent_db'])
+    biosphere_db = inventory_imports.extract_biosphere_snapshot('biosphere3')
+
+    lci_path = data_dir / "inventories.xlsx"
+    lci_import = bw.ExcelImporter(lci_path)
+    lci_import.apply_strategies()
+    lci_import.match_database(config['ecoinvent_db'], fields=('name', 'reference product', 'unit', 'location'))
+    lci_import.match_database("biosphere3", fields=('name', 'unit', 'categories'))
+
+    lci_db = lci_import.data
+    for sheet in ['LCI_Upgrading', 'LCI_Heat', 'LCI_Ammonia_NG&Biomethane']:
+        inventories_df = pd.read_excel(lci_path, sheet_name=sheet, skiprows=1).fillna(0)
+        lci_db += inventory_imports.create_dataset_from_df(inventories_df)
+
+    inventory_imports.assign_deterministic_codes(lci_db)
+    inventory_imports.correct_product_in_exchanges(lci_db)
+    inventory_imports.link_exchanges_by_code(lci_db, ei_db, biosphere_db)
+
+    biogas_market_by_country = _biogas_market_by_country(data_dir)
+    countries = project_config.countries(data_dir)
+    lci_db_regional = inventory_imports.regionalize_inventories([tuple(ds) for ds in config['ds_to_regionalize']],
+                                                                countries,
+                                                                ei_db + lci_db,
+                                                                lci_db[0]['database'],
+                                                                seed=0)
+
+    # Country-specific markets for biogas
+    for ds in filter(lambda ds: ds["name"] == 'market for biogas, sustainable feedstocks', lci_db_regional):
+        for exc in filter(lambda x: x["type"] == "technosphere", ds["exchanges"]):
+            exc.update({'amount': biogas_market_by_country.loc[ds['location']][config['feedstock_match'][exc['name']]]})
+
+    inventory_imports.write_database_incremental(lci_db + lci_db_regional, config['lci_db'])
+
+    content_hashes = bw.databases[config['lci_db']]['content_hashes']
+    return {'LCI database content hashes': pd.DataFrame({'code': list(content_hashes),
+                                                         'hash': list(content_hashes.values())})}
+
+
+def rer_contribution_stage(config, upstream):
+    """
+    Contribution of the system components to the carbon footprint of ammonia production in Europe (notebook 03).
+    """
+    activities = results_analysis.activities_by_key(config['lci_db'])
+    ipcc_method = {config['ipcc_impact']: tuple(config['lcia_methods'][config['ipcc_impact']])}
+
+    carbon_footprint = {}
+    for inv, (name, product) in config['inventories'].items():
+        lca_results = results_analysis.lcia_system_contribution(activities[(name, product, 'RER')], ipcc_method)
+        carbon_footprint[inv] = lca_results[config['ipcc_impact']]
+
+    return {'Fig 2 Carbon footprint ammonia production Europe average': pd.DataFrame(carbon_footprint)}
+
+
+def footprint_with_use_stage(config, upstream):
+    """
+    Carbon footprint of ammonia in Europe including the N2O emissions of its use as fertilizer or fuel (notebook 03).
+    """
+    carbon_footprint = upstream['rer_contribution']['Fig 2 Carbon footprint ammonia production Europe average']
+    use_impacts = project_config.n2o_use_impacts(config['ammonia_nitrogen_content'], config['cf_n2o'],
+                                                 config['n2o_emission_factors'])
+
+    carbon_footprint_with_use = pd.DataFrame({use: carbon_footprint.loc['Total'] + impact
+                                              for use, impact in use_impacts.items()})
+    return {'SI Carbon footprint ammonia production Europe average with usage': carbon_footprint_with_use}
+
+
+def country_footprints_stage(config, upstream):
+    """
+    Carbon footprint of ammonia production in every country, solved with one factorization (notebook 03).
+    """
+    activities = results_analysis.activities_by_key(config['lci_db'])
+    ipcc_method = {config['ipcc_impact']: tuple(config['lcia_methods'][config['ipcc_impact']])}
+    countries = project_config.countries(config['data_dir'])
+    scenarios = [inv for inv in config['inventories'] if inv != 'Green H2']
+
+    demands = {(inv, country): (activities[(*config['inventories'][inv], country)], 1)
+               for inv in scenarios for country in countries}
+    impacts_country = results_analysis.multi_lcia_batch(demands, ipcc_method, names=['Scenario', 'Location'])
+    carbon_footprint_country = impacts_country[config['ipcc_impact']].unstack('Scenario').loc[countries, scenarios]
+
+    return {'Carbon footprint ammonia production by country': carbon_footprint_country,
+            'Fig 3 Country-specific carbon footprint ammonia production':
+                carbon_footprint_country[list(config['biomethane_fossil_match'])]}
+
+
+def net_zero_blending_stage(config, upstream):
+    """
+    Share of biomethane in the natural gas-biomethane blend for net-zero ammonia production, for the European
+    average and every country (notebook 03).
+    """
+    carbon_footprint_rer = upstream['rer_contribution']['Fig 2 Carbon footprint ammonia production Europe average']
+    carbon_footprint_country = upstream['country_footprints']['Carbon footprint ammonia production by country']
+    scenarios = list(config['biomethane_fossil_match'])
+    fossil_scenarios = [config['biomethane_fossil_match'][scenario] for scenario in scenarios]
+
+    carbon_footprint_locations = pd.concat([
+        carbon_footprint_rer.loc[['Total']].rename(index={'Total': 'Europe'}),
+        carbon_footprint_country.rename(index=results_analysis.countries_iso_match(carbon_footprint_country.index))])
+    ratio, status = net_zero.net_zero_blending_ratio(carbon_footprint_locations[scenarios].to_numpy(),
+                                                     carbon_footprint_locations[fossil_scenarios].to_numpy())
+
+    return {'Fig 4 Net-zero blending ratios': pd.DataFrame(ratio, index=carbon_footprint_locations.index,
+                                                           columns=scenarios),
+            'Net-zero blending status': pd.DataFrame(status, index=carbon_footprint_locations.index,
+                                                     columns=scenarios).replace(net_zero.STATUS_LABELS)}
+
+
+def net_zero_lcia_stage(config, upstream):
+    """
+    Impacts of the net-zero ammonia scenarios in Europe: DACCS with natural gas + CCS or green H2, and the
+    blending strategy (notebook 03).
+    """
+    activities = results_analysis.activities_by_key(config['lci_db'])
+    lcia_methods = {impact: tuple(method) for impact, method in config['lcia_methods'].items()}
+    ipcc_impact = config['ipcc_impact']
+    fossil_scenario, biomethane_scenario = config['blending_scenario']
+
+    target_inventories = list(dict.fromkeys(list(config['netzero_scenarios']) + [biomethane_scenario]))
+    daccs = [a for label, a in activities.items() if label[0] == config['daccs_name']][0]
+    demands = {inv: (activities[(*config['inventories'][inv], 'RER')], 1) for inv in target_inventories}
+    demands['DACCS'] = (daccs, 1)
+    scores = results_analysis.multi_lcia_batch(demands, lcia_methods)
+
+    daccs_amounts, _ = net_zero.net_zero_removal(scores.loc[list(config['netzero_scenarios']), ipcc_impact].to_numpy(),
+                                                 scores.loc['DACCS', ipcc_impact])
+    blend_ratio = upstream['net_zero_blending']['Fig 4 Net-zero blending ratios'].loc['Europe', biomethane_scenario]
+
+    impacts = [impact for impact in lcia_methods if impact != ipcc_impact]
+    netzero_lcia = {}
+    for (scenario, component), daccs_amount in zip(config['netzero_scenarios'].items(), daccs_amounts):
+        for impact in impacts:
+            impact_ammonia = scores.loc[scenario, impact]
+            impact_daccs = daccs_amount * scores.loc['DACCS', impact]
+            netzero_lcia[(scenario, impact)] = {'Total': impact_ammonia + impact_daccs,
+                                                component: impact_ammonia,
+                                                'DACCS': impact_daccs}
+    # Share of each source in the impacts of the blend (the blend with the impacts of the other source set to zero)
+    impacts_ng = net_zero.blending_footprint(np.zeros(len(impacts)), scores.loc[fossil_scenario, impacts].to_numpy(),
+                                             blend_ratio)
+    impacts_biomethane = net_zero.blending_footprint(scores.loc[biomethane_scenario, impacts].to_numpy(),
+                                                     np.zeros(len(impacts)), blend_ratio)
+    for impact, impact_ng, impact_biomethane in zip(impacts, impacts_ng, impacts_biomethane):
+        netzero_lcia[('Blending strategy', impact)] = {'Total': impact_ng + impact_biomethane,
+                                                       'Ammonia production from natural gas with CCS': impact_ng,
+                                                       'Ammonia production from biomethane with CCS': impact_biomethane}
+
+    netzero_lcia_df = pd.DataFrame.from_dict(netzero_lcia, orient='index')
+    netzero_lcia_df.index.names = ['Scenario', 'Category']
+
+    # Impacts relative to the maximum total impact of the scenarios (0 if the maximum is 0)
+    max_impacts = netzero_lcia_df.groupby('Category')['Total'].transform('max')
+    netzero_lcia_relative_df = netzero_lcia_df.div(max_impacts, axis=0).where(max_impacts != 0, 0, axis=0)
+
+    return {'Fig 5 LCIA net zero ammonia scenarios absolute': netzero_lcia_df,
+            'Fig 5 LCIA net zero ammonia scenarios relative': netzero_lcia_relative_df}
+
+
+def sa_methane_leakage_stage(config, upstream):
+    """
+    Sensitivity analysis of the carbon footprint of bio-ammonia to the methane leakage (notebook 04).
+    """
+    results = _scenario_sensitivity(config, Path(config['data_dir']) / "SA_methane leakage_for presample.xlsx",
+                                    {config['ipcc_impact']: tuple(config['lcia_methods'][config['ipcc_impact']])})
+    results_df = pd.DataFrame({scenario: {key: value[config['ipcc_impact']] for key, value in scores.items()}
+                               for scenario, scores in results.items()}).T
+    results_df.insert(0, 'default', results_df.pop('default'))
+    results_df.index.name = 'Scenario'
+
+    return {'SI Sensitivity analysis carbon footprint ammonia methane leakage': results_df}
+
+
+def sa_upgrading_technology_stage(config, upstream):
+    """
+    Sensitivity analysis of the impacts of bio-ammonia to the biogas upgrading technology (notebook 04).
+    """
+    lcia_methods = {impact: tuple(method) for impact, method in config['lcia_methods'].items()}
+    results = _scenario_sensitivity(config, Path(config['data_dir']) / "SA_upgrading technology_presamples.xlsx",
+                                    lcia_methods)
+    results_df = pd.DataFrame({scenario: {key: value[config['ipcc_impact']] for key, value in scores.items()}
+                               for scenario, scores in results.items()}).T
+    results_df.index.name = 'Scenario'
+
+    return {'SI Sensitivity analysis carbon footprint ammonia upgrading technology': results_df}
+
+
+def perturbation_analysis_stage(config, upstream):
+    """
+    Perturbation analysis of the carbon footprint of bio-ammonia with CCS in upgrading, syngas and heating
+    (notebook 04).
+    """
+    ipcc_method = {config['ipcc_impact']: tuple(config['lcia_methods'][config['ipcc_impact']])}
+    activities = results_analysis.activities_by_key(config['lci_db'])
+    assessed_ds = activities[(*config['inventories']['Biomethane + CCS Upgrading + CCS Syngas + CCS Heating'], 'RER')]
+
+    ds_for_oat = [a for (name, product, location), a in activities.items()
+                  if location == 'RER' and product in config['oat_products'] and 'market for' not in name
+                  and (product not in ["biomethane, 24 bar", "heat, district or industrial"] or 'w/ CCS' in name)]
+    ds_for_oat += [assessed_ds]
+
+    perturbation_results = results_analysis.perturbation_analysis_adjoint(assessed_ds, ds_for_oat, ipcc_method)
+    return {'SI Perturbation analysis carbon footprint scenario full CCS':
+                perturbation_results.set_index(['activity', 'parameter'])}
+
+
+def _biogas_market_by_country(data_dir):
+    """
+    Share of the sustainable biomethane potential in 2030 by feedstock (countries x feedstocks).
+    """
+    biomethane_potential = pd.read_excel(data_dir / "sustainable_biomethane_potential_Europe.xlsx",
+                                         sheet_name='Biomethane Potential', usecols='A:AE', index_col=[0])
+    return biomethane_potential.loc['Sustainable biomethane share by feedstock in 2030'].reset_index(
+                                    ).drop(['Parameter', 'Unit'], axis=1).set_index(['Feedstock']).T
+
+
+def _scenario_sensitivity(config, scenario_file, lcia_methods):
+    """
+    Scores of the scenarios of a presamples scenario file for the bio-ammonia datasets in Europe.
+
+    Returns:
+    - results (dict): Scores as {scenario: {scenario of the file: {impact: score}}}.
+    """
+    scenario_label, scenario_data = results_analysis.read_ps_scenario_data(scenario_file,
+                                                                           dbs=[config['ecoinvent_db'], config['lci_db']])
+    matrix_data = results_analysis.ps_matrix_data(scenario_data, scenario_label)
+
+    activities = results_analysis.activities_by_key(config['lci_db'])
+    results = {}
+    for inv, (name, product) in config['inventories'].items():
+        if "ammonia production, liquid, bio-ammonia from biomethane" not in name:
+            continue
+        ds = activities[(name, product, 'RER')]
+        results[inv] = results_analysis.calculate_impacts_with_scenarios(matrix_data, scenario_label, ds,
+                                                                         lcia_methods).to_dict()
+    return results
+
+
+STAGES = {stage.name: stage for stage in [
+    Stage('lci', lci_stage,
+          outputs=['LCI database content hashes'],
+          files=["inventories.xlsx", "sustainable_biomethane_potential_Europe.xlsx"],
+          databases=['ecoinvent_db'],
+          settings=['ecoinvent_db', 'lci_db', 'ds_to_regionalize', 'feedstock_match'],
+          modules=[inventory_imports, project_config]),
+    Stage('rer_contribution', rer_contribution_stage,
+          outputs=['Fig 2 Carbon footprint ammonia production Europe average'],
+          store={'Fig 2 Carbon footprint ammonia production Europe average':
+                     (['component', 'scenario'], {'result': 'carbon footprint', 'location': 'RER', 'impact': '{ipcc_impact}'})},
+          upstream=['lci'],
+          databases=['ecoinvent_db'],
+          settings=['lci_db', 'inventories', 'ipcc_impact', 'lcia_methods'],
+          modules=[results_analysis, lca_matrices, lca_engine]),
+    Stage('footprint_with_use', footprint_with_use_stage,
+          outputs=['SI Carbon footprint ammonia production Europe average with usage'],
+          store={'SI Carbon footprint ammonia production Europe average with usage':
+                     (['scenario', 'parameter'], {'result': 'carbon footprint with use', 'location': 'RER',
+                                                  'impact': '{ipcc_impact}'})},
+          upstream=['rer_contribution'],
+          settings=['ammonia_nitrogen_content', 'cf_n2o', 'n2o_emission_factors'],
+          modules=[project_config]),
+    Stage('country_footprints', country_footprints_stage,
+          outputs=['Carbon footprint ammonia production by country',
+                   'Fig 3 Country-specific carbon footprint ammonia production'],
+          store={'Carbon footprint ammonia production by country':
+                     (['location', 'scenario'], {'result': 'carbon footprint', 'impact': '{ipcc_impact}'})},
+          upstream=['lci'],
+          files=["sustainable_biomethane_potential_Europe.xlsx"],
+          databases=['ecoinvent_db'],
+          settings=['lci_db', 'inventories', 'ipcc_impact', 'lcia_methods', 'biomethane_fossil_match'],
+          modules=[results_analysis, lca_matrices, lca_engine, project_config]),
+    Stage('net_zero_blending', net_zero_blending_stage,
+          outputs=['Fig 4 Net-zero blending ratios', 'Net-zero blending status'],
+          store={'Fig 4 Net-zero blending ratios': (['location', 'scenario'], {'result': 'net-zero blending ratio'})},
+          upstream=['rer_contribution', 'country_footprints'],
+          settings=['biomethane_fossil_match'],
+          modules=[net_zero]),
+    Stage('net_zero_lcia', net_zero_lcia_stage,
+          outputs=['Fig 5 LCIA net zero ammonia scenarios absolute', 'Fig 5 LCIA net zero ammonia scenarios relative'],
+          store={'Fig 5 LCIA net zero ammonia scenarios absolute':
+                     (['scenario', 'impact', 'component'], {'result': 'net-zero LCIA', 'location': 'RER'}),
+                 'Fig 5 LCIA net zero ammonia scenarios relative':
+                     (['scenario', 'impact', 'component'], {'result': 'net-zero LCIA relative', 'location': 'RER'})},
+          upstream=['lci', 'net_zero_blending'],
+          databases=['ecoinvent_db'],
+          settings=['lci_db', 'inventories', 'ipcc_impact', 'lcia_methods', 'daccs_name', 'netzero_scenarios',
+                    'blending_scenario'],
+          modules=[results_analysis, lca_matrices, lca_engine, net_zero]),
+    Stage('sa_methane_leakage', sa_methane_leakage_stage,
+          outputs=['SI Sensitivity analysis carbon footprint ammonia methane leakage'],
+          store={'SI Sensitivity analysis carbon footprint ammonia methane leakage':
+                     (['scenario', 'parameter'], {'result': 'sensitivity methane leakage', 'location': 'RER',
+                                                  'impact': '{ipcc_impact}'})},
+          upstream=['lci'],
+          files=["SA_methane leakage_for presample.xlsx"],
+          databases=['ecoinvent_db'],
+          settings=['ecoinvent_db', 'lci_db', 'inventories', 'ipcc_impact', 'lcia_methods'],
+          modules=[results_analysis, lca_matrices, lca_engine]),
+    Stage('sa_upgrading_technology', sa_upgrading_technology_stage,
+          outputs=['SI Sensitivity analysis carbon footprint ammonia upgrading technology'],
+          store={'SI Sensitivity analysis carbon footprint ammonia upgrading technology':
+                     (['scenario', 'parameter'], {'result': 'sensitivity upgrading technology', 'location': 'RER',
+                                                  'impact': '{ipcc_impact}'})},
+          upstream=['lci'],
+          files=["SA_upgrading technology_presamples.xlsx"],
+          databases=['ecoinvent_db'],
+          settings=['ecoinvent_db', 'lci_db', 'inventories', 'ipcc_impact', 'lcia_methods'],
+          modules=[results_analysis, lca_matrices, lca_engine]),
+    Stage('perturbation_analysis', perturbation_analysis_stage,
+          outputs=['SI Perturbation analysis carbon footprint scenario full CCS'],
+          store={'SI Perturbation analysis carbon footprint scenario full CCS':
+                     (['component', 'parameter', 'result'], {'scenario': 'Biomethane + CCS Upgrading + CCS Syngas + CCS Heating',
+                                                             'location': 'RER', 'impact': '{ipcc_impact}'})},
+          upstream=['lci'],
+          databases=['ecoinvent_db'],
+          settings=['lci_db', 'inventories', 'ipcc_impact', 'lcia_methods', 'oat_products'],
+          modules=[results_analysis, lca_matrices, lca_engine]),
+]}
+
+
+def run_pipeline(stages=None, config=None, output_dir=None, store_dir=None, run_id=None, force=(), processes=None,
+                 stage_graph=None):
+    """
+    Run the stages of the pipeline whose cached results are missing or invalidated.
+
+    Parameters:
+    - stages (list): Names of the stages to run, with the stages they depend on. Defaults to None (all stages).
+    - config (dict): Settings that replace those of `DEFAULT_CONFIG`. Defaults to None.
+    - output_dir (str or Path): Directory of the outputs (csv files); the cache is stored in its ".cache"
+                                subdirectory. Defaults to None ("results/pipeline" in the data directory).
+    - store_dir (str or Path): Directory of the results store. Defaults to None ("results/store" in the data directory).
+    - run_id (str): Id of the run in the results store; the outputs of the stages that run and of the cached stages
+                    are appended under this id. Defaults to None (`results_store.new_run_id`).
+    - force (list): Names of the stages that run regardless of the cache. Defaults to ().
+    - processes (int): Number of worker processes. Defaults to None (serial run in this process).
+    - stage_graph (dict): Stages as {name: Stage}. Defaults to None (`STAGES`).
+
+    Returns:
+    - status (dict): Status of every stage as {name: 'cached' or 'run'}.
+    """
+    stage_graph = STAGES if stage_graph is None else stage_graph
+    config = dict(DEFAULT_CONFIG, **(config or {}))
+    output_dir = Path(config['data_dir']) / "results" / "pipeline" if output_dir is None else Path(output_dir)
+    cache_dir = output_dir / ".cache"
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    store_dir = Path(config['data_dir']) / "results" / "store" if store_dir is None else Path(store_dir)
+    run_id = results_store.new_run_id() if run_id is None else run_id
+    print(f"run {run_id}")
+
+    selected = _stage_order(stage_graph, stages)
+    output_hashes, results, status, running = {}, {}, {}, {}
+    pending = list(selected)
+
+    # The cache keys are computed in this process, with the metadata of the databases of the project
+    _init_pipeline_worker(config['project'], stage_graph)
+    executor = None
+    if processes is not None:
+        executor = ProcessPoolExecutor(max_workers=processes, initializer=_init_pipeline_worker,
+                                       initargs=(config['project'], stage_graph))
+
+    try:
+        while pending or running:
+            ready = [name for name in pending if all(dep in output_hashes for dep in stage_graph[name].upstream)]
+            if ready:
+                # Databases may have been written by the stages that ran since (e.g., in a worker process)
+                bw.databases.load()
+            for name in ready:
+                pending.remove(name)
+                stage = stage_graph[name]
+                key = stage_key(stage, config, {dep: output_hashes[dep] for dep in stage.upstream})
+                cached = _read_cache_metadata(cache_dir, name)
+                if name not in force and cached is not None and cached['key'] == key and \
+                        all((output_dir / f"{output}.csv").exists() for output in stage.outputs):
+                    output_hashes[name] = cached['output_hash']
+                    status[name] = 'cached'
+                    if stage.store:
+                        _store_stage_result(store_dir, run_id, stage, _read_cache_result(cache_dir, name), config)
+                    print(f"{name}: cached")
+                    continue
+
+                upstream = {dep: results[dep] if dep in results else _read_cache_result(cache_dir, dep)
+                            for dep in stage.upstream}
+                if executor is None:
+                    running[name] = (key, time.time(), _run_stage_worker(name, config, upstream))
+                else:
+                    running[name] = (key, time.time(), executor.submit(_run_stage_worker, name, config, upstream))
+
+            if executor is not None and running:
+                wait([future for _, _, future in running.values()], return_when=FIRST_COMPLETED)
+
+            for name in list(running):
+                key, start, result = running[name]
+                if executor is not None:
+                    if not result.done():
+                        continue
+                    result = result.result()
+                del running[name]
+                results[name] = result
+                output_hashes[name] = _write_stage_result(cache_dir, output_dir, stage_graph[name], key, result)
+                _store_stage_result(store_dir, run_id, stage_graph[name], result, config)
+                status[name] = 'run'
+                print(f"{name}: run ({time.time() - start:.1f} s)")
+
+            if pending and not running and not any(all(dep in output_hashes for dep in stage_graph[name].upstream)
+                                                   for name in pending):
+                raise ValueError(f"The stages {pending} depend on stages that are not in the pipeline.")
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    return status
+
+
+def stage_key(stage, config, upstream_hashes):
+    """
+    Hash of the inputs and code of a stage: data files, modification time of the Brightway databases, settings,
+    hashes of the outputs of the upstream stages, and source code of the stage function, of the functions of this
+    module that it calls and of the modules of the stage.
+    """
+    data_dir = Path(config['data_dir'])
+    functions = [stage.func] + [obj for obj in (globals().get(name) for name in stage.func.__code__.co_names)
+                                if inspect.isfunction(obj) and obj.__module__ == __name__]
+
+    inputs = {'code': [inspect.getsource(func) for func in functions] +
+                      [Path(inspect.getfile(module)).read_text() for module in stage.modules],
+              'files': {file: file_hash(data_dir / file) for file in stage.files},
+              'databases': {config[setting]: bw.databases[config[setting]].get('modified')
+                            for setting in stage.databases},
+              'settings': {setting: config[setting] for setting in stage.settings},
+              'upstream': upstream_hashes}
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def file_hash(filepath, chunk_size=2**20):
+    """
+    sha256 hash of the content of a file.
+    """
+    digest = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _stage_order(stage_graph, stages=None):
+    """
+    Names of the stages to run (with the stages they depend on) in topological order.
+    """
+    order, visiting = [], set()
+
+    def visit(name):
+        if name in order:
+            return
+        if name in visiting:
+            raise ValueError(f"The stage {name} depends on itself.")
+        if name not in stage_graph:
+            raise ValueError(f"Unknown stage {name}.")
+        visiting.add(name)
+        for dep in stage_graph[name].upstream:
+            visit(dep)
+        order.append(name)
+
+    for name in (stage_graph if stages is None else stages):
+        visit(name)
+    return order
+
+
+def _read_cache_metadata(cache_dir, name):
+    filepath = cache_dir / f"{name}.json"
+    if not filepath.exists() or not (cache_dir / f"{name}.pickle").exists():
+        return None
+    with open(filepath) as f:
+        return json.load(f)
+
+
+def _read_cache_result(cache_dir, name):
+    with open(cache_dir / f"{name}.pickle", 'rb') as f:
+        return pickle.load(f)
+
+
+def _write_stage_result(cache_dir, output_dir, stage, key, result):
+    """
+    Write the outputs of a stage (csv files) and its result in the cache. Returns the hash of the outputs.
+    """
+    missing = [output for output in stage.outputs if output not in result]
+    if missing:
+        raise ValueError(f"The stage {stage.name} did not return the outputs {missing}.")
+
+    digest = hashlib.sha256()
+    for output in stage.outputs:
+        filepath = output_dir / f"{output}.csv"
+        result[output].to_csv(filepath, index=not isinstance(result[output].index, pd.RangeIndex))
+        digest.update(file_hash(filepath).encode())
+
+    with open(cache_dir / f"{stage.name}.pickle", 'wb') as f:
+        pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+    with open(cache_dir / f"{stage.name}.json", 'w') as f:
+        json.dump({'key': key, 'output_hash': digest.hexdigest()}, f)
+    return digest.hexdigest()
+
+
+def _store_stage_result(store_dir, run_id, stage, result, config):
+    """
+    Append the outputs of a stage to the results store (see `Stage.store`).
+    """
+    for output, (dimensions, fixed) in stage.store.items():
+        records = results_store.tidy_results(result[output], dimensions,
+                                             **{dimension: value.format(**config) for dimension, value in fixed.items()})
+        results_store.append_results(store_dir, records, run_id)
+
+
+# Data shared with the worker processes of `run_pipeline`
+_worker_data = {}
+
+
+def _init_pipeline_worker(project, stage_graph):
+    bw.projects.set_current(project)
+    _worker_data['stage_graph'] = stage_graph
+
+
+def _run_stage_worker(name, config, upstream):
+    # The metadata of the databases (e.g., "modified" and "content_hashes") may have been changed by other processes
+    bw.databases.load()
+    return _worker_data['stage_graph'][name].func(config, upstream)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m src.pipeline", description=__doc__.splitlines()[1])
+    parser.add_argument('stages', nargs='*', help="stages to run (default: all)")
+    parser.add_argument('--force', nargs='*', default=[],
+                        help="stages that run regardless of the cache (the stages that depend on them run again "
+                             "only if their outputs change)")
+    parser.add_argument('--processes', type=int, default=min(4, os.cpu_count() or 1),
+                        help="number of worker processes (0: serial run)")
+    parser.add_argument('--project', default=DEFAULT_CONFIG['project'], help="Brightway project")
+    parser.add_argument('--data-dir', default=DEFAULT_CONFIG['data_dir'], help="data directory")
+    parser.add_argument('--output-dir', default=None, help="output directory (default: <data dir>/results/pipeline)")
+    parser.add_argument('--store-dir', default=None, help="results store (default: <data dir>/results/store)")
+    parser.add_argument('--run-id', default=None, help="id of the run in the results store (default: from the time)")
+    parser.add_argument('--list', action='store_true', help="list the stages and exit")
+    args = parser.parse_args(argv)
+
+    if args.list:
+        for name, stage in STAGES.items():
+            print(f"{name}: {inspect.getdoc(stage.func).splitlines()[0]}")
+            if stage.upstream:
+                print(f"    after: {', '.join(stage.upstream)}")
+        return
+
+    run_pipeline(stages=args.stages or None,
+                 config={'project': args.project, 'data_dir': args.data_dir},
+                 output_dir=args.output_dir,
+                 store_dir=args.store_dir,
+                 run_id=args.run_id,
+                 force=args.force,
+                 processes=args.processes or None)
+
+
+if __name__ == '__main__':
+    main()
@@ -5,10 +5,24 @@ Functions to perform LCA results analysis
 import pandas as pd
 import numpy as np
 import brightway2 as bw
+from bw2data.utils import TYPE_DICTIONARY
 import presamples as ps
 import geopandas as gpd
 import pycountry
 import copy
+import hashlib
+import json
+import pickle
+import uuid
+from pathlib import Path
+from scipy import sparse
+
+from . import inventory_imports
+from . import lca_matrices
+from . import lca_engine
+from . import monte_carlo
+from . import global_sensitivity
+from . import lca_server
 
 
 def multi_lcia(activity, lcia_methods, amount=1):
@@ -27,12 +41,73 @@ def multi_lcia(activity, lcia_methods, amount=1):
     """
     lca = bw.LCA({activity.key: amount})
     lca.lci()
-    multi_lcia_results = dict()
-    for impact in lcia_methods:
-        lca.switch_method(lcia_methods[impact])
-        lca.lcia()
-        multi_lcia_results[impact] = lca.score
-    return multi_lcia_results
+    return lcia_scores(lca, lcia_methods)
+
+
+def lcia_scores(lca, lcia_methods):
+    """
+    Calculate multiple impact categories of an LCA object whose inventory has been calculated,
+    from one product of the stacked characterization matrix with the inventory.
+
+    Parameters:
+    - lca (object): A bw.LCA object after `lci()` or `redo_lci()`.
+    - lcia_methods (dict): A dictionary of impact categories and their corresponding method.
+
+    Returns:
+    - multi_lcia_results (dict): A dictionary of impact categories and their corresponding scores.
+    """
+    characterization = characterization_matrix(lcia_methods, lca.biosphere_dict)
+    scores = characterization @ (lca.biosphere_matrix @ lca.supply_array)
+    return {impact: scores[i] for i, impact in enumerate(lcia_methods)}
+
+
+def multi_lcia_batch(demands, lcia_methods, names=None):
+    """
+    Calculate multiple impact categories for many demands at once.
+
+    A single LCA object is built for all demands, the technosphere matrix is factorized once
+    and all demands are solved together (see `lca_matrices.demand_scores`).
+
+    Parameters:
+    - demands (dict): A dictionary of demands as {label: (activity, amount)}. Labels are tuples
+                      (e.g., (scenario, country)) or single values.
+    - lcia_methods (dict): A dictionary of impact categories and their corresponding method. 
+                           The keys are the names of the impact categories and the values are the methods to be used for each category.
+    - names (list): Names of the levels of the labels (e.g., ['Scenario', 'Location']). Defaults to None.
+
+    Returns:
+    - multi_lcia_results (DataFrame): Scores with one row per demand (MultiIndex when the labels are tuples)
+                                      and one column per impact category.
+    """
+    labels = list(demands)
+    keys = [demands[label][0].key for label in labels]
+
+    lca = bw.LCA({key: 1 for key in keys})
+    lca.load_lci_data()
+    characterization = characterization_matrix(lcia_methods, lca.biosphere_dict)
+    lu = lca_matrices.factorize(lca.technosphere_matrix)
+
+    demand_matrix = sparse.csc_matrix(([demands[label][1] for label in labels],
+                                       ([lca.product_dict[key] for key in keys], list(range(len(labels))))),
+                                      shape=(len(lca.product_dict), len(labels)))
+    scores = lca_matrices.demand_scores(lu, lca.biosphere_matrix, characterization, demand_matrix)
+
+    if all(isinstance(label, tuple) for label in labels):
+        index = pd.MultiIndex.from_tuples(labels, names=names)
+    else:
+        index = pd.Index(labels, name=names[0] if names else None)
+
+    return pd.DataFrame(scores, index=index, columns=list(lcia_methods))
+
+
+def activities_by_key(db_name):
+    """
+    Map the activities of a database by (name, reference product, location) with a single pass over the database.
+
+    Returns:
+    - activities (dict): A dictionary as {(name, reference product, location): activity}.
+    """
+    return {(a['name'], a['reference product'], a['location']): a for a in bw.Database(db_name)}
 
 
 def lcia_system_contribution(activity, lcia_methods, activity_amount=1):
@@ -40,6 +115,9 @@ def lcia_system_contribution(activity, lcia_methods, activity_amount=1):
     This function computes the contribution of each system component to the total impact
     Based on: https://github.com/brightway-lca/brightway2/blob/master/notebooks/Contribution%20analysis%20and%20comparison.ipynb
 
+    The technosphere matrix is built and factorized once; the scores of the activity and of all its
+    technosphere inputs, for all impact categories, are obtained from a single solve (see `lca_matrices.unit_scores`).
+
     Parameters:
     - activity (object): An activity object representing the product or process being assessed.
     - lcia_methods (dict): A dictionary of impact categories and their corresponding method. 
@@ -50,73 +128,252 @@ def lcia_system_contribution(activity, lcia_methods, activity_amount=1):
     - system_contributions (dict): A nested dictionary of impact categories and system components and their corresponding LCIA scores.
                                    The keys are the names of the impact categories and the name of the system components, while the values are the scores.
     '''
-    system_components = ['Direct emissions',
-                         'Feedstock supply chain',
-                         'Heating',
-                         'Electricity from grid',
-                         'Other',
-                         'Total']
-    
     # Create am empty dict with the structure
     system_contributions = dict()
     for impact in lcia_methods:
         system_contributions[impact] = {}
-        for category in system_components:
+        for category in lca_engine.SYSTEM_COMPONENTS:
             system_contributions[impact][category] = 0
+
+    # Build matrices and factorize the technosphere matrix once
+    lca = bw.LCA({activity.key: activity_amount})
+    lca.load_lci_data()
+    characterization = characterization_matrix(lcia_methods, lca.biosphere_dict)
+    lu = lca_matrices.factorize(lca.technosphere_matrix)
+    scores = lca_matrices.unit_scores(lu, lca.biosphere_matrix, characterization)
     
     # Add total impact
-    multi_lcia_results = multi_lcia(activity, lcia_methods, activity_amount)
-    for impact in multi_lcia_results:
-        system_contributions[impact]['Total'] = multi_lcia_results[impact]
+    total_scores = activity_amount * scores[lca.product_dict[activity.key]]
+    for i, impact in enumerate(lcia_methods):
+        system_contributions[impact]['Total'] = total_scores[i]
                 
     # Contribution of each system component
     for exc in activity.technosphere():
         exc_amount = activity_amount * exc['amount']
+        exc_scores = exc_amount * scores[lca.product_dict[exc.input.key]]
         
-        # Feedstock supply chain
-        if exc.input['name'] in ['market group for natural gas, high pressure',
-                                 'market for biomethane, 24 bar',
-                                 'market for biomethane, 24 bar w/ CCS',
-                                 'hydrogen production, gaseous, 25 bar, from electrolysis with wind electricity',
-                                 'nitrogen gaseous, from cryogenic distillation, without compression']:
-            multi_lcia_results = multi_lcia(exc.input, lcia_methods, exc_amount)
-            for impact in multi_lcia_results:
-                system_contributions[impact]['Feedstock supply chain'] += multi_lcia_results[impact]
-        
-        # Heating
-        elif 'heat production' in exc.input['name'] or 'steam production' in exc.input['name']:
-            multi_lcia_results = multi_lcia(exc.input, lcia_methods, exc_amount)
-            for impact in multi_lcia_results:
-                system_contributions[impact]['Heating'] += multi_lcia_results[impact]            
-                        
-        # Electricity
-        elif 'market group for electricity' in exc.input['name']:
-            multi_lcia_results = multi_lcia(exc.input, lcia_methods, exc_amount)
-            for impact in multi_lcia_results:
-                system_contributions[impact]['Electricity from grid'] += multi_lcia_results[impact]    
-        
-        # Infrastructure + other utilities
-        else:
-            multi_lcia_results = multi_lcia(exc.input, lcia_methods, exc_amount)
-            for impact in multi_lcia_results:
-                system_contributions[impact]['Other'] += multi_lcia_results[impact]
+        component = lca_engine.system_component(exc.input['name'])
+
+        for i, impact in enumerate(lcia_methods):
+            system_contributions[impact][component] += exc_scores[i]
                         
     # Direct emissions
-    method_CFs = dict() # First load element flows exchanges and characterization factors into a dictionary
-    for impact in lcia_methods:
-        method_CFs[impact] = {}
-        method_CFs[impact] = {ef[0]: ef[1] for ef in bw.Method(lcia_methods[impact]).load()}
-                                 
-    for exc in activity.biosphere():
-        exc_amount = exc['amount']
-        exc_key = bw.get_activity(exc.input).key
-        for impact in lcia_methods:
-            if exc_key in method_CFs[impact]:
-                system_contributions[impact]['Direct emissions'] += exc_amount * method_CFs[impact][exc_key]
+    direct_emissions = lca.biosphere_matrix[:, lca.activity_dict[activity.key]].toarray().ravel()
+    direct_scores = activity_amount * (characterization @ direct_emissions)
+    for i, impact in enumerate(lcia_methods):
+        system_contributions[impact]['Direct emissions'] += direct_scores[i]
     
     return system_contributions
 
 
+def export_matrix_bundle(activities, lcia_methods, dirpath):
+    '''
+    Export the matrices of the system of one or several activities, and the uncertainty parameters of their values,
+    to a bundle that can be used without Brightway (see `lca_engine.load_matrix_bundle`).
+
+    Parameters:
+    - activities (list): Activity objects; the bundle includes every activity linked to them.
+    - lcia_methods (dict): A dictionary of impact categories and their corresponding method.
+    - dirpath (str or Path): Directory of the bundle.
+    '''
+    lca = bw.LCA({activity.key: 1 for activity in activities})
+    lca.load_lci_data()
+    characterization = characterization_matrix(lcia_methods, lca.biosphere_dict)
+
+    lca_engine.write_matrix_bundle(dirpath, lca.technosphere_matrix, lca.biosphere_matrix, characterization,
+                                   lca.product_dict, lca.activity_dict, lca.biosphere_dict,
+                                   list(lcia_methods), activity_names(lca.activity_dict),
+                                   technosphere_params=_bundle_params(lca.tech_params, technosphere=True),
+                                   biosphere_params=_bundle_params(lca.bio_params))
+
+
+def activity_names(activity_dict):
+    '''
+    Name of the activities of a LCA object as {key: name}, with one pass over each database.
+    '''
+    names = {}
+    for db_name in {key[0] for key in activity_dict}:
+        for act in bw.Database(db_name):
+            if act.key in activity_dict:
+                names[act.key] = act['name']
+    return names
+
+
+def lcia_supply_chain_contribution(activity, lcia_methods, activity_amount=1, rules=None, max_depth=5, cutoff=0.01,
+                                   max_nodes=10000):
+    '''
+    This function computes the contribution of the supply chain of an activity to its impacts, by traversing the
+    supply chain up to `max_depth` tiers and aggregating the contributions into categories defined by rules
+    (see `lca_engine.MatrixBundle.supply_chain_contribution`).
+
+    The matrices, the factorization of the technosphere matrix and the unit scores are built once per activity and
+    set of methods in a session and reused by the following calls (e.g., with other rules, depths or cutoffs).
+
+    Parameters:
+    - activity (object): An activity object representing the product or process being assessed.
+    - lcia_methods (dict): A dictionary of impact categories and their corresponding method.
+    - activity_amount (float): The functional unit of the assessment. Defaults to 1.
+    - rules (list): Categories as [(category, [name substrings])]. Defaults to `lca_engine.SUPPLY_CHAIN_RULES`.
+    - max_depth (int): Maximum number of tiers from the activity. Defaults to 5.
+    - cutoff (float): Nodes whose score is below this fraction of the total score (first impact category) are not
+                      expanded. Defaults to 0.01.
+    - max_nodes (int): Maximum number of expanded nodes. Defaults to 10000.
+
+    Returns:
+    - contributions (DataFrame): Scores with one row per category (and 'Total') and one column per impact category.
+    - nodes (DataFrame): The expanded nodes with their depth, path, amount, score and direct emissions score
+                         ("<impact> (direct)") for each impact category.
+    '''
+    cache_key = (activity.key, tuple(lcia_methods.items()))
+    if cache_key not in _lca_bundles:
+        lca = bw.LCA({activity.key: 1})
+        lca.load_lci_data()
+        _lca_bundles[cache_key] = lca_engine.MatrixBundle(sparse.csc_matrix(lca.technosphere_matrix),
+                                                          sparse.csc_matrix(lca.biosphere_matrix),
+                                                          characterization_matrix(lcia_methods, lca.biosphere_dict),
+                                                          lca.product_dict, lca.activity_dict, lca.biosphere_dict,
+                                                          list(lcia_methods), activity_names(lca.activity_dict))
+
+    contributions, nodes = _lca_bundles[cache_key].supply_chain_contribution(activity.key, activity_amount, rules=rules,
+                                                                              max_depth=max_depth, cutoff=cutoff,
+                                                                              max_nodes=max_nodes)
+
+    nodes_df = pd.DataFrame([{'depth': node['depth'],
+                              'activity': node['path'][-1],
+                              'path': ' > '.join(node['path']),
+                              'amount': node['amount'],
+                              **{impact: node['score'][i] for i, impact in enumerate(lcia_methods)},
+                              **{f"{impact} (direct)": node['direct score'][i] for i, impact in enumerate(lcia_methods)}}
+                             for node in nodes])
+
+    return pd.DataFrame(contributions), nodes_df
+
+
+# Matrices and factorizations already built in this session (see `lcia_supply_chain_contribution`)
+_lca_bundles = {}
+
+
+def _bundle_params(params, technosphere=False):
+    '''
+    Uncertainty parameters of a LCA object (`lca.tech_params` or `lca.bio_params`) in the format of the matrix bundles.
+    '''
+    bundle_params = np.zeros(len(params), dtype=lca_engine.PARAMETER_DTYPE)
+    for field in lca_engine.PARAMETER_DTYPE.names:
+        if field != 'sign':
+            bundle_params[field] = params[field]
+    bundle_params['sign'] = 1
+    if technosphere:
+        # Technosphere inputs are negative in the technosphere matrix
+        bundle_params['sign'][params['type'] == TYPE_DICTIONARY['technosphere']] = -1
+    return bundle_params
+
+
+def monte_carlo_lcia(activities, lcia_methods, iterations, output_dir, block_size=100, processes=None, seed=None):
+    '''
+    Monte Carlo uncertainty propagation for several activities, with the same samples for all activities in each iteration.
+
+    The system of the activities is exported once to a matrix bundle in `output_dir` (see `export_matrix_bundle`)
+    and the iterations are calculated without Brightway (see `monte_carlo.monte_carlo`). The scores are stored in
+    `output_dir`; calling the function again with the same arguments resumes an interrupted run. The bundle is
+    exported again, and the run restarted, when the activities, the methods or the "modified" timestamp of the
+    databases of the system (the databases of the activities and their dependencies) have changed.
+
+    Parameters:
+    - activities (dict): A dictionary of activities as {label: activity}.
+    - lcia_methods (dict): A dictionary of impact categories and their corresponding method.
+    - iterations (int): Number of iterations.
+    - output_dir (str or Path): Directory of the run.
+    - block_size (int): Number of iterations sampled and solved together. Defaults to 100.
+    - processes (int): Number of worker processes. Defaults to None (serial run).
+    - seed (int): Seed of the random numbers. Defaults to None.
+
+    Returns:
+    - statistics (DataFrame): Mean, standard deviation and 2.5%, 50% and 97.5% quantiles, with one row per
+                              (label, statistic) and one column per impact category.
+    '''
+    output_dir = Path(output_dir)
+    bundle_dir = output_dir / "bundle"
+    source = _bundle_source(list(activities.values()), lcia_methods)
+    previous_source = None
+    if (bundle_dir / "index.json").exists() and (bundle_dir / "source.json").exists():
+        with open(bundle_dir / "source.json") as f:
+            previous_source = json.load(f)
+    if previous_source != source:
+        # The scores of a previous run were calculated with the previous bundle
+        for filename in ("run.json", "blocks.npy", "scores.npy"):
+            (output_dir / filename).unlink(missing_ok=True)
+        export_matrix_bundle(list(activities.values()), lcia_methods, bundle_dir)
+        with open(bundle_dir / "source.json", 'w') as f:
+            json.dump(source, f)
+
+    demands = {label: (activity.key, 1) for label, activity in activities.items()}
+    statistics = monte_carlo.monte_carlo(bundle_dir, demands, iterations, output_dir,
+                                         block_size=block_size, processes=processes, seed=seed)
+
+    results = {}
+    for d, label in enumerate(activities):
+        results[(label, 'mean')] = statistics['mean'][d]
+        results[(label, 'std')] = np.sqrt(statistics['variance'][d])
+        for q, quantile in enumerate(statistics['quantiles']):
+            results[(label, f"{quantile:.1%}")] = statistics['quantile_values'][q, d]
+
+    return pd.DataFrame(results, index=list(lcia_methods)).T
+
+
+def _bundle_source(activities, lcia_methods):
+    '''
+    Description of what a matrix bundle of activities is calculated from: the activities, the methods and the
+    "modified" timestamp of the databases of the activities and of the databases they depend on.
+    '''
+    databases, pending = {}, [activity.key[0] for activity in activities]
+    while pending:
+        db_name = pending.pop()
+        if db_name not in databases and db_name in bw.databases:
+            databases[db_name] = bw.databases[db_name].get('modified')
+            pending.extend(bw.databases[db_name].get('depends', []))
+    return {'activities': [list(activity.key) for activity in activities],
+            'methods': {impact: list(method) for impact, method in lcia_methods.items()},
+            'databases': databases}
+
+
+# Last characterization matrix of each method set, with its biosphere index (see `characterization_matrix`)
+_characterization_cache = {}
+
+
+def characterization_matrix(lcia_methods, biosphere_dict, sparse_matrix=False):
+    '''
+    This function loads the characterization factors of several impact categories into a single matrix.
+
+    The last matrix of each method set is cached with its biosphere index, and reused when called again with the same
+    index object or an equal one (e.g., the `biosphere_dict` of another LCA on the same databases). A biosphere index
+    modified in place after a call must be passed as a new dictionary.
+
+    Parameters:
+    - lcia_methods (dict): A dictionary of impact categories and their corresponding method.
+    - biosphere_dict (dict): Mapping of elementary flow keys to rows of the biosphere matrix (e.g., `lca.biosphere_dict`).
+    - sparse_matrix (bool): Return a scipy sparse (CSR) matrix instead of a numpy array. Defaults to False.
+
+    Returns:
+    - characterization (numpy array or sparse matrix): Characterization factors (impact categories x elementary flows).
+    '''
+    cache_key = (tuple(lcia_methods.values()), sparse_matrix)
+    cached = _characterization_cache.get(cache_key)
+    if cached is None or not (cached[0] is biosphere_dict or cached[0] == biosphere_dict):
+        characterization = np.zeros((len(lcia_methods), len(biosphere_dict)))
+        for i, impact in enumerate(lcia_methods):
+            for cf in bw.Method(lcia_methods[impact]).load():
+                row = biosphere_dict.get(cf[0])
+                if row is not None:
+                    characterization[i, row] += cf[1]['amount'] if isinstance(cf[1], dict) else cf[1]
+        if sparse_matrix:
+            characterization = sparse.csr_matrix(characterization)
+        else:
+            characterization.flags.writeable = False
+        _characterization_cache[cache_key] = (biosphere_dict, characterization)
+
+    return _characterization_cache[cache_key][1]
+
+
 def carbon_footprint_blending(cf_biomethane, cf_fossil):
     """
     This function computes the carbon footprint of ammonia production based on
@@ -190,62 +447,167 @@ def impacts_geo_data(data):
     return data_regional
 
 
-def map_dbs_keys(dbs):
+def map_dbs_keys(dbs, cache_dir=None):
     """    
     Create mapping of BW codes for involved databases
 
-    :dbs list: list of databases
+    The mapping of each database is read from a persistent index (see `database_key_index`),
+    so the databases are only iterated when they have been modified.
+
+    :dbs list: list of databases (biosphere3 is always included)
+    :cache_dir path: directory of the persistent indexes. Defaults to the "key_index" folder of the project directory.
     """
-    if "biosphere 3" not in dbs:
+    dbs = list(dbs)
+    if "biosphere3" not in dbs:
         dbs.append("biosphere3")
 
     map_bw_keys =  {}
 
     for db in dbs:
-        db_obj = bw.Database(db)
-        for ds in db_obj:
-            if db == "biosphere3":
-                map_bw_keys[(ds['name'], ds["categories"])] = ds.key
-            else:
-                map_bw_keys[(ds['reference product'], ds['name'], ds['location'])] = ds.key
+        map_bw_keys.update(database_key_index(db, cache_dir))
     return map_bw_keys
 
 
-def read_ps_scenario_data(scenario_file, dbs):
+def database_key_index(db, cache_dir=None):
+    """
+    Mapping of (reference product, name, location) -- or (name, categories) for biosphere3 -- to the BW keys
+    of the activities of a database.
+
+    The mapping is stored on disk, one file per database in the project, and is rebuilt only when the
+    modification time of the database changes. It is also kept in memory for the session.
+
+    :db str: name of the database
+    :cache_dir path: directory of the persistent indexes. Defaults to the "key_index" folder of the project directory.
+    """
+    modified = bw.databases[db].get("modified")
+    cache_dir = Path(cache_dir) if cache_dir is not None else Path(bw.projects.dir) / "key_index"
+    filepath = cache_dir / f"{hashlib.md5(db.encode('utf-8')).hexdigest()}.pickle"
+
+    cached = _key_indexes.get(filepath)
+    if cached is None and filepath.exists():
+        with open(filepath, "rb") as f:
+            cached = pickle.load(f)
+    if cached is not None and cached["database"] == db and cached["modified"] == modified:
+        _key_indexes[filepath] = cached
+        return cached["index"]
+
+    index = {}
+    for ds in bw.Database(db):
+        if db == "biosphere3":
+            index[(ds['name'], ds["categories"])] = ds.key
+        else:
+            index[(ds['reference product'], ds['name'], ds['location'])] = ds.key
+
+    cached = {"database": db, "modified": modified, "index": index}
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    with open(filepath, "wb") as f:
+        pickle.dump(cached, f, protocol=pickle.HIGHEST_PROTOCOL)
+    _key_indexes[filepath] = cached
+
+    return index
+
+
+# Key indexes already loaded in this session (see `database_key_index`)
+_key_indexes = {}
+
+
+def read_ps_scenario_data(scenario_file, dbs, cache_dir=None):
     """
     This function reads the scenario data from an Excel file and prepares it into a dataframe for being used with presamples.
     Secondly, it adds the bw codes for the involved activities.
     The dictionary map_bw_keys provides these codes, it needs to be generated beforehand with the involved databases.    
+
+    The parsed Excel file is cached (see `read_scenario_file`) and the codes are added column-wise (see `add_bw_keys`).
+
+    :scenario_file path: Excel file with the scenario data
+    :dbs list: list of databases
+    :cache_dir path: directory of the parsed scenario files. Defaults to the "scenario_cache" folder of the project directory.
     """
 
     # Create mapping of BW codes for involved databases
     map_bw_keys =  map_dbs_keys(dbs)
 
     # Import scenario df and remove empty rows
-    scenariodata_df = pd.read_excel(scenario_file)
-    scenariodata_df = scenariodata_df.dropna(how="all")
+    scenariodata_df = read_scenario_file(scenario_file, cache_dir)
     scenario_label = list(scenariodata_df.columns)[10:]
 
     # add the bw code to scenario df (input = process, output = to_process)
-    scenariodata_df["input"] = None
-    scenariodata_df["output"] = None
-    for index, row in scenariodata_df.iterrows():
-        output_key = (row["to_reference product"], row["to_process"], row["to_location"])
+    add_bw_keys(scenariodata_df, map_bw_keys)
 
-        if row["from_type"] == "technosphere":
-            input_key = (row["from_reference_product"], row["from_process"], row["from_location"])
-        elif row["from_type"] == "biosphere":
-            input_key = (row["from_process"], tuple(row["from_categories"].split('::')))
+    return scenario_label, scenariodata_df
 
-        scenariodata_df.at[index, "input"] = map_bw_keys.get(input_key, None)
-        scenariodata_df.at[index, "output"] = map_bw_keys.get(output_key, None)
 
-    return scenario_label, scenariodata_df
+def read_scenario_file(scenario_file, cache_dir=None):
+    """
+    This function reads an Excel file with scenario data and removes the empty rows.
 
+    The parsed dataframe is cached as a Parquet file named after the hash of the Excel file, so that
+    the Excel file is only parsed again when it changes. It is also kept in memory for the session.
 
-def make_ps_package(scenariodata_df, scenario_label, ps_packagename):
+    :scenario_file path: Excel file with the scenario data
+    :cache_dir path: directory of the parsed scenario files. Defaults to the "scenario_cache" folder of the project directory.
     """
-    This function prepares a Presamples package out of the scenario data if.
+    with open(scenario_file, "rb") as f:
+        file_hash = hashlib.sha256(f.read()).hexdigest()
+
+    if file_hash not in _scenario_files:
+        cache_dir = Path(cache_dir) if cache_dir is not None else Path(bw.projects.dir) / "scenario_cache"
+        filepath = cache_dir / f"{file_hash}.parquet"
+
+        if filepath.exists():
+            scenariodata_df = pd.read_parquet(filepath)
+        else:
+            scenariodata_df = pd.read_excel(scenario_file)
+            scenariodata_df = scenariodata_df.dropna(how="all")
+            cache_dir.mkdir(parents=True, exist_ok=True)
+            try:
+                scenariodata_df.to_parquet(filepath)
+            except (ValueError, TypeError, ImportError) as err:
+                # e.g., non-string column names or mixed-type columns; the file is read from Excel next time
+                print(f"Scenario file not cached: {err}")
+        _scenario_files[file_hash] = scenariodata_df
+
+    return _scenario_files[file_hash].copy()
+
+
+# Scenario files already read in this session (see `read_scenario_file`)
+_scenario_files = {}
+
+
+def add_bw_keys(scenario_df, map_bw_keys):
+    """
+    This function adds in place the bw codes of the inputs (from_...) and outputs (to_...) of the scenario dataframe
+    as columns "input" and "output". Codes that are not found are None.
+
+    :scenario_df DataFrame: scenario data; categories of biosphere flows are tuples or strings separated by '::'
+    :map_bw_keys dict: mapping of the databases (see `map_dbs_keys`)
+    """
+    output_keys = pd.Series(list(zip(scenario_df["to_reference product"],
+                                     scenario_df["to_process"],
+                                     scenario_df["to_location"])), index=scenario_df.index, dtype=object)
+
+    technosphere_keys = pd.Series(list(zip(scenario_df["from_reference_product"],
+                                           scenario_df["from_process"],
+                                           scenario_df["from_location"])), index=scenario_df.index, dtype=object)
+
+    categories = [tuple(c.split('::')) if isinstance(c, str) else tuple(c) if isinstance(c, (tuple, list)) else c
+                  for c in scenario_df["from_categories"]]
+    biosphere_keys = pd.Series(list(zip(scenario_df["from_process"], categories)), index=scenario_df.index, dtype=object)
+
+    input_codes = pd.Series([None] * len(scenario_df), index=scenario_df.index, dtype=object)
+    is_technosphere = (scenario_df["from_type"] == "technosphere").values
+    is_biosphere = (scenario_df["from_type"] == "biosphere").values
+    input_codes[is_technosphere] = technosphere_keys[is_technosphere].map(map_bw_keys.get)
+    input_codes[is_biosphere] = biosphere_keys[is_biosphere].map(map_bw_keys.get)
+
+    scenario_df["input"] = input_codes
+    scenario_df["output"] = output_keys.map(map_bw_keys.get)
+
+
+def ps_matrix_data(scenariodata_df, scenario_label):
+    """
+    This function prepares the matrix data (samples, indices and matrix type) of the scenario data,
+    as used by Presamples packages and by `calculate_impacts_with_scenarios`.
     """
         
     technosphere_flows_df = scenariodata_df[scenariodata_df["from_type"] == "technosphere"]
@@ -267,15 +629,27 @@ def make_ps_package(scenariodata_df, scenario_label, ps_packagename):
         'biosphere'
         )
 
+    return [data_technosphere, data_biosphere]
+
+
+def make_ps_package(scenariodata_df, scenario_label, ps_packagename=None, dirpath=None):
+    """
+    This function prepares a Presamples package out of the scenario data if.
+
+    Packages are only needed to use the scenarios with `calculate_impacts_with_ps` or outside this project;
+    `calculate_impacts_with_scenarios` takes the matrix data in memory (see `ps_matrix_data`).
+
+    :ps_packagename str: name of the package. Defaults to a unique name, so that concurrent runs do not collide.
+    :dirpath path: directory of the package. Defaults to the presamples directory of the project.
+    :return path: directory of the package (named after the id of the package).
+    """
+    if ps_packagename is None:
+        ps_packagename = f"ps_{uuid.uuid4().hex}"
+
     ps_id, ps_filepath = ps.create_presamples_package(
-        matrix_data=[
-            data_technosphere,
-            data_biosphere
-            ],
-            name=ps_packagename, seed="sequential"
-            ) 
-        
-    print("\n ps_id, filepath:", ps_id, ps_filepath)
+        matrix_data=ps_matrix_data(scenariodata_df, scenario_label),
+            name=ps_packagename, seed="sequential", dirpath=dirpath
+            )
     return ps_filepath
 
 
@@ -299,19 +673,10 @@ def calculate_impacts_with_ps(ps_filepath, scenario_label, ds, lcia_methods):
        for i in range(len(scenario_label)): # Scenarios
               if i == 0: # Don't update the first time around, since indexer already at 0th column
                      lca.lci() # Builds matrices
-                     multi_lcia_results = dict()
-                     for impact in lcia_methods:
-                            lca.switch_method(lcia_methods[impact])
-                            lca.lcia()
-                            multi_lcia_results[impact] = lca.score
               else:
                      lca.presamples.update_matrices() # Move to next column and update matrices
                      lca.redo_lci()
-                     multi_lcia_results = dict()
-                     for impact in lcia_methods:
-                            lca.switch_method(lcia_methods[impact])
-                            lca.lcia()
-                            multi_lcia_results[impact] = lca.score
+              multi_lcia_results = lcia_scores(lca, lcia_methods)
                      
               scenario_lca[scenario_label[i]] = multi_lcia_results
 
@@ -323,7 +688,143 @@ def calculate_impacts_with_ps(ps_filepath, scenario_label, ds, lcia_methods):
        return ps_results_df
 
 
-def perturbation_analysis_with_ps(assessed_ds, included_ds, dbs, lcia_method):
+def calculate_impacts_with_scenarios(matrix_data, scenario_label, ds, lcia_methods, max_rank=200):
+       """
+       This function computes LCA results for the scenarios of a presamples-like matrix data
+       (see `ps_matrix_data`) with a single factorization of the base technosphere matrix.
+
+       Each scenario only replaces a few matrix values, so the scenarios are solved with a low-rank
+       (Woodbury) correction of the base solution, or with a full solve when the change is large
+       (see `lca_matrices.scenario_scores`). The results are the same as with `calculate_impacts_with_ps`.
+       
+       :matrix_data list: list of (samples, indices, matrix) tuples; indices are (input key, output key, type)
+       :scenario_label list: list of labels for scenarios
+       :ds bw object: activity for assessment
+       :lcia_methods dict: dictionary with LCIA methods
+       :max_rank int: maximum number of changed rows/columns for the low-rank correction
+       """
+
+       # Build matrices once
+       lca = bw.LCA({ds.key: 1})
+       lca.load_lci_data()
+       characterization = characterization_matrix(lcia_methods, lca.biosphere_dict)
+
+       # Position and new values of the changed matrix elements
+       changes = {'technosphere': ([], [], []), 'biosphere': ([], [], [])}
+       for samples, indices, matrix in matrix_data:
+              rows, cols, values = changes[matrix]
+              for (input_key, output_key, exc_type), sample in zip(indices, np.asarray(samples, dtype=float)):
+                     if matrix == 'technosphere':
+                            rows.append(lca.product_dict[input_key])
+                            # Technosphere inputs are negative in the technosphere matrix
+                            values.append(-sample if exc_type == 'technosphere' else sample)
+                     else:
+                            rows.append(lca.biosphere_dict[input_key])
+                            values.append(sample)
+                     cols.append(lca.activity_dict[output_key])
+
+       matrix_changes = {matrix: (rows, cols, np.array(values)) if rows else None
+                         for matrix, (rows, cols, values) in changes.items()}
+
+       demand = np.zeros(len(lca.product_dict))
+       demand[lca.product_dict[ds.key]] = 1
+
+       scores = lca_matrices.scenario_scores(lca.technosphere_matrix, lca.biosphere_matrix, characterization, demand,
+                                             technosphere_changes=matrix_changes['technosphere'],
+                                             biosphere_changes=matrix_changes['biosphere'],
+                                             max_rank=max_rank)
+
+       ps_results_df = pd.DataFrame(scores.T, index=list(lcia_methods), columns=scenario_label)
+
+       return ps_results_df
+
+
+def prospective_scenario_scores(demands, db, lci_param_prosp, columns, lcia_methods, names=None, max_rank=200):
+    """
+    This function computes LCA results for the prospective parameters of several years and cases (e.g., '2025_avg',
+    '2030_min', ..., '2050_max') without writing one database per column.
+
+    The parameters are matched once with the exchanges of `db` (see `inventory_imports.build_parameter_index`)
+    and each column is a scenario that changes the matched elements of the technosphere and biosphere matrices
+    of the base database. All scenarios are solved on a single factorization (see `lca_matrices.scenario_scores`).
+
+    :demands dict: dictionary of demands as {label: (activity, amount)}
+    :db list: the database with the parameterized exchanges in wurst format (e.g., extracted from the Brightway
+              database of the activities), with linked exchanges
+    :lci_param_prosp DataFrame: parameters (see `inventory_imports.modify_exchange_amount_from_df`)
+    :columns list: columns of `lci_param_prosp` with the amounts of each year/case
+    :lcia_methods dict: dictionary with LCIA methods
+    :names list: names of the levels of the demand labels. Defaults to None.
+    :max_rank int: maximum number of changed rows/columns for the low-rank correction
+
+    Returns a dataframe with one row per (year, case, demand label) and one column per impact category.
+    Columns that are not named "<year>_<case>" are used as they are for the year and case levels.
+    The parameter rows that did not match any exchange are printed.
+    """
+    labels = list(demands)
+    lca = bw.LCA({demands[label][0].key: 1 for label in labels})
+    lca.load_lci_data()
+    characterization = characterization_matrix(lcia_methods, lca.biosphere_dict)
+    lu = lca_matrices.factorize(lca.technosphere_matrix)
+
+    # Change of each matched matrix element in each column, from the amount of the exchange in `db`
+    parameter_index, amounts = inventory_imports.build_parameter_index(lci_param_prosp, columns)
+    deltas = {'technosphere': {}, 'biosphere': {}}
+    matched_rows = set()
+    for i, j, row in inventory_imports.match_parameters(db, parameter_index):
+        ds, exc = db[i], db[i]['exchanges'][j]
+        col = lca.activity_dict.get((ds['database'], ds['code']))
+        if col is None:
+            continue
+        matched_rows.add(row)
+        delta = np.asarray(amounts[row], dtype=float) - exc['amount']
+        if exc['type'] == 'technosphere':
+            # Technosphere inputs are negative in the technosphere matrix
+            element, matrix = (lca.product_dict[exc['input']], col), 'technosphere'
+            delta = -delta
+        else:
+            element, matrix = (lca.biosphere_dict[exc['input']], col), 'biosphere'
+        deltas[matrix][element] = deltas[matrix].get(element, 0) + delta
+
+    unmatched = inventory_imports.unmatched_parameters(lci_param_prosp, matched_rows)
+    if len(unmatched):
+        print(f"{len(unmatched)} parameters did not match any exchange:")
+        print(unmatched)
+
+    changes = {}
+    for matrix, base_matrix in (('technosphere', lca.technosphere_matrix), ('biosphere', lca.biosphere_matrix)):
+        if deltas[matrix]:
+            rows, cols = (list(x) for x in zip(*deltas[matrix]))
+            base = np.asarray(base_matrix[rows, cols]).ravel()
+            changes[matrix] = (rows, cols, base[:, None] + np.array(list(deltas[matrix].values())))
+
+    scores = np.zeros((len(columns), len(labels), len(lcia_methods)))
+    for d, label in enumerate(labels):
+        activity, amount = demands[label]
+        demand = np.zeros(len(lca.product_dict))
+        demand[lca.product_dict[activity.key]] = amount
+        if changes:
+            scores[:, d, :] = lca_matrices.scenario_scores(lca.technosphere_matrix, lca.biosphere_matrix, characterization,
+                                                           demand, technosphere_changes=changes.get('technosphere'),
+                                                           biosphere_changes=changes.get('biosphere'),
+                                                           lu=lu, max_rank=max_rank)
+        else:
+            scores[:, d, :] = characterization @ (lca.biosphere_matrix @ lu.solve(demand))
+
+    years_cases = []
+    for column in columns:
+        year, case = column.split('_', 1) if '_' in column else (column, column)
+        years_cases.append((int(year) if year.isdigit() else year, case))
+    index = [year_case + (label if isinstance(label, tuple) else (label,))
+             for year_case in years_cases for label in labels]
+    label_names = list(names) if names else [None] * (len(index[0]) - 2)
+
+    return pd.DataFrame(scores.reshape(len(columns) * len(labels), len(lcia_methods)),
+                        index=pd.MultiIndex.from_tuples(index, names=['Year', 'Case'] + label_names),
+                        columns=list(lcia_methods))
+
+
+def perturbation_analysis_with_ps(assessed_ds, included_ds, dbs, lcia_method, write_ps_package=False):
     """
     This function performs a perturbation analysis to
     identify the most sensitive LCI flows with respect
@@ -336,6 +837,8 @@ def perturbation_analysis_with_ps(assessed_ds, included_ds, dbs, lcia_method):
     :included_ds list: list of LCI datasets included in the perturbation analysis
     :dbs list: list of databases included
     :lcia_methods dict: dictionary with the name and assessed LCIA method
+    :write_ps_package bool: write the scenarios to presamples packages on disk and calculate the impacts from them.
+                            Defaults to False (scenarios are passed in memory to `calculate_impacts_with_scenarios`).
     """
 
     if len(lcia_method) > 1:
@@ -377,24 +880,8 @@ def perturbation_analysis_with_ps(assessed_ds, included_ds, dbs, lcia_method):
     scenario_df = pd.DataFrame(to_from_ds, columns=df_columns)
 
     # add the bw code to scenario df (input = process, output = to_process) and the parameter identifier
-    scenario_df["input"] = None
-    scenario_df["output"] = None
-
-    count_sc = 0
-    for index, row in scenario_df.iterrows():
-        output_key = (row["to_reference product"], row["to_process"], row["to_location"])
-
-        if row["from_type"] == "technosphere":
-            input_key = (row["from_reference_product"], row["from_process"], row["from_location"])
-        elif row["from_type"] == "biosphere":
-            input_key = (row["from_process"], tuple(row["from_categories"]))
-
-        scenario_df.at[index, "input"] = map_bw_keys.get(input_key, None)
-        scenario_df.at[index, "output"] = map_bw_keys.get(output_key, None)
-
-        scenario_id = "PAR_" + str(count_sc)
-        scenario_df.at[index, "param id"] = scenario_id
-        count_sc += 1
+    add_bw_keys(scenario_df, map_bw_keys)
+    scenario_df["param id"] = ["PAR_" + str(count_sc) for count_sc in range(len(scenario_df))]
 
     scenario_df = scenario_df[[col for col in scenario_df.columns if col != "default"] + ["default"]]
 
@@ -412,17 +899,21 @@ def perturbation_analysis_with_ps(assessed_ds, included_ds, dbs, lcia_method):
     np.fill_diagonal(replicated_columns.values, replicated_columns.values.diagonal() * (1 - 0.2))
     scenario_df_minus_20 = pd.concat([scenario_df, replicated_columns], axis=1)
 
-    ps_packagename = "ps_v1"
     scenario_label = list(scenario_df_plus_20.columns)[13:]
+    if write_ps_package:
+        ps_filepath = make_ps_package(scenario_df_plus_20, scenario_label)
+        lca_plus_20 = calculate_impacts_with_ps(ps_filepath, scenario_label, assessed_ds, lcia_method)
+    else:
+        matrix_data = ps_matrix_data(scenario_df_plus_20, scenario_label)
+        lca_plus_20 = calculate_impacts_with_scenarios(matrix_data, scenario_label, assessed_ds, lcia_method)
 
-    ps_filepath = make_ps_package(scenario_df_plus_20, scenario_label, ps_packagename)
-    lca_plus_20 = calculate_impacts_with_ps(ps_filepath, scenario_label, assessed_ds, lcia_method)
-
-    ps_packagename = "ps_v1"
     scenario_label = list(scenario_df_minus_20.columns)[13:]
-
-    ps_filepath = make_ps_package(scenario_df_minus_20, scenario_label, ps_packagename)
-    lca_minus_20 = calculate_impacts_with_ps(ps_filepath, scenario_label, assessed_ds, lcia_method)
+    if write_ps_package:
+        ps_filepath = make_ps_package(scenario_df_minus_20, scenario_label)
+        lca_minus_20 = calculate_impacts_with_ps(ps_filepath, scenario_label, assessed_ds, lcia_method)
+    else:
+        matrix_data = ps_matrix_data(scenario_df_minus_20, scenario_label)
+        lca_minus_20 = calculate_impacts_with_scenarios(matrix_data, scenario_label, assessed_ds, lcia_method)
 
     perturbation_analysis_results = {}
     for index, row in scenario_df_plus_20.iterrows():
@@ -460,3 +951,258 @@ def perturbation_analysis_with_ps(assessed_ds, included_ds, dbs, lcia_method):
     perturbation_analysis_results = perturbation_analysis_results.reset_index().rename(columns={"level_0": "activity", "level_1": "parameter"}).sort_values(by="sensitivity ratio", ascending=False)
 
     return perturbation_analysis_results
+
+
+def perturbation_analysis_adjoint(assessed_ds, included_ds, lcia_method, perturbation=0.2):
+    """
+    This function performs the perturbation analysis of `perturbation_analysis_with_ps` analytically.
+
+    The derivatives of the score with respect to every technosphere and biosphere coefficient are
+    obtained from one solve (supply vector) and one transposed solve (unit scores of every product)
+    with the same factorization of the technosphere matrix:
+        - technosphere exchange from product i to activity j: d score / d amount = unit score(i) * supply(j)
+        - biosphere exchange of flow k in activity j: d score / d amount = CF(k) * supply(j)
+
+    The sensitivity ratio is d score / d amount * amount / score. The "lca plus/minus ... (linear)" columns are
+    the first-order estimates score +- d score / d amount * perturbation * amount (exact for biosphere exchanges),
+    not the finite-difference scores of the "lca plus/minus 20" columns of `perturbation_analysis_with_ps`.
+    Column labels give the perturbation in percent (e.g., "param plus 20%", "lca plus 20% (linear)").
+    `perturbation_analysis_with_ps` remains available to validate the results by finite differences.
+
+    :assessed_ds bw object: LCI dataset for which perturbation analysis is assessed
+    :included_ds list: list of LCI datasets included in the perturbation analysis
+    :lcia_method dict: dictionary with the name and assessed LCIA method
+    :perturbation float: relative variation of the parameters. Defaults to 0.2 (+-20%)
+    """
+
+    if len(lcia_method) > 1:
+        raise ValueError("More than one impact category has been provided.")
+
+    # Build matrices and factorize the technosphere matrix once
+    lca = bw.LCA({assessed_ds.key: 1})
+    lca.load_lci_data()
+    characterization = characterization_matrix(lcia_method, lca.biosphere_dict)
+    lu = lca_matrices.factorize(lca.technosphere_matrix)
+
+    demand = np.zeros(len(lca.product_dict))
+    demand[lca.product_dict[assessed_ds.key]] = 1
+    supply = lu.solve(demand)
+    scores = lca_matrices.unit_scores(lu, lca.biosphere_matrix, characterization)[:, 0]
+    result_default = scores[lca.product_dict[assessed_ds.key]]
+
+    # Get only elementary flows relevant to the assessed impact category:
+    cfs_keys = {cf[0] for cf in bw.Method(list(lcia_method.values())[0]).load()}
+
+    # Column labels of the perturbed values (e.g., "20%" for the default perturbation)
+    label = f"{perturbation * 100:g}%"
+
+    perturbation_analysis_results = {}
+    for ds in included_ds:
+        ds_supply = supply[lca.activity_dict[ds.key]]
+
+        for exc in ds.exchanges():
+            if exc["type"] == "technosphere":
+                derivative = scores[lca.product_dict[exc.input.key]] * ds_supply
+            elif exc["type"] == "biosphere" and exc.input.key in cfs_keys:
+                derivative = characterization[0, lca.biosphere_dict[exc.input.key]] * ds_supply
+            else:
+                continue
+
+            param_default = exc["amount"]
+            perturbation_analysis_results.update(
+                {
+                    (ds["name"], exc["name"]): {"param default": param_default,
+                                                f"param plus {label}": param_default * (1 + perturbation),
+                                                f"param minus {label}": param_default * (1 - perturbation),
+                                                "lca default": result_default,
+                                                f"lca plus {label} (linear)": result_default + derivative * param_default * perturbation,
+                                                f"lca minus {label} (linear)": result_default - derivative * param_default * perturbation,
+                                                "sensitivity ratio": derivative * param_default / result_default}
+                }
+            )
+
+    perturbation_analysis_results = pd.DataFrame(perturbation_analysis_results).T
+
+    perturbation_analysis_results = perturbation_analysis_results.reset_index().rename(columns={"level_0": "activity", "level_1": "parameter"}).sort_values(by="sensitivity ratio", ascending=False)
+
+    return perturbation_analysis_results
+
+
+def global_sensitivity_analysis(assessed_ds, parameters, lcia_methods, method='sobol', n=1024, trajectories=100,
+                                seed=None, batch_size=1000, processes=None):
+    """
+    This function performs a global sensitivity analysis of the impacts of an activity with respect to
+    the amounts of some exchanges, varied together within their ranges.
+
+    With method 'sobol', a Saltelli design of n * (parameters + 2) runs is evaluated and the first-order and total
+    Sobol indices are calculated; with method 'morris', a design of trajectories * (parameters + 1) runs is evaluated
+    and the Morris indices (mu, mu_star, sigma) are calculated. The runs are evaluated in batches on a single
+    factorization of the technosphere matrix (see `global_sensitivity.evaluate_design`).
+
+    :assessed_ds bw object: LCI dataset for which the sensitivity analysis is assessed
+    :parameters dict: dictionary as {label: (exchange, minimum amount, maximum amount)} with the exchanges
+                      (technosphere or biosphere exchanges, e.g., from `ds.exchanges()`) and their ranges
+    :lcia_methods dict: dictionary with LCIA methods
+    :method str: 'sobol' or 'morris'. Defaults to 'sobol'.
+    :n int: number of base samples of the Saltelli design (preferably a power of 2). Defaults to 1024.
+    :trajectories int: number of trajectories of the Morris design. Defaults to 100.
+    :seed int: seed of the random numbers. Defaults to None.
+    :batch_size int: number of runs evaluated together. Defaults to 1000.
+    :processes int: number of worker processes. Defaults to None (serial run).
+
+    Returns a dataframe with one row per parameter and the indices of each impact category as columns
+    (impact category, index).
+    """
+    if method not in ('sobol', 'morris'):
+        raise ValueError(f"Unknown method '{method}'; use 'sobol' or 'morris'.")
+
+    lca = bw.LCA({assessed_ds.key: 1})
+    lca.load_lci_data()
+    characterization = characterization_matrix(lcia_methods, lca.biosphere_dict)
+
+    demand = np.zeros(len(lca.product_dict))
+    demand[lca.product_dict[assessed_ds.key]] = 1
+
+    # Matrix elements of the parameters; technosphere inputs are negative in the technosphere matrix
+    labels = list(parameters)
+    matrix_parameters, bounds = [], []
+    for label in labels:
+        exc, minimum, maximum = parameters[label]
+        col = lca.activity_dict[exc.output.key]
+        if exc['type'] == 'biosphere':
+            matrix_parameters.append(('biosphere', lca.biosphere_dict[exc.input.key], col))
+            bounds.append([minimum, maximum])
+        else:
+            matrix_parameters.append(('technosphere', lca.product_dict[exc.input.key], col))
+            bounds.append([-maximum, -minimum] if exc['type'] == 'technosphere' else [minimum, maximum])
+    bounds = np.array(bounds, dtype=float)
+
+    if method == 'sobol':
+        design = global_sensitivity.saltelli_design(bounds, n, seed=seed)
+    else:
+        design = global_sensitivity.morris_design(bounds, trajectories, seed=seed)
+
+    scores = global_sensitivity.evaluate_design(lca.technosphere_matrix, lca.biosphere_matrix, characterization, demand,
+                                                matrix_parameters, design, batch_size=batch_size, processes=processes)
+
+    if method == 'sobol':
+        indices = global_sensitivity.sobol_indices(scores, n)
+    else:
+        indices = global_sensitivity.morris_indices(design, scores, bounds)
+        # Elementary effects with respect to the exchange amount (the sign of technosphere inputs is reversed in the matrix)
+        sign = np.array([-1 if parameters[label][0]['type'] == 'technosphere' else 1 for label in labels])[:, None]
+        indices['mu'] = sign * indices['mu']
+
+    gsa_results = {(impact, index_name): values[:, i]
+                   for i, impact in enumerate(lcia_methods) for index_name, values in indices.items()}
+
+    return pd.DataFrame(gsa_results, index=labels)
+
+
+def lca_service(operation, payload, bundle_dir, host=lca_server.DEFAULT_HOST, port=lca_server.DEFAULT_PORT):
+    '''
+    Result of an operation of the local LCA server (see `lca_server`) for a matrix bundle. If no server is running,
+    the result is computed in this process with the same code; the bundle is then loaded and factorized once per
+    session and reused by the following calls.
+
+    Parameters:
+    - operation (str): Name of the operation (e.g., 'multi_lcia', 'system_contribution', 'scenario_deltas').
+    - payload (dict): Parameters of the operation (see `lca_server`).
+    - bundle_dir (str or Path): Directory of the bundle (see `export_matrix_bundle`).
+    - host (str), port (int): Address of the server. Defaults to `lca_server.DEFAULT_HOST` and `DEFAULT_PORT`.
+
+    Returns:
+    - result (dict): Result of the operation.
+    '''
+    bundle_dir = str(Path(bundle_dir).resolve())
+    try:
+        return lca_server.request(operation, dict(payload, bundle_dir=bundle_dir), host=host, port=port)
+    except ConnectionError:
+        pass
+
+    if bundle_dir not in _service_bundles:
+        bundle = lca_server.warm_bundle(lca_engine.load_matrix_bundle(bundle_dir))
+        bundle.bundle_dir = bundle_dir
+        _service_bundles[bundle_dir] = bundle
+    return lca_server.handle_request(_service_bundles[bundle_dir], operation, lca_server.json_compatible(payload))
+
+
+# Bundles loaded in this session when no LCA server is running (see `lca_service`)
+_service_bundles = {}
+
+
+def service_multi_lcia(demands, bundle_dir, names=None, **server):
+    '''
+    Scores of several demands with the local LCA server or in-process (see `lca_service`), in the format of
+    `multi_lcia_batch`.
+
+    Parameters:
+    - demands (dict): Demands as {label: (activity or key, amount)}.
+    - bundle_dir (str or Path): Directory of the bundle, which includes the activities of the demands.
+    - names (list): Names of the levels of the labels (e.g., ['Scenario', 'Location']). Defaults to None.
+    - server: `host` and `port` of the server.
+
+    Returns:
+    - multi_lcia_results (DataFrame): Scores with one row per demand and one column per impact category.
+    '''
+    labels = list(demands)
+    result = lca_service('multi_lcia', {'demands': [[label, *_service_demand(demands[label])] for label in labels]},
+                         bundle_dir, **server)
+    return pd.DataFrame(result['scores'], index=_service_index(labels, names), columns=result['impacts'])
+
+
+def service_system_contribution(activity, bundle_dir, activity_amount=1, **server):
+    '''
+    Contribution of each system component to the impacts of an activity with the local LCA server or in-process
+    (see `lca_service`), as returned by `lcia_system_contribution`.
+    '''
+    key, amount = _service_demand((activity, activity_amount))
+    return lca_service('system_contribution', {'key': key, 'amount': amount}, bundle_dir, **server)['contributions']
+
+
+def service_scenario_deltas(demands, bundle_dir, technosphere=None, biosphere=None, names=None, **server):
+    '''
+    Change of the scores of several demands in scenarios that change some exchange amounts, with the local LCA
+    server or in-process (see `lca_service`). The scenarios are solved with the factorization of the bundle
+    (see `lca_matrices.scenario_scores`).
+
+    Parameters:
+    - demands (dict): Demands as {label: (activity or key, amount)}.
+    - bundle_dir (str or Path): Directory of the bundle.
+    - technosphere (list): Technosphere exchanges as [(input, activity, [amount in each scenario])], with activities
+                           or keys; inputs have positive amounts and the production exchange has the activity as input.
+    - biosphere (list): Biosphere exchanges as [(elementary flow, activity, [amount in each scenario])].
+    - names (list): Names of the levels of the labels. Defaults to None.
+    - server: `host` and `port` of the server.
+
+    Returns:
+    - deltas (DataFrame): Scenario score minus base score, with one row per demand and scenario (last level of the
+                          index) and one column per impact category.
+    '''
+    key_of = lambda x: list(getattr(x, 'key', x))
+    labels = list(demands)
+    payload = {'demands': [[label, *_service_demand(demands[label])] for label in labels],
+               'technosphere': [[key_of(i), key_of(a), list(amounts)] for i, a, amounts in technosphere or []],
+               'biosphere': [[key_of(i), key_of(a), list(amounts)] for i, a, amounts in biosphere or []]}
+    result = lca_service('scenario_deltas', payload, bundle_dir, **server)
+
+    deltas = np.asarray(result['deltas'], dtype=float).reshape(len(labels), -1, len(result['impacts']))
+    index = pd.MultiIndex.from_tuples([(*(label if isinstance(label, tuple) else (label,)), s)
+                                       for label in labels for s in range(deltas.shape[1])],
+                                      names=(list(names) if names else [None] * _label_depth(labels)) + ['Scenario number'])
+    return pd.DataFrame(deltas.reshape(-1, deltas.shape[2]), index=index, columns=result['impacts'])
+
+
+def _service_demand(demand):
+    activity, amount = demand
+    return [list(getattr(activity, 'key', activity)), float(amount)]
+
+
+def _label_depth(labels):
+    return len(labels[0]) if labels and isinstance(labels[0], tuple) else 1
+
+
+def _service_index(labels, names=None):
+    if all(isinstance(label, tuple) for label in labels):
+        return pd.MultiIndex.from_tuples(labels, names=names)
+    return pd.Index(labels, name=names[0] if names else None)
@@ -0,0 +1,174 @@
+"""
+Columnar store of results (Parquet dataset) with a fixed schema of dimensions
+
+Every result is a row with the dimensions of `DIMENSIONS` and a value. The store is a directory with one
+subdirectory per run ("run_id=<run id>", hive partitioning) and one Parquet file per write, so that writes only
+append files. Reads filter on the dimensions while scanning the files (run ids select the subdirectories and the
+other filters are evaluated on the row groups), so only the requested slices are loaded.
+"""
+
+import datetime
+import uuid
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as pds
+import pyarrow.parquet as pq
+from pathlib import Path
+
+
+# Dimensions of the results: run, quantity (e.g., 'carbon footprint') and labels of the value
+DIMENSIONS = ('run_id', 'result', 'scenario', 'location', 'impact', 'component', 'parameter')
+
+SCHEMA = pa.schema([(dimension, pa.string()) for dimension in DIMENSIONS] + [('value', pa.float64())])
+
+
+def new_run_id():
+    """
+    Run id from the current time, e.g. '2024-03-03T10-15-00-1a2b3c'.
+    """
+    return f"{datetime.datetime.now().strftime('%Y-%m-%dT%H-%M-%S')}-{uuid.uuid4().hex[:6]}"
+
+
+def tidy_results(data, dimensions, **fixed):
+    """
+    Convert results to rows with the dimensions of `DIMENSIONS` and a value.
+
+    Parameters:
+    - data (dict, Series or DataFrame): Results as nested dictionaries (e.g., {scenario: {impact: {component: value}}}),
+                                        a Series or a DataFrame (the levels of the index, then the levels of the columns).
+    - dimensions (list): Dimension of every level of `data` (e.g., ['scenario', 'impact', 'component']).
+    - fixed: Values of other dimensions, the same for all rows (e.g., result='carbon footprint', location='RER').
+
+    Returns:
+    - records (DataFrame): Rows with the dimensions (None when not given) and the value. Missing values are dropped.
+    """
+    unknown = [dimension for dimension in list(dimensions) + list(fixed)
+               if dimension not in DIMENSIONS or dimension == 'run_id']
+    if unknown:
+        raise ValueError(f"Unknown dimensions {unknown}; the dimensions are {DIMENSIONS[1:]}.")
+
+    if isinstance(data, dict):
+        flat = _flatten(data, len(dimensions))
+        index = pd.MultiIndex.from_tuples(list(flat)) if len(dimensions) > 1 else pd.Index(list(flat))
+        data = pd.Series(list(flat.values()), index=index, dtype=float)
+    elif isinstance(data, pd.DataFrame):
+        data = data.stack(list(range(data.columns.nlevels)), dropna=False)
+    if data.index.nlevels != len(dimensions):
+        raise ValueError(f"The results have {data.index.nlevels} levels but {len(dimensions)} dimensions were given.")
+
+    records = pd.DataFrame({dimension: None for dimension in DIMENSIONS[1:]}, index=range(len(data)))
+    for level, dimension in enumerate(dimensions):
+        records[dimension] = data.index.get_level_values(level).astype(str)
+    for dimension, value in fixed.items():
+        records[dimension] = None if value is None else str(value)
+    records['value'] = pd.to_numeric(pd.Series(data.to_numpy()), errors='coerce').to_numpy(dtype=float)
+
+    return records[~np.isnan(records['value'])].reset_index(drop=True)
+
+
+def append_results(store_dir, records, run_id):
+    """
+    Append rows (see `tidy_results`) to the results of a run. A new file is written in the directory of the run;
+    existing files are never modified.
+
+    Returns:
+    - filepath (Path): File written.
+    """
+    run_dir = Path(store_dir) / f"run_id={run_id}"
+    run_dir.mkdir(parents=True, exist_ok=True)
+
+    records = records.reindex(columns=list(DIMENSIONS[1:]) + ['value'])
+    records = records.sort_values(list(DIMENSIONS[1:]), na_position='first', kind='stable')
+    table = pa.Table.from_pandas(records, schema=SCHEMA.remove(0), preserve_index=False)
+
+    filepath = run_dir / f"part-{datetime.datetime.now().strftime('%Y%m%d%H%M%S%f')}-{uuid.uuid4().hex[:8]}.parquet"
+    pq.write_table(table, filepath)
+    return filepath
+
+
+def read_results(store_dir, columns=None, **filters):
+    """
+    Read the rows of the store that match filters on the dimensions.
+
+    Parameters:
+    - store_dir (str or Path): Directory of the store.
+    - columns (list): Columns to read. Defaults to None (all the dimensions and the value).
+    - filters: Value or list of values of dimensions (e.g., run_id='...', impact=['Acidification', 'Land use']);
+               None selects the rows without the dimension.
+
+    Returns:
+    - results (DataFrame): Matching rows.
+    """
+    if not Path(store_dir).exists():
+        return pd.DataFrame({column: pd.Series(dtype=object if column != 'value' else float)
+                             for column in (columns or SCHEMA.names)})
+    dataset = pds.dataset(store_dir, format='parquet', schema=SCHEMA, partitioning='hive')
+    return dataset.to_table(columns=columns, filter=_filter_expression(filters)).to_pandas()
+
+
+def list_runs(store_dir):
+    """
+    Ids of the runs in the store, in chronological order (for run ids from `new_run_id`).
+    """
+    return sorted(path.name.split('=', 1)[1] for path in Path(store_dir).glob("run_id=*") if path.is_dir())
+
+
+def diff_runs(store_dir, run_a, run_b, tolerance=0, **filters):
+    """
+    Rows whose value differs between two runs (or that are in only one run).
+
+    Parameters:
+    - store_dir (str or Path): Directory of the store.
+    - run_a, run_b (str): Ids of the runs.
+    - tolerance (float): Absolute difference below which the values are equal. Defaults to 0.
+    - filters: Filters on the dimensions (see `read_results`).
+
+    Returns:
+    - differences (DataFrame): Rows indexed by the dimensions, with the values of both runs, the difference
+                               (run_b - run_a) and the relative difference (to run_a).
+    """
+    dimensions = list(DIMENSIONS[1:])
+    runs = []
+    for run_id in (run_a, run_b):
+        results = read_results(store_dir, columns=dimensions + ['value'], run_id=run_id, **filters)
+        results[dimensions] = results[dimensions].fillna('')
+        runs.append(results.groupby(dimensions, sort=False)['value'].last().rename(run_id))
+
+    differences = pd.concat(runs, axis=1, join='outer')
+    differences.columns = [run_a, run_b]
+    differences['difference'] = differences[run_b] - differences[run_a]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        differences['relative difference'] = differences['difference'] / differences[run_a].abs()
+
+    changed = (differences['difference'].abs() > tolerance) | differences[[run_a, run_b]].isna().any(axis=1)
+    return differences[changed]
+
+
+def _filter_expression(filters):
+    expression = None
+    for dimension, value in filters.items():
+        if dimension not in DIMENSIONS:
+            raise ValueError(f"Unknown dimension {dimension}.")
+        field = pds.field(dimension)
+        if value is None:
+            condition = field.is_null()
+        elif isinstance(value, (list, tuple, set)):
+            condition = field.isin([str(v) for v in value])
+        else:
+            condition = field == str(value)
+        expression = condition if expression is None else expression & condition
+    return expression
+
+
+def _flatten(data, depth):
+    """
+    Flatten nested dictionaries to {(key level 1, ..., key level `depth`): value}.
+    """
+    if depth == 1:
+        return {key: value for key, value in data.items()}
+    flat = {}
+    for key, value in data.items():
+        for keys, leaf in _flatten(value, depth - 1).items():
+            flat[(key,) + (keys if isinstance(keys, tuple) and depth > 2 else (keys,))] = leaf
+    return flat
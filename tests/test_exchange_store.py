@@ -0,0 +1,73 @@
+import copy
+import pickle
+
+from src.exchange_store import ExchangeStore
+
+
+def _database():
+    return [{'name': 'ammonia production', 'location': 'DE', 'code': 'a', 'database': 'lci',
+             'exchanges': [{'name': 'ammonia production', 'product': 'ammonia', 'location': 'DE', 'unit': 'kilogram',
+                            'amount': 1.0, 'type': 'production', 'input': ('lci', 'a')},
+                           {'name': 'market for natural gas', 'product': 'natural gas', 'location': 'DE',
+                            'unit': 'cubic meter', 'amount': 0.5, 'type': 'technosphere', 'uncertainty type': 2,
+                            'loc': -0.69, 'scale': 0.1, 'pedigree': {'reliability': 2, 'completeness': 3}}]},
+            {'name': 'hydrogen production', 'location': 'DE', 'code': 'b', 'database': 'lci',
+             'exchanges': [{'name': 'hydrogen production', 'product': 'hydrogen', 'location': 'DE', 'unit': 'kilogram',
+                            'amount': 1.0, 'type': 'production'},
+                           {'name': 'Carbon dioxide, fossil', 'categories': ('air',), 'unit': 'kilogram',
+                            'amount': 9.0, 'type': 'biosphere', 'pedigree': {'completeness': 3, 'reliability': 2}}]}]
+
+
+def test_round_trip():
+    db = _database()
+    assert ExchangeStore.from_wurst(db).to_wurst() == db
+
+
+def test_modified_exchanges_round_trip():
+    store = ExchangeStore.from_wurst(_database())
+    ds = store[0]
+    ds['exchanges'][1]['amount'] = 0.4
+    ds['exchanges'][1].update({'location': 'RER', 'comment': 'regionalized'})
+    ds['exchanges'].append({'name': 'market for electricity', 'product': 'electricity', 'location': 'DE',
+                            'unit': 'kilowatt hour', 'amount': 10.0, 'type': 'technosphere'})
+    ds['exchanges'].remove(ds['exchanges'][0])
+    store[1]['exchanges'] = [exc for exc in store[1]['exchanges'] if exc['type'] != 'biosphere']
+
+    expected = _database()
+    expected[0]['exchanges'][1].update({'amount': 0.4, 'location': 'RER', 'comment': 'regionalized'})
+    expected[0]['exchanges'].append({'name': 'market for electricity', 'product': 'electricity', 'location': 'DE',
+                                     'unit': 'kilowatt hour', 'amount': 10.0, 'type': 'technosphere'})
+    del expected[0]['exchanges'][0]
+    expected[1]['exchanges'] = expected[1]['exchanges'][:1]
+
+    assert len(ds['exchanges']) == 2
+    assert ds['exchanges'] == expected[0]['exchanges']
+    assert store.to_wurst() == expected
+    assert copy.deepcopy(ds) == expected[0]
+    assert pickle.loads(pickle.dumps(store[1])) == expected[1]
+
+
+def test_unhashable_values_are_stored_once():
+    store = ExchangeStore.from_wurst(_database())
+    number_extras = len(store.extras)
+    exc = store[0]['exchanges'][1]
+    for _ in range(3):
+        exc.update({'pedigree': {'completeness': 3, 'reliability': 2}})
+    exc['pedigree']['reliability'] = 5
+
+    assert len(store.extras) == number_extras == 2
+    assert store[1]['exchanges'][1]['pedigree'] == {'reliability': 2, 'completeness': 3}
+
+
+def test_unhashable_values_keep_their_types():
+    db = _database()
+    db[0]['exchanges'][1]['pedigree'] = {1: 2}
+    db[1]['exchanges'][1]['pedigree'] = {'1': 2}
+    db[0]['exchanges'][0]['properties'] = [('carbon', [0.5])]
+    db[1]['exchanges'][0]['properties'] = [['carbon', (0.5,)]]
+    store = ExchangeStore.from_wurst(db)
+
+    assert len([extra for extra in store.extras if extra]) == 4
+    assert store.to_wurst() == db
+    assert type(store[1]['exchanges'][0]['properties'][0]) is list
+    assert type(store[0]['exchanges'][0]['properties'][0][1]) is list
@@ -0,0 +1,240 @@
+import copy
+
+import numpy as np
+import pandas as pd
+import pytest
+
+inventory_imports = pytest.importorskip('src.inventory_imports')
+wurst = inventory_imports.wurst
+
+
+COLUMNS = ['name', 'reference product', 'database', 'categories', 'location', 'type', 'unit']
+
+
+def _sheet():
+    rows = [['ammonia production, biomethane', 'ammonia, anhydrous, liquid', 'lci_ammonia', np.nan, 'DE', 'production', 'kilogram'],
+            ['market group for electricity, medium voltage', 'electricity, medium voltage', 'ecoinvent', np.nan, 'RER', 'technosphere', 'kilowatt hour'],
+            ['market for biomethane', 'biomethane', 'ecoinvent', np.nan, 'RoW', 'technosphere', 'cubic meter'],
+            ['Carbon dioxide, fossil', np.nan, 'biosphere3', 'air::urban air close to ground', np.nan, 'biosphere', 'kilogram'],
+            ['Dinitrogen monoxide', np.nan, 'biosphere3', 'air', np.nan, 'biosphere', 'kilogram']]
+    df = pd.DataFrame(rows, columns=COLUMNS)
+    df['BM1'] = [1.0, 10.2, 0.6, 0.0, 1e-5]
+    df['BM2'] = [1.0, 0.0, 0.55, 0.12, 0.0]
+    df['BM3'] = [2.0, 20.4, 0.0, 0.0, np.nan]
+    df['comment'] = ['', 'market group', '', 'fossil part', '']
+    return df
+
+
+def _wide_sheet(number_datasets, number_rows=120, zero_share=0.6, seed=0):
+    rng = np.random.default_rng(seed)
+    types = ['production'] + ['technosphere'] * (number_rows // 2) + ['biosphere'] * (number_rows - number_rows // 2 - 1)
+    df = pd.DataFrame({'name': [f"exchange {i}" for i in range(number_rows)],
+                       'reference product': [f"product {i}" for i in range(number_rows)],
+                       'database': ['ecoinvent'] * number_rows,
+                       'categories': [np.nan if t != 'biosphere' else 'air::low population density' for t in types],
+                       'location': ['GLO'] * number_rows,
+                       'type': types,
+                       'unit': ['kilogram'] * number_rows})
+    values = rng.random((number_rows, number_datasets)) * (rng.random((number_rows, number_datasets)) > zero_share)
+    values[0] = 1.0
+    for j in range(number_datasets):
+        df[f"DS{j}"] = values[:, j]
+    df['comment'] = ''
+    return df
+
+
+def _create_dataset_from_df_reference(inventories_df):
+    # create_dataset_from_df before it was vectorized (one iloc lookup per cell)
+    COL_START = 7
+    NUMBER_ACTV = len(inventories_df.columns) - COL_START - 1
+
+    inventories = []
+    for i in range(NUMBER_ACTV):
+        col_no = i + COL_START
+        id_actv = inventories_df.columns[col_no]
+        inv_actv = inventories_df.iloc[:, np.r_[0:COL_START, col_no]].copy()
+
+        exchanges = []
+        for exc in list(inv_actv.index):
+            if inv_actv.iloc[exc][id_actv] == 0:
+                pass
+            else:
+                if inv_actv.iloc[exc]['type'] == 'production':
+                    name_actv = f"{inv_actv.iloc[exc]['name']}, {id_actv}"
+                    actv_dict = {'name': name_actv,
+                                 'location': inv_actv.iloc[exc]['location'],
+                                 'reference product': inv_actv.iloc[exc]['reference product'],
+                                 'production amount': inv_actv.iloc[exc][id_actv],
+                                 'unit': inv_actv.iloc[exc]['unit'],
+                                 'database': inv_actv.iloc[exc]['database'],
+                                 'code': wurst.filesystem.get_uuid()
+                                 }
+                    exchanges.append({'name': name_actv,
+                                      'reference product': inv_actv.iloc[exc]['reference product'],
+                                      'amount': inv_actv.iloc[exc][id_actv],
+                                      'unit': inv_actv.iloc[exc]['unit'],
+                                      'database': inv_actv.iloc[exc]['database'],
+                                      'location': inv_actv.iloc[exc]['location'],
+                                      'type': inv_actv.iloc[exc]['type']
+                                      })
+                elif inv_actv.iloc[exc]['type'] == 'technosphere':
+                    exchanges.append({'name': inv_actv.iloc[exc]['name'],
+                                      'reference product': inv_actv.iloc[exc]['reference product'],
+                                      'amount': inv_actv.iloc[exc][id_actv],
+                                      'unit': inv_actv.iloc[exc]['unit'],
+                                      'database': inv_actv.iloc[exc]['database'],
+                                      'location': inv_actv.iloc[exc]['location'],
+                                      'type': inv_actv.iloc[exc]['type']
+                                      })
+                elif inv_actv.iloc[exc]['type'] == 'biosphere':
+                    categories = tuple(inv_actv.iloc[exc]['categories'].split('::'))
+                    exchanges.append({'name': inv_actv.iloc[exc]['name'],
+                                      'amount': inv_actv.iloc[exc][id_actv],
+                                      'unit': inv_actv.iloc[exc]['unit'],
+                                      'categories': categories,
+                                      'database': inv_actv.iloc[exc]['database'],
+                                      'type': inv_actv.iloc[exc]['type']
+                                      })
+
+        actv_dict.update({'exchanges': exchanges})
+        inventories.append(actv_dict)
+
+    return inventories
+
+
+@pytest.fixture
+def uuids(monkeypatch):
+    # Same dataset codes in both implementations
+    def reset():
+        counter = iter(range(10**6))
+        monkeypatch.setattr(wurst.filesystem, 'get_uuid', lambda: f"code {next(counter)}")
+    return reset
+
+
+def _assert_same_datasets(datasets, expected):
+    assert len(datasets) == len(expected)
+    for ds, expected_ds in zip(datasets, expected):
+        # NaN amounts and locations are compared as equal
+        assert pd.Series(ds).drop('exchanges').equals(pd.Series(expected_ds).drop('exchanges'))
+        assert [list(exc) for exc in ds['exchanges']] == [list(exc) for exc in expected_ds['exchanges']]
+        for exc, expected_exc in zip(ds['exchanges'], expected_ds['exchanges']):
+            assert pd.Series(exc).equals(pd.Series(expected_exc))
+            assert type(exc['amount']) is type(expected_exc['amount'])
+
+
+@pytest.mark.parametrize('sheet', [_sheet(), _wide_sheet(5), _wide_sheet(40)], ids=['fixture', '5 datasets', '40 datasets'])
+def test_create_dataset_from_df_matches_reference(sheet, uuids):
+    uuids()
+    expected = _create_dataset_from_df_reference(sheet)
+    uuids()
+    _assert_same_datasets(inventory_imports.create_dataset_from_df(sheet), expected)
+
+
+def test_create_dataset_from_df_without_production():
+    sheet = _sheet()
+    sheet.loc[0, 'BM2'] = 0
+    with pytest.raises(ValueError, match="'BM2' has no production"):
+        inventory_imports.create_dataset_from_df(sheet)
+
+
+def _supplier(name, product, location, code, unit='kilogram', database='ecoinvent'):
+    return {'name': name, 'reference product': product, 'unit': unit, 'location': location,
+            'database': database, 'code': code, 'exchanges': []}
+
+
+def _suppliers():
+    return [_supplier('market group for electricity, medium voltage', 'electricity, medium voltage', 'RER', 'el-rer', 'kilowatt hour'),
+            _supplier('market group for electricity, medium voltage', 'electricity, medium voltage', 'GLO', 'el-glo', 'kilowatt hour'),
+            _supplier('market for electricity, medium voltage', 'electricity, medium voltage', 'DE', 'el-de', 'kilowatt hour'),
+            _supplier('market for electricity, medium voltage', 'electricity, medium voltage', 'CN-NM', 'el-cn-nm', 'kilowatt hour'),
+            _supplier('market for natural gas, high pressure', 'natural gas, high pressure', 'DE', 'ng-de-1', 'cubic meter'),
+            _supplier('market for natural gas, high pressure', 'natural gas, high pressure', 'DE', 'ng-de-2', 'cubic meter'),
+            _supplier('market for natural gas, high pressure', 'natural gas, high pressure', 'Europe without Switzerland', 'ng-eu', 'cubic meter'),
+            _supplier('market for natural gas, high pressure', 'natural gas, high pressure', 'RoW', 'ng-row', 'cubic meter'),
+            _supplier('market for water, deionised', 'water, deionised', 'CH', 'w-ch'),
+            _supplier('market for water, deionised', 'water, deionised', 'RoW', 'w-row')]
+
+
+def _dataset(location):
+    exchanges = [{'name': 'ammonia production', 'product': 'ammonia', 'unit': 'kilogram', 'location': location,
+                  'amount': 1.0, 'type': 'production'},
+                 {'name': 'market group for electricity, medium voltage', 'product': 'electricity, medium voltage',
+                  'unit': 'kilowatt hour', 'location': 'GLO', 'amount': 10.2, 'type': 'technosphere'},
+                 {'name': 'market for natural gas, high pressure', 'product': 'natural gas, high pressure',
+                  'unit': 'cubic meter', 'location': 'RER', 'amount': 0.6, 'type': 'technosphere'},
+                 {'name': 'market for water, deionised', 'product': 'water, deionised', 'unit': 'kilogram',
+                  'location': 'CH', 'amount': 1.5, 'type': 'technosphere'},
+                 {'name': 'Carbon dioxide, fossil', 'categories': ('air',), 'unit': 'kilogram', 'amount': 0.1,
+                  'type': 'biosphere'}]
+    return {'name': 'ammonia production', 'reference product': 'ammonia', 'unit': 'kilogram', 'location': location,
+            'database': 'lci_reg', 'code': f"nh3-{location}", 'exchanges': exchanges}
+
+
+def _relink_exchange_location_reference(ds, db):
+    # relink_exchange_location before the supplier index (list scans of `db` for every exchange)
+    LOCATION = ds['location']
+    technosphere = lambda x: x["type"] == "technosphere"
+    geomatcher = inventory_imports.Geomatcher()
+
+    for exc in filter(technosphere, ds["exchanges"]):
+        exc_filter = {'name': exc['name'],
+                      'product': exc['product'],
+                      'unit': exc['unit']}
+
+        if 'market group' in exc['name']:
+            possible_datasets_group = list(wurst.transformations.geo.get_possibles(exc_filter, db))
+            exc_filter_market = copy.deepcopy(exc_filter)
+            exc_filter_market.update({'name': exc['name'].replace('market group', 'market')})
+            possible_datasets_market = list(wurst.transformations.geo.get_possibles(exc_filter_market, db))
+            possible_datasets = possible_datasets_group + possible_datasets_market
+        else:
+            possible_datasets = list(wurst.transformations.geo.get_possibles(exc_filter, db))
+
+        match_dataset = [ds for ds in possible_datasets if ds['location'] == LOCATION]
+        if len(match_dataset) == 0:
+            loc_intersection = geomatcher.intersects(LOCATION, biggest_first=False)
+            for loc in [i[1] if type(i)==tuple else i for i in loc_intersection]:
+                match_dataset = [ds for ds in possible_datasets if ds['location'] == loc]
+                if len(match_dataset) > 0:
+                    break
+                else:
+                    match_dataset = [ds for ds in possible_datasets if ds['location'] == 'RoW']
+
+        exc.update({
+                    'name': match_dataset[0]['name'],
+                    'product': match_dataset[0]['reference product'],
+                    'unit': match_dataset[0]['unit'],
+                    'location': match_dataset[0]['location'],
+                    'input': (match_dataset[0]['database'], match_dataset[0]['code'])
+                    })
+
+    return ds
+
+
+@pytest.mark.parametrize('location', ['DE', 'FR', 'CH', 'CN', 'BR'])
+def test_relink_exchange_location_matches_reference(location):
+    db = _suppliers() + [_dataset(loc) for loc in ('DE', 'FR', 'CH', 'CN', 'BR')]
+    expected = _relink_exchange_location_reference(_dataset(location), db)
+    supplier_index = inventory_imports.build_supplier_index(db)
+
+    assert inventory_imports.relink_exchange_location(_dataset(location), db) == expected
+    assert inventory_imports.relink_exchange_location(_dataset(location), None, supplier_index) == expected
+
+
+def test_relink_exchange_location_choices():
+    db = _suppliers()
+    inputs = {location: [exc.get('input') for exc in inventory_imports.relink_exchange_location(_dataset(location), db)['exchanges']
+                         if exc['type'] == 'technosphere']
+              for location in ('DE', 'FR', 'CN')}
+
+    # Own location (first of the duplicates, and "market" when there is no "market group"), then intersecting
+    # locations from the smallest to the biggest, then RoW
+    assert inputs['DE'] == [('ecoinvent', 'el-de'), ('ecoinvent', 'ng-de-1'), ('ecoinvent', 'w-row')]
+    assert inputs['FR'] == [('ecoinvent', 'el-rer'), ('ecoinvent', 'ng-eu'), ('ecoinvent', 'w-row')]
+    assert inputs['CN'] == [('ecoinvent', 'el-cn-nm'), ('ecoinvent', 'ng-row'), ('ecoinvent', 'w-row')]
+
+
+def test_relink_exchange_location_without_supplier():
+    db = [ds for ds in _suppliers() if 'water' not in ds['name']]
+    with pytest.raises(ValueError, match='No supplier found for market for water, deionised'):
+        inventory_imports.relink_exchange_location(_dataset('DE'), db)
@@ -0,0 +1,111 @@
+import numpy as np
+import pandas as pd
+import pytest
+from scipy import sparse
+from scipy.sparse.linalg import spsolve
+
+from src import lca_matrices
+
+
+def _system(number_products=40, number_flows=6, number_impacts=2, seed=0):
+    rng = np.random.default_rng(seed)
+    inputs = sparse.random(number_products, number_products, density=0.1, random_state=seed, data_rvs=rng.random)
+    inputs.setdiag(0)
+    technosphere = sparse.csc_matrix(sparse.eye(number_products) - 0.3 * inputs)
+    biosphere = sparse.random(number_flows, number_products, density=0.4, random_state=seed + 1, format='csr')
+    characterization = rng.random((number_impacts, number_flows))
+    demand = np.zeros(number_products)
+    demand[0] = 1
+    return technosphere, biosphere, characterization, demand
+
+
+def _scenario_scores_reference(technosphere, biosphere, characterization, demand,
+                               technosphere_changes=None, biosphere_changes=None):
+    # One matrix update and full solve per scenario, as with presamples and `lca.redo_lci`
+    number_scenarios = max(np.asarray(changes[2]).reshape(len(changes[0]), -1).shape[1]
+                           for changes in (technosphere_changes, biosphere_changes) if changes is not None)
+    scores = []
+    for s in range(number_scenarios):
+        technosphere_s, biosphere_s = technosphere.tolil(), biosphere.tolil()
+        for matrix, changes in ((technosphere_s, technosphere_changes), (biosphere_s, biosphere_changes)):
+            if changes is not None:
+                rows, cols, values = changes
+                values = np.asarray(values, dtype=float).reshape(len(rows), -1)
+                for row, col, value in zip(rows, cols, values[:, s]):
+                    matrix[row, col] = value
+        supply = spsolve(technosphere_s.tocsc(), demand)
+        scores.append(characterization @ (biosphere_s.tocsr() @ supply))
+    return np.array(scores)
+
+
+def _one_at_a_time(technosphere, variation=0.2):
+    rows, cols = technosphere.nonzero()
+    values = np.asarray(technosphere[rows, cols]).ravel()
+    perturbed = np.repeat(values[:, None], len(values), axis=1)
+    np.fill_diagonal(perturbed, values * (1 + variation))
+    return rows, cols, perturbed
+
+
+def test_scenario_scores_few_changes():
+    technosphere, biosphere, characterization, demand = _system()
+    technosphere_changes = ([1, 2, 5], [0, 1, 2], [[-0.5, -0.2, 0.0], [-0.1, -0.4, -0.3], [0.0, 0.0, -0.2]])
+    biosphere_changes = ([0, 3], [0, 2], [[1.0, 2.0, 0.5], [0.0, 0.1, 0.3]])
+
+    scores = lca_matrices.scenario_scores(technosphere, biosphere, characterization, demand,
+                                          technosphere_changes, biosphere_changes)
+    expected = _scenario_scores_reference(technosphere, biosphere, characterization, demand,
+                                          technosphere_changes, biosphere_changes)
+    assert np.allclose(scores, expected)
+
+
+@pytest.mark.parametrize('max_rank', [200, 5, 0], ids=['shared', 'per scenario', 'full solve'])
+def test_scenario_scores_one_at_a_time(max_rank):
+    technosphere, biosphere, characterization, demand = _system()
+    technosphere_changes = _one_at_a_time(technosphere)
+
+    scores = lca_matrices.scenario_scores(technosphere, biosphere, characterization, demand,
+                                          technosphere_changes, max_rank=max_rank)
+    expected = _scenario_scores_reference(technosphere, biosphere, characterization, demand, technosphere_changes)
+    assert scores.shape == (len(technosphere_changes[0]), characterization.shape[0])
+    assert np.allclose(scores, expected)
+
+
+def test_calculate_impacts_with_scenarios(monkeypatch):
+    results_analysis = pytest.importorskip('src.results_analysis')
+    technosphere, biosphere, characterization, demand = _system(number_products=8, number_flows=3, seed=2)
+    products = [('lci', f"p{i}") for i in range(8)]
+    flows = [('biosphere3', f"f{i}") for i in range(3)]
+
+    class LCA:
+        def __init__(self, demand):
+            self.demand = demand
+
+        def load_lci_data(self):
+            self.product_dict = self.activity_dict = {key: i for i, key in enumerate(products)}
+            self.biosphere_dict = {key: i for i, key in enumerate(flows)}
+            self.technosphere_matrix, self.biosphere_matrix = technosphere, biosphere
+
+    monkeypatch.setattr(results_analysis.bw, 'LCA', LCA, raising=False)
+    monkeypatch.setattr(results_analysis, 'characterization_matrix', lambda lcia_methods, biosphere_dict: characterization)
+
+    # Scenario data as in `perturbation_analysis_with_ps`: amounts of the exchanges (inputs are positive)
+    scenario_df = pd.DataFrame({'input': [products[3], products[5], flows[1]],
+                                'output': [products[0], products[3], products[0]],
+                                'from_type': ['technosphere', 'technosphere', 'biosphere'],
+                                'default': [0.2, 0.1, 0.5],
+                                'S1': [0.4, 0.1, 0.5],
+                                'S2': [0.2, 0.3, 1.5]})
+    scenario_label = ['default', 'S1', 'S2']
+    matrix_data = results_analysis.ps_matrix_data(scenario_df, scenario_label)
+    assert [matrix for _, _, matrix in matrix_data] == ['technosphere', 'biosphere']
+
+    ds = type('Activity', (), {'key': products[0]})()
+    results = results_analysis.calculate_impacts_with_scenarios(matrix_data, scenario_label, ds,
+                                                                {'climate change': ('ipcc',), 'acidification': ('ef',)})
+
+    expected = _scenario_scores_reference(technosphere, biosphere, characterization, demand,
+                                          ([3, 5], [0, 3], -scenario_df.loc[:1, scenario_label].to_numpy()),
+                                          ([1], [0], scenario_df.loc[2:, scenario_label].to_numpy()))
+    assert list(results.columns) == scenario_label
+    assert list(results.index) == ['climate change', 'acidification']
+    assert np.allclose(results.to_numpy(), expected.T)
@@ -0,0 +1,146 @@
+import http.client
+import json
+import socket
+import threading
+
+import numpy as np
+import pytest
+from scipy import sparse
+
+from src import lca_engine
+from src import lca_server
+
+
+PRODUCTS = {('db', 'ammonia'): 0, ('db', 'gas'): 1, ('db', 'heat'): 2, ('db', 'electricity'): 3}
+FLOWS = {('biosphere3', 'co2'): 0, ('biosphere3', 'ch4'): 1}
+NAMES = {('db', 'ammonia'): 'ammonia production, liquid',
+         ('db', 'gas'): 'market group for natural gas, high pressure',
+         ('db', 'heat'): 'heat production, at industrial furnace >100kW, natural gas',
+         ('db', 'electricity'): 'market group for electricity, medium voltage'}
+TECHNOSPHERE = np.array([[1.0, 0.0, 0.0, 0.0],
+                         [-0.5, 1.0, -0.1, 0.0],
+                         [-2.0, 0.0, 1.0, 0.0],
+                         [-1.0, 0.0, -0.05, 1.0]])
+BIOSPHERE = np.array([[1.5, 0.2, 0.3, 0.4],
+                      [0.0, 0.01, 0.0, 0.001]])
+CHARACTERIZATION = np.array([[1.0, 29.8],
+                             [0.0, 1.0]])
+
+
+def dense_scores(product, amount=1.0, technosphere=TECHNOSPHERE, biosphere=BIOSPHERE):
+    demand = np.zeros(len(PRODUCTS))
+    demand[PRODUCTS[product]] = amount
+    return CHARACTERIZATION @ (biosphere @ np.linalg.solve(technosphere, demand))
+
+
+@pytest.fixture(scope='module')
+def bundle_dir(tmp_path_factory):
+    dirpath = tmp_path_factory.mktemp('bundle')
+    lca_engine.write_matrix_bundle(dirpath, sparse.csc_matrix(TECHNOSPHERE), sparse.csc_matrix(BIOSPHERE),
+                                   CHARACTERIZATION, PRODUCTS, PRODUCTS, FLOWS, ['Climate change', 'Methane'], NAMES)
+    return dirpath
+
+
+@pytest.fixture(scope='module')
+def bundle(bundle_dir):
+    return lca_server.warm_bundle(lca_engine.load_matrix_bundle(bundle_dir))
+
+
+@pytest.fixture(scope='module')
+def server(bundle_dir):
+    server = lca_server.make_server(bundle_dir, port=0)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind((lca_server.DEFAULT_HOST, 0))
+        return s.getsockname()[1]
+
+
+def post(server, operation, payload):
+    connection = http.client.HTTPConnection(*server.server_address, timeout=10)
+    try:
+        connection.request('POST', f"/{operation}", body=json.dumps(payload).encode(),
+                           headers={'Content-Type': 'application/json'})
+        response = connection.getresponse()
+        return response.status, json.loads(response.read())
+    finally:
+        connection.close()
+
+
+def test_multi_lcia(server, bundle):
+    payload = {'demands': [['ammonia', ['db', 'ammonia'], 2.0], ['heat', ['db', 'heat'], 1.0]]}
+    result = lca_server.request('multi_lcia', payload, port=server.server_address[1])
+
+    assert result['labels'] == ['ammonia', 'heat']
+    assert np.allclose(result['scores'][0], dense_scores(('db', 'ammonia'), 2.0))
+    assert np.allclose(result['scores'][1], dense_scores(('db', 'heat')))
+    assert np.allclose(result['scores'], lca_server.handle_request(bundle, 'multi_lcia', payload)['scores'])
+
+
+def test_system_contribution(server, bundle):
+    payload = {'key': ['db', 'ammonia'], 'amount': 1}
+    contributions = lca_server.request('system_contribution', payload, port=server.server_address[1])['contributions']
+
+    climate_change = contributions['Climate change']
+    assert np.isclose(climate_change['Total'], dense_scores(('db', 'ammonia'))[0])
+    assert np.isclose(climate_change['Direct emissions'], CHARACTERIZATION[0] @ BIOSPHERE[:, 0])
+    assert np.isclose(sum(value for component, value in climate_change.items() if component != 'Total'),
+                      climate_change['Total'])
+    assert contributions == lca_server.json_compatible(
+        lca_server.handle_request(bundle, 'system_contribution', payload)['contributions'])
+
+
+def test_scenario_deltas(server, bundle):
+    payload = {'demands': [['ammonia', ['db', 'ammonia'], 1.0]],
+               'technosphere': [[['db', 'heat'], ['db', 'ammonia'], [2.0, 1.0, 3.0]]],
+               'biosphere': [[['biosphere3', 'co2'], ['db', 'ammonia'], [1.5, 0.0, 1.0]]]}
+    result = lca_server.request('scenario_deltas', payload, port=server.server_address[1])
+
+    for s, (heat, co2) in enumerate([(2.0, 1.5), (1.0, 0.0), (3.0, 1.0)]):
+        technosphere, biosphere = TECHNOSPHERE.copy(), BIOSPHERE.copy()
+        technosphere[2, 0], biosphere[0, 0] = -heat, co2
+        assert np.allclose(result['scores'][0][s], dense_scores(('db', 'ammonia'), 1.0, technosphere, biosphere))
+    assert np.allclose(result['deltas'][0][0], 0)
+    assert np.allclose(result['deltas'], lca_server.handle_request(bundle, 'scenario_deltas', payload)['deltas'])
+
+
+def test_errors(server, monkeypatch):
+    status, body = post(server, 'multi_lcia', {'demands': [['x', ['db', 'unknown'], 1.0]]})
+    assert status == 400 and 'Unknown product' in body['error']
+
+    status, body = post(server, 'scenario_deltas',
+                        {'demands': [['ammonia', ['db', 'ammonia'], 1.0]],
+                         'technosphere': [[['db', 'heat'], ['db', 'ammonia'], [2.0, 1.0]]],
+                         'biosphere': [[['biosphere3', 'co2'], ['db', 'ammonia'], [1.5, 0.0, 1.0]]]})
+    assert status == 400 and 'different numbers of scenarios' in body['error']
+
+    monkeypatch.setitem(lca_server.OPERATIONS, 'info', lambda bundle, payload: 1 / 0)
+    status, body = post(server, 'info', {})
+    assert status == 500 and 'ZeroDivisionError' in body['error']
+    with pytest.raises(ValueError, match='ZeroDivisionError'):
+        lca_server.request('info', port=server.server_address[1])
+
+
+def test_no_server():
+    with pytest.raises(ConnectionError):
+        lca_server.request('info', port=free_port())
+
+
+def test_service_fallback(server, bundle_dir):
+    results_analysis = pytest.importorskip('src.results_analysis')
+    demands = {'ammonia': (('db', 'ammonia'), 2.0), 'heat': (('db', 'heat'), 1.0)}
+
+    with_server = results_analysis.service_multi_lcia(demands, bundle_dir, port=server.server_address[1])
+    without_server = results_analysis.service_multi_lcia(demands, bundle_dir, port=free_port())
+    assert np.allclose(with_server.to_numpy(), without_server.to_numpy())
+    assert np.allclose(without_server.loc['ammonia'].to_numpy(), dense_scores(('db', 'ammonia'), 2.0))
+
+    port = free_port()
+    assert results_analysis.service_system_contribution(('db', 'ammonia'), bundle_dir, port=port) == \
+        results_analysis.service_system_contribution(('db', 'ammonia'), bundle_dir, port=server.server_address[1])